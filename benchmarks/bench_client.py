@@ -0,0 +1,81 @@
+""" Start/stop/status cycles per minute through `sock.PulseClient` and
+`sock.AsyncPulseClient`, against a control server on a free port.
+
+    connect each    a new connection for every command, as a script had to
+                    once the connection of the old helpers was lost
+    sequential      one `PulseClient`, waiting for each reply
+    pipelined       one `PulseClient`, sending every command before reading
+                    the replies
+    async           `AsyncPulseClient`, all the requests gathered at once
+
+Run from the repository root with:
+    python -m benchmarks.bench_client
+"""
+import asyncio
+import contextlib
+import io
+import time
+
+from sock import AsyncPulseClient, PulseClient
+from src.control_server import ControlServer
+
+N_CYCLES = 1000
+CYCLE = ("START", "STOP", "STATUS")
+
+
+def connect_each(port, n):
+    for _ in range(n):
+        for command in CYCLE:
+            with PulseClient(port=port) as client:
+                client.request(command)
+
+
+def sequential(port, n):
+    with PulseClient(port=port) as client:
+        for _ in range(n):
+            for command in CYCLE:
+                client.request(command)
+
+
+def pipelined(port, n):
+    with PulseClient(port=port) as client:
+        replies = [client.submit(command) for _ in range(n) for command in CYCLE]
+        for reply in replies:
+            reply.result()
+
+
+async def gathered(port, n):
+    async with AsyncPulseClient(port=port) as client:
+        await asyncio.gather(*[client.request(command) for _ in range(n) for command in CYCLE])
+
+
+def main():
+    running = []
+    def on_command(command):
+        if command == "STATUS":
+            return "running" if running else "stopped"
+        running[:] = [True] if command == "START" else []
+    server = ControlServer(on_command=on_command, port=0)
+    cases = [
+        ("connect each", lambda: connect_each(server.port, N_CYCLES // 10), N_CYCLES // 10),
+        ("sequential", lambda: sequential(server.port, N_CYCLES), N_CYCLES),
+        ("pipelined", lambda: pipelined(server.port, N_CYCLES), N_CYCLES),
+        ("async", lambda: asyncio.run(gathered(server.port, N_CYCLES)), N_CYCLES),
+    ]
+    results = []
+    # The server prints every command, which would be timed too
+    with contextlib.redirect_stdout(io.StringIO()):
+        server.start()
+        server.wait_listening()
+        for name, f, n in cases:
+            t0 = time.perf_counter()
+            f()
+            results.append((name, n / (time.perf_counter() - t0) * 60))
+        server.kill()
+        server.join()
+    for name, rate in results:
+        print("%-14s %10.0f cycles/minute" % (name, rate))
+
+
+if __name__ == "__main__":
+    main()
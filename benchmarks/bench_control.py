@@ -0,0 +1,94 @@
+""" Command latency of the control server (`src.control_server`).
+
+Local clients, like `sock.MockClient`, connect to a server on a free port
+and time:
+    framed      round trip of a framed STOP and its b"OK STOP" reply
+    legacy      a bare b"STOP" until the server has dispatched it
+    clients     round trips with `N_CLIENTS` framed clients at once
+
+Run from the repository root with:
+    python -m benchmarks.bench_control
+"""
+import contextlib
+import io
+import socket
+import statistics
+import threading
+import time
+
+from sock import pack_frame, recv_frame
+from src.control_server import ControlServer
+
+N_ROUNDS = 2000
+N_CLIENTS = 8
+
+
+def summary(times):
+    times = sorted(times)
+    p99 = times[min(len(times) - 1, int(len(times) * 0.99))]
+    return "median %7.1f us   p99 %7.1f us   max %7.1f us" % (
+        statistics.median(times) * 1e6, p99 * 1e6, times[-1] * 1e6)
+
+
+def connect(server):
+    sock = socket.create_connection((server.host, server.port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def framed_round_trips(server, n, out):
+    sock = connect(server)
+    message = pack_frame(b"STOP")
+    for _ in range(n):
+        t0 = time.perf_counter()
+        sock.sendall(message)
+        reply = recv_frame(sock)
+        out.append(time.perf_counter() - t0)
+        assert reply == b"OK STOP", reply
+    sock.close()
+
+
+def legacy_dispatch(server, dispatched, n):
+    sock = connect(server)
+    times = []
+    for _ in range(n):
+        dispatched.clear()
+        t0 = time.perf_counter()
+        sock.sendall(b"STOP")
+        dispatched.wait()
+        times.append(time.perf_counter() - t0)
+    sock.close()
+    return times
+
+
+def main():
+    dispatched = threading.Event()
+    server = ControlServer(on_command=lambda command: dispatched.set(), port=0)
+    # The server prints every command, which would be timed too
+    with contextlib.redirect_stdout(io.StringIO()):
+        server.start()
+        server.wait_listening()
+        times = []
+        framed_round_trips(server, N_ROUNDS, times)
+        legacy = legacy_dispatch(server, dispatched, N_ROUNDS)
+    print("framed   %s" % summary(times))
+    print("legacy   %s" % summary(legacy))
+
+    times = []
+    threads = [threading.Thread(target=framed_round_trips, args=(server, N_ROUNDS, times))
+        for _ in range(N_CLIENTS)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        t0 = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        dt = time.perf_counter() - t0
+        server.kill()
+        server.join()
+    print("clients  %s   (%d clients, %.0f commands/s)" % (
+        summary(times), N_CLIENTS, len(times) / dt))
+
+
+if __name__ == "__main__":
+    main()
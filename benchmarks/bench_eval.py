@@ -0,0 +1,46 @@
+""" Timing for `StructuredSequence.eval` of CPMG-2.pls, structure
+"0, (1, 2^N)^M, 3", as the number of repetitions N*M grows.
+
+The time per repetition should stay roughly constant. For comparison the
+same children are also joined pairwise (`a + b + ...`), which copies the
+sequence so far on every step.
+
+Run from the repository root with:
+    python -m benchmarks.bench_eval
+"""
+import contextlib
+import io
+import time
+from functools import reduce
+
+from pulse_src import load_pulse
+from pulse_src.pulse_utils import RawSequence
+
+
+def timed(f, repeats=3):
+    best = float("inf")
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        out = f()
+        best = min(best, time.perf_counter() - t0)
+    return best, out
+
+
+def main():
+    with contextlib.redirect_stdout(io.StringIO()):
+        pulse = load_pulse.read_pulse_file("pulses/CPMG-2.pls")
+    a, b, c, d = [child.eval() for child in pulse.children[:4]]
+    print("%6s %6s %8s %12s %12s %14s" % ("N", "M", "reps", "eval (s)", "us/rep", "pairwise (s)"))
+    for N, M in [(4, 4), (8, 8), (16, 16), (32, 32), (64, 64), (128, 128)]:
+        dt, raw = timed(lambda: pulse.eval(N=N, M=M))
+        if N * M <= 1024:
+            parts = [a] + ([b] + [c] * N) * M + [d]
+            dt_pair, _ = timed(lambda: reduce(RawSequence.concat, parts), repeats=1)
+            pairwise = "%14.4f" % dt_pair
+        else:
+            pairwise = "%14s" % "-"
+        print("%6d %6d %8d %12.4f %12.2f %s" % (N, M, N * M, dt, dt / (N * M) * 1e6, pairwise))
+
+
+if __name__ == "__main__":
+    main()
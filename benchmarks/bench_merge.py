@@ -0,0 +1,43 @@
+""" Timing for `pulse_utils.merge_flag_words`.
+
+Run from the repository root with:
+    python -m benchmarks.bench_merge
+"""
+import time
+
+import numpy as np
+
+from pulse_src import pulse_utils as pu
+
+N_BITS = 24
+
+
+def random_flag_seqs(n_edges, n_used=8, seed=0):
+    """ Create `n_used` random flag sequences (relative times, in ns) with
+    `n_edges` toggles in total, spread over the first `n_used` bits. """
+    rng = np.random.default_rng(seed)
+    seqs = [[] for _ in range(N_BITS)]
+    for bit in range(n_used):
+        seqs[bit] = rng.integers(0, 50, size=n_edges // n_used) * 10
+    return seqs
+
+
+def time_merge(n_edges, repeats=3):
+    seqs = random_flag_seqs(n_edges)
+    best = np.inf
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        t_ax, words = pu.merge_flag_words(seqs)
+        best = min(best, time.perf_counter() - t0)
+    return best, len(t_ax)
+
+
+def main():
+    print("%12s %12s %10s %14s" % ("edges", "frames", "time (s)", "edges/s"))
+    for n_edges in [10**3, 10**4, 10**5, 10**6, 4 * 10**6]:
+        dt, n_frames = time_merge(n_edges)
+        print("%12d %12d %10.4f %14.3g" % (n_edges, n_frames, dt, n_edges / dt))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+""" Startup and parse timing for the files in `pulses/`.
+
+Compares reading the time literals of every sequence token with
+`units.parse_time_ns` against astropy's `Quantity` (if installed), times
+`read_pulse_file` over the whole corpus, and the import time of the loader
+against that of `astropy.units` in a fresh interpreter.
+
+Run from the repository root with:
+    python -m benchmarks.bench_parse
+"""
+import contextlib
+import glob
+import io
+import subprocess
+import sys
+import time
+
+from pulse_src import load_pulse
+from pulse_src.units import parse_time_ns
+
+
+def timed(f, repeats=5):
+    best = float("inf")
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        f()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def import_time(module, repeats=3):
+    """ Wall time of importing `module` in a new interpreter, less the
+    interpreter's own startup. """
+    def run(code):
+        return timed(lambda: subprocess.run([sys.executable, "-c", code], check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL), repeats)
+    return run("import %s" % module) - run("pass")
+
+
+def corpus_tokens(files):
+    """ Every word of the sequence sections that is a plain time literal. """
+    tokens = []
+    for filename in files:
+        with open(filename) as f:
+            lines = f.read().split("!")[1].splitlines()[1:]
+        for line in lines:
+            line = load_pulse.ignore_comments(line)
+            if ":" not in line: continue
+            for word in line.split(":")[1].replace(",", " ").split():
+                try:
+                    parse_time_ns(word)
+                except ValueError:
+                    continue
+                tokens.append(word)
+    return tokens
+
+
+def parse_all(tokens):
+    for word in tokens:
+        parse_time_ns(word)
+
+
+def parse_all_astropy(tokens):
+    from astropy import units as u
+    for word in tokens:
+        q = u.Quantity(word, dtype=float if "." in word else int)
+        if str(q.unit) == "":
+            q *= u.ns
+        round(q.to("ns").value)
+
+
+def read_all(files):
+    with contextlib.redirect_stdout(io.StringIO()):
+        for filename in files:
+            load_pulse.read_pulse_file(filename)
+
+
+def main():
+    files = sorted(glob.glob("pulses/*.pls"))
+    tokens = corpus_tokens(files)
+    print("%d files, %d time literals" % (len(files), len(tokens)))
+
+    dt = timed(lambda: parse_all(tokens))
+    print("parse_time_ns      %10.1f us/token" % (dt / len(tokens) * 1e6))
+    try:
+        import astropy
+    except ImportError:
+        print("astropy Quantity   %10s" % "not installed")
+    else:
+        dt_astropy = timed(lambda: parse_all_astropy(tokens))
+        print("astropy Quantity   %10.1f us/token  (%.0fx)" % (
+            dt_astropy / len(tokens) * 1e6, dt_astropy / dt))
+
+    dt = timed(lambda: read_all(files))
+    print("read_pulse_file    %10.2f ms/file" % (dt / len(files) * 1e3))
+
+    print("import pulse_src.load_pulse %8.0f ms" % (import_time("pulse_src.load_pulse") * 1e3))
+    try:
+        print("import astropy.units        %8.0f ms" % (import_time("astropy.units") * 1e3))
+    except subprocess.CalledProcessError:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+""" Import time of `main.py`, from `python -X importtime`.
+
+Prints the slowest imports and fails (exit status 1) if importing `main`
+takes longer than `BUDGET_MS`, or if any of the `DEFERRED` modules, which
+should only be imported when first used, are imported at start up.
+
+Run from the repository root with:
+    python -m benchmarks.bench_startup
+"""
+import subprocess
+import sys
+
+BUDGET_MS = 500
+DEFERRED = ["matplotlib", "scipy", "astropy"]
+N_SHOWN = 15
+
+
+def import_times(module):
+    """ List of `(name, self us, cumulative us, depth)` for every module
+    imported by `import module` in a fresh interpreter. """
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import %s" % module],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    times = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        times.append((name.strip(), int(self_us), int(cumulative), depth))
+    return times
+
+
+def main():
+    times = min((import_times("main") for _ in range(3)),
+        key=lambda t: [c for n, s, c, d in t if n == "main"][0])
+    total_ms = [c for name, s, c, d in times if name == "main"][0] / 1e3
+    print("%-40s %10s %10s" % ("module", "self (ms)", "cum. (ms)"))
+    for name, self_us, cumulative, depth in sorted(times, key=lambda t: -t[2])[:N_SHOWN]:
+        print("%-40s %10.1f %10.1f" % ("  " * depth + name, self_us / 1e3, cumulative / 1e3))
+
+    failed = False
+    print("\nimport main: %.0f ms (budget %d ms)" % (total_ms, BUDGET_MS))
+    if total_ms > BUDGET_MS:
+        print("Over budget")
+        failed = True
+    imported = {name.split(".")[0] for name, *_ in times}
+    eager = [name for name in DEFERRED if name in imported]
+    if eager:
+        print("Imported at start up, should be deferred: %s" % ", ".join(eager))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
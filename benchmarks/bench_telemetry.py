@@ -0,0 +1,93 @@
+""" Size and throughput of the telemetry messages (`sock.encode_telemetry`).
+
+Sweeps `pulses/Rabi.pls` over `N_STEPS` values of tau, then times encoding
+and decoding its telemetry, and sending it through the control server to a
+local framed client which decodes every message, against the old 16 byte
+length message sent to a legacy client.
+
+Run from the repository root with:
+    python -m benchmarks.bench_telemetry
+"""
+import contextlib
+import io
+import socket
+import threading
+import time
+
+import numpy as np
+
+from pulse_src import load_pulse
+from sock import decode_telemetry, encode_telemetry, pack_frame, recv_exactly, recv_frame
+from src.control_server import ControlServer
+
+N_STEPS = 1000
+N_MESSAGES = 2000
+
+
+def timed(f, repeats=200):
+    best = float("inf")
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        f()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def receive(sock, n, framed, done):
+    for _ in range(n):
+        if framed:
+            decode_telemetry(recv_frame(sock))
+        else:
+            int.from_bytes(recv_exactly(sock, 16), "big")
+    done.set()
+
+
+def stream(server, program, framed):
+    """ Messages per second from `send_info()` to a client having read them. """
+    sock = socket.create_connection((server.host, server.port))
+    # A framed client is recognised by its first message
+    sock.sendall(pack_frame(b"NONE") if framed else b" ")
+    if framed:
+        recv_frame(sock)
+    while not server.con_alive:
+        time.sleep(1e-3)
+    done = threading.Event()
+    reader = threading.Thread(target=receive, args=(sock, N_MESSAGES, framed, done))
+    reader.start()
+    t0 = time.perf_counter()
+    for _ in range(N_MESSAGES):
+        server.send_info(program)
+    done.wait()
+    dt = time.perf_counter() - t0
+    reader.join()
+    sock.close()
+    while server.con_alive:
+        time.sleep(1e-3)
+    return N_MESSAGES / dt
+
+
+def main():
+    with contextlib.redirect_stdout(io.StringIO()):
+        pulse = load_pulse.read_pulse_file("pulses/Rabi.pls")
+    program = pulse.sweep({"tau": np.linspace(10, 1000, N_STEPS)}, n_steps=N_STEPS)
+    message = encode_telemetry(program)
+    print("%r, %d steps" % (program, N_STEPS))
+    print("message      %10d bytes" % len(message))
+    print("encode       %10.1f us" % (timed(lambda: encode_telemetry(program)) * 1e6))
+    print("decode       %10.1f us" % (timed(lambda: decode_telemetry(message)) * 1e6))
+
+    server = ControlServer(port=0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        server.start()
+        server.wait_listening()
+        telemetry_rate = stream(server, program, framed=True)
+        length_rate = stream(server, program, framed=False)
+        server.kill()
+        server.join()
+    print("telemetry    %10.0f messages/s  (%.1f MB/s)" % (
+        telemetry_rate, telemetry_rate * len(message) / 1e6))
+    print("length only  %10.0f messages/s" % length_rate)
+
+
+if __name__ == "__main__":
+    main()
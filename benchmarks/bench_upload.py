@@ -0,0 +1,59 @@
+""" Instruction upload rate of `SequenceProgram`, adding instructions one at a
+time with `add_instruction` compared to a block with `add_instructions`.
+
+Without the SpinAPI library this measures the Python overhead against the
+debug stand-in, which returns immediately.
+
+Run from the repository root with:
+    python -m benchmarks.bench_upload
+"""
+import time
+
+import numpy as np
+
+from pulse_src import pulse_utils as pu
+from pulse_src.spinapi import Inst
+
+
+def random_program(n_inst, seed=0):
+    rng = np.random.default_rng(seed)
+    flags = rng.integers(0, 1 << 21, size=n_inst)
+    opcode = np.full(n_inst, Inst.CONTINUE)
+    opcode[-1] = Inst.BRANCH
+    inst_data = np.zeros(n_inst, dtype=int)
+    length = rng.integers(1, 100, size=n_inst) * 10.0
+    return flags, opcode, inst_data, length
+
+
+def time_single(sp, prog):
+    sp.prog_enter()
+    t0 = time.perf_counter()
+    for fields in zip(*(a.tolist() for a in prog)):
+        sp.add_instruction(*fields)
+    dt = time.perf_counter() - t0
+    sp.prog_exit()
+    return dt
+
+
+def time_block(sp, prog):
+    sp.prog_enter()
+    t0 = time.perf_counter()
+    sp.add_instructions(*prog)
+    dt = time.perf_counter() - t0
+    sp.prog_exit()
+    return dt
+
+
+def main():
+    pu.init_board()
+    sp = pu.SequenceProgram("Upload benchmark")
+    print("%10s %14s %14s %8s" % ("inst", "single (i/s)", "block (i/s)", "speedup"))
+    for n_inst in [10**3, 10**4, 10**5, 10**6]:
+        prog = random_program(n_inst)
+        single = min(time_single(sp, prog) for _ in range(3))
+        block = min(time_block(sp, prog) for _ in range(3))
+        print("%10d %14.3g %14.3g %8.1f" % (n_inst, n_inst / single, n_inst / block, single / block))
+
+
+if __name__ == "__main__":
+    main()
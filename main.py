@@ -1,23 +1,25 @@
-import socket
+import os
 import sys
 import time
 import tkinter as tk
 import tkinter.font as tf
-from threading import Thread
-from pulse_src.spinapi import DBG_MODE
+from pulse_src.spinapi import is_debug_mode
 
 import pulse_src.load_pulse as lp
 import pulse_src.pulse_utils as pls
+from pulse_src.program_cache import CACHE
 import src.Boxes
 import src.PulseFrames
-from sock import HOST, PORT
 from src.Boxes import *
 from src.led_indicator import IndicatorLED
+from src.control_server import ControlServer
+from src.jobs import JobExecutor
 from src.pulse_instance import PulseManager as PM, PulseManagerException
 
 PULSE_FOLDER = "pulses"
 IR_WHEN_OFF = True
 IR_ON_PLS = "IR_ON.pls"
+LV_TIMEOUT = 600 # Seconds to wait for labview before giving up programming
 WIDTH = 900
 HEIGHT = 600
 src.PulseFrames.WIDTH = 600
@@ -30,6 +32,9 @@ class AppFrame(tk.Tk):
         global _app_instance
         super(AppFrame, self).__init__(*args, **kwargs)
         self.title("Pulse manager")
+        # Compiling and programming run in the background, see src/jobs.py
+        self.jobs = JobExecutor(self)
+        PM.call_on_main = self.jobs.call_on_main
 
         try:
             os.listdir(PULSE_FOLDER)
@@ -45,6 +50,10 @@ class AppFrame(tk.Tk):
 
         self.pls_controller = pls.SequenceProgram("Main sequence")
         PM.set_controller(self.pls_controller)
+        # Compile the trap-on program now, so restoring the trap is quick
+        self.ir_program = None
+        self.ir_mtime = None
+        self.load_ir_program()
         self.geometry(f"{WIDTH}x{HEIGHT}")
         self.protocol("WM_DELETE_WINDOW", self.on_close)
 
@@ -53,16 +62,18 @@ class AppFrame(tk.Tk):
         self.prog_ready = tk.BooleanVar(self, False) # Program ready and waiting for labview to accept.
         self.ir_when_off = tk.BooleanVar(self, IR_WHEN_OFF) # Run IR_ON.pls during downtime? 
         self.wait_for_LV = tk.BooleanVar(self, True) # Wait for labview to accept programs?
-        if DBG_MODE:
-            self.wait_for_LV.set(False)
         self.LV_connected = tk.BooleanVar(self, False)
         self.err_light = tk.BooleanVar(self, False)
+        self.awaiting_LV = False # Should the next program wait for labview?
 
-        self.sock_thread = SocketThread(self.LV_connected)
+        self.sock_thread = ControlServer(self.LV_connected, on_command=self.handle_command)
         self.sock_thread.start()
+        PM.wait_ready = self.wait_for_LV_ready
 
         self.init_ui()
         PM.register(self)
+        # Before any other board job, so before anything is programmed
+        self.jobs.run_on_board(self.check_debug_mode, on_error=self.job_failed)
         if IR_WHEN_OFF:
             self.notify(event=PM.Event.STOP)
 
@@ -72,6 +83,7 @@ class AppFrame(tk.Tk):
         self.sock_thread.kill()
     
     def on_close(self):
+        self.jobs.shutdown()
         self.kill_threads()
         print("Goodbye")
         self.destroy()
@@ -140,6 +152,10 @@ class AppFrame(tk.Tk):
         # Add wait for labview checkbox
         lv_chkbox = tk.Checkbutton(button_pane, text="Wait for labview?", variable=self.wait_for_LV)
         lv_chkbox.grid(row=row_n, column=2, sticky=tk.W+tk.E)
+        # Stop waiting for labview, the pending program isn't written
+        self.cancel_wait_btn = tk.Button(button_pane, text="Cancel wait",
+            command=self.sock_thread.cancel_wait, state=tk.DISABLED)
+        self.cancel_wait_btn.grid(row=row_n, column=3, sticky=tk.W+tk.E)
         row_n += 1
         font = tf.Font(size=24, weight="bold")
         btn_size = {"width":10, "height":1, "font":font}
@@ -157,6 +173,19 @@ class AppFrame(tk.Tk):
 
         vbox_right.add(button_pane, stretch="never")
 
+    def load_ir_program(self):
+        """ Return the compiled trap-on program (`IR_ON_PLS`), only compiling
+        it again if the file has been modified since it was last compiled. """
+        path = PULSE_FOLDER + "/" + IR_ON_PLS
+        mtime = os.stat(path).st_mtime_ns
+        if self.ir_program is None or mtime != self.ir_mtime:
+            t0 = time.perf_counter()
+            self.ir_program = CACHE.compile_file(path,
+                loops=src.PulseFrames.HW_LOOPS, subroutines=src.PulseFrames.HW_SUBROUTINES)
+            self.ir_mtime = mtime
+            print("Compiled %s in %.1f ms" % (IR_ON_PLS, (time.perf_counter() - t0) * 1e3))
+        return self.ir_program
+
     def indicate_error(self):
         " Light up front panel error light " 
         self.err_light.set(True)
@@ -180,36 +209,14 @@ class AppFrame(tk.Tk):
             self.pb_running.set(False)
 
             if self.ir_when_off.get():
-                # Start PB incase loading a new pulse is slow
-                try:
-                    PM.start()
-                except PulseManagerException:
-                    # If this happens we don't need to worry about the old pulse. (There isn't one)
-                    pass
-
-                # Restart IR sequence
-                print("Restoring Trap-on state")
-                original = PM.get_pulse()
-                pulse = lp.read_pulse_file(PULSE_FOLDER+"/"+IR_ON_PLS)
-                # Set this as the pulse, don't notify because we don't want
-                # to change anything on the frontend.
-                PM.set_pulse(pulse, notify=False)
-                err = PM.program(notify=False, stopping=True)
-                if err:
-                    raise Exception("Failed to program IR_ON.pls, program can not continue.")
-                PM.start(notify=False)
-                self.pb_running.set(True)
-                self.trap_state.set(True)
-                # Restore original
-                PM.set_pulse(original, notify=False)
+                self.jobs.run_on_board(self.restore_trap,
+                    on_done=self.trap_restored, on_error=self.job_failed)
         if event == PM.Event.PREPROGRAM:
             if self.wait_for_LV.get():
                 self.prog_ready.set(True)
-                print("Waiting for LV to be ready for data...")
-                # TODO: Move this out of the main thread
-                while not self.sock_thread.con_alive:
-                    continue
-                print("LV detected.")
+                # The wait itself is on the programming thread, see wait_for_LV_ready()
+                self.awaiting_LV = True
+                self.cancel_wait_btn.config(state=tk.ACTIVE)
 
         if event == PM.Event.PROGRAM:
             # The trap will probably not be on now.
@@ -223,7 +230,7 @@ class AppFrame(tk.Tk):
             else:
                 # Send to client
                 try:
-                    pulse = PulseManager.get_pulse()
+                    pulse = PM.get_programmed()
                     self.sock_thread.send_info(pulse)
                 except Exception as e:
                     self.err_light.set(True)
@@ -238,117 +245,89 @@ class AppFrame(tk.Tk):
         # One last check to make sure the PB running light and variable are in sync
         self.pb_running.set(self.pls_controller.running) 
                     
+    def handle_command(self, command):
+        """ Start or stop the sequence, or report whether it is running, as
+        asked by a control client. Called on the server thread; START and
+        STOP return the future of their board job, which the reply waits for. """
+        if command == "START":
+            return self.jobs.run_on_board(PM.start, on_error=self.job_failed).future
+        elif command == "STOP":
+            return self.jobs.run_on_board(PM.stop, on_error=self.job_failed).future
+        elif command == "STATUS":
+            return "running" if self.pls_controller.running else "stopped"
+
+    def wait_for_LV_ready(self):
+        """ Wait, on the board thread, until labview is connected if the
+        PREPROGRAM event asked to. Raises a PulseManagerException if the wait
+        is cancelled or times out. """
+        if not self.awaiting_LV:
+            return
+        self.awaiting_LV = False
+        print("Waiting for LV to be ready for data...")
+        ready = self.sock_thread.wait_connected(LV_TIMEOUT)
+        self.jobs.post(self.LV_wait_over, ready)
+        if not ready:
+            raise PulseManagerException("Stopped waiting for LV, sequence not programmed.")
+        print("LV detected.")
+
+    def LV_wait_over(self, ready):
+        self.cancel_wait_btn.config(state=tk.DISABLED)
+        if not ready:
+            self.prog_ready.set(False)
+
+    def check_debug_mode(self):
+        """ Stop waiting for labview if there is no board (SpinAPI TEST MODE).
+        Called on the board thread, as it loads the SpinAPI library, which
+        would otherwise hold up building the window. """
+        if is_debug_mode():
+            self.jobs.post(self.wait_for_LV.set, False)
+
+    def restore_trap(self):
+        """ Program and start the trap-on sequence, on the board thread. """
+        # Start PB incase loading a new pulse is slow
+        try:
+            PM.start(notify=False)
+        except PulseManagerException:
+            # If this happens we don't need to worry about the old pulse. (There isn't one)
+            pass
+
+        # Restart IR sequence
+        print("Restoring Trap-on state")
+        t0 = time.perf_counter()
+        pulse = self.load_ir_program()
+        # Don't notify because we don't want to change anything on the frontend.
+        err = PM.program(notify=False, stopping=True, pulse=pulse)
+        if err:
+            raise Exception("Failed to program IR_ON.pls, program can not continue.")
+        PM.start(notify=False, allow_controller_start=True)
+        print("Trap restored in %.1f ms" % ((time.perf_counter() - t0) * 1e3))
+
+    def trap_restored(self, *args):
+        self.pb_running.set(True)
+        self.trap_state.set(True)
+        self.start_btn.config(state=tk.DISABLED)
+
+    def job_failed(self, e):
+        print(e)
+        self.indicate_error()
+
     def prog_and_start(self, *args):
-        # Get current pulse
-        PM.stop(notify=False)
-        PM.program(notify=True)
-        PM.start(notify=True)
+        def run():
+            # Get current pulse
+            PM.stop(notify=False)
+            PM.program(notify=True)
+            PM.start(notify=True)
+        self.jobs.run_on_board(run, on_error=self.job_failed)
 
     def close_controller(self, *args):
         self.err_light.set(True)
         print("!! PB Connection closed !!")
-        self.pls_controller.close()
+        self.jobs.run_on_board(self.pls_controller.close)
 
     def open_controller(self, *args):
         print("** PB Connection opened **")
-        self.pls_controller.init()
-        
-class SocketThread(Thread):
-    def __init__(self, connected_var:tk.Variable=None):
-        super(SocketThread, self).__init__(group=None)
-        self.socket = socket.socket()
-        self.socket.bind((HOST, PORT))
-        self.do_wait = True
-        self.send_buffer = None
-        self.conn = None
-        self.connected_var = connected_var
-        self.killed = False
-        self._con_alive = False
-
-    @property
-    def con_alive(self):
-        return self._con_alive
-    
-    @con_alive.setter
-    def con_alive(self, value:bool):
-        self._con_alive = value
-        if self.connected_var is not None:
-            try:
-                self.connected_var.set(value)
-            except RuntimeError as e:
-                print("Unable to set connection status: " + str(e))
-
-    def stop_wait(self):
-        self.do_wait = False
-
-    def kill(self):
-        self.socket.close()
-        self.killed = True
-
-    def run(self):
-        # Wait for data to be received
-        self.socket.listen()
-        if self.con_alive:
-            self.con_alive = False
+        self.jobs.run_on_board(self.pls_controller.init)
         
-        print("Socket thread waiting for connection.")
-        while True:
-            if self.killed:
-                break
-            try:
-                if not self.con_alive:
-                    self.socket.settimeout(1)
-                    self.conn, addr = self.socket.accept()
-            except socket.timeout:
-                continue
-            except:
-                print("Socket died. Ending socket thread.")
-                self.kill()
-                break
-            else:
-                self.con_alive = True
-                print("Socket thread connected.")
-            while self.do_wait:
-                try:
-                    self.conn.settimeout(1)
-                    data = self.conn.recv(8)
-                except socket.timeout:
-                    continue
-                except:
-                    print("Connection Closed.")
-                    self.con_alive = False
-                    break
-                if len(data) == 0:
-                    print("Stream ended (received no data)")
-                    self.con_alive = False
-                    break
-                if "START" in str(data):
-                    print("Received start request")
-                    PulseManager.start()
-                elif "STOP" in str(data):
-                    print("Received stop request")
-                    # self.stop_wait()
-                    PulseManager.stop()
-                elif "EXIT" in str(data):
-                    print("Received exit request")
-                    # PulseManager.stop()
-                    self.stop_wait()
-                    self.kill()
-                    self.con_alive = False
-                    break
-                else:
-                    print("Received unknown message: %s" % str(data))
-
-            
-    def send_info(self, raw_seq, byte_order="big"):
-        # Send pulse length:
-        if self.conn:
-            length = raw_seq.length_ns
-            length = int(length).to_bytes(16, byte_order)
-            self.conn.send(length)
-        else:
-            print("No connection to send data on yet")
-
 frame = None
 def main():
     global frame
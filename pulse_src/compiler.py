@@ -0,0 +1,524 @@
+import hashlib
+
+import numpy as np
+
+from . import _actions as actions
+from .spinapi import Inst
+
+MAX_LOOP_DEPTH = 8          # Maximum number of nested hardware loops
+MAX_LOOP_COUNT = 1 << 20    # Maximum repetitions of a single hardware loop
+
+
+class CompiledProgram:
+    def __init__(self, flags, opcode, inst_data, length, bit_names=None, used_flags=None):
+        """ A table of Pulse Blaster instructions, stored as one array per field:
+
+            flags:      uint32, flag word output during each instruction
+            opcode:     int32,  `Inst` value of each instruction
+            inst_data:  int32,  data for each instruction (branch target, loop count, etc.)
+            length:     float64, duration of each instruction in nanoseconds
+
+        Instruction `n` is at address `n` on the board. Programs are normally
+        created with `RawSequence.compile()` or `StructuredSequence.compile()`,
+        and can then be programmed any number of times with `program_seq()`
+        without evaluating or merging the sequence again.
+
+        The arrays are read-only so that the program can be hashed and
+        compared, see `digest()` and `diff()`.
+        """
+        self.flags = _frozen(flags, np.uint32)
+        self.opcode = _frozen(opcode, np.int32)
+        self.inst_data = _frozen(inst_data, np.int32)
+        self.length = _frozen(length, np.float64)
+        n = len(self.flags)
+        if not (len(self.opcode) == len(self.inst_data) == len(self.length) == n):
+            raise ValueError("All instruction arrays must have the same length.")
+        self.bit_names = dict(bit_names) if bit_names else {}
+        if used_flags is None:
+            all_flags = np.bitwise_or.reduce(self.flags) if n else 0
+            used_flags = [b for b in range(32) if (int(all_flags) >> b) & 1]
+        self.used_flags = np.array(used_flags, dtype=int)
+        self._controller = None
+        self._digest = None
+        self.saved_instructions = 0 # Instructions saved by using subroutines
+        # For parameter sweeps, the start time and length of each step (ns)
+        # and the parameter values used, see `StructuredSequence.sweep()`
+        self.step_starts = None
+        self.step_lengths = None
+        self.axes = None
+
+    @classmethod
+    def from_frames(cls, t_ax, words, end_action=None, **kwargs):
+        """ Create a program from frame durations and packed flag words,
+        as returned by `merge_flag_words`. Every frame becomes a CONTINUE
+        instruction, except the last which performs `end_action`.
+
+        `end_action` must be a `Branch` action from `_actions.py`, or `None` (default),
+        which branches back to the first instruction.
+        """
+        if end_action is None:
+            # Assume we just want to end the sequence and loop back
+            end_action = actions.Branch(0)
+        elif end_action.inst != Inst.BRANCH:
+            raise Exception("End action is:", type(end_action), end_action.inst)
+        n = len(words)
+        if n == 0:
+            raise ValueError("Can not compile an empty sequence.")
+        opcode = np.full(n, Inst.CONTINUE, dtype=np.int32)
+        inst_data = np.zeros(n, dtype=np.int32)
+        opcode[-1] = end_action.inst
+        inst_data[-1] = end_action.data
+        return cls(words, opcode, inst_data, t_ax, **kwargs)
+
+    def __len__(self):
+        return len(self.flags)
+
+    def __repr__(self):
+        return "<CompiledProgram: %d instructions, %.2f ms, %s>" % (
+            len(self), self.length_ns / 1e6, self.digest()[:8])
+
+    def __eq__(self, other):
+        if not isinstance(other, CompiledProgram):
+            return NotImplemented
+        return self.digest() == other.digest()
+
+    def __hash__(self):
+        return hash(self.digest())
+
+    def digest(self):
+        """ Hex digest of the instruction table, identical programs
+        have identical digests. """
+        if self._digest is None:
+            h = hashlib.sha1()
+            for arr in (self.flags, self.opcode, self.inst_data, self.length):
+                h.update(arr.tobytes())
+            self._digest = h.hexdigest()
+        return self._digest
+
+    def diff(self, other):
+        """ Return an array of the addresses at which this program and `other`
+        have different instructions. Addresses which only exist in one of the
+        programs are included. """
+        n = min(len(self), len(other))
+        differs = np.zeros(n, dtype=bool)
+        for a, b in zip(self._fields(), other._fields()):
+            differs |= a[:n] != b[:n]
+        extra = np.arange(n, max(len(self), len(other)))
+        return np.concatenate([np.flatnonzero(differs), extra])
+
+    def _fields(self):
+        return self.flags, self.opcode, self.inst_data, self.length
+
+    @property
+    def inst_count(self):
+        return len(self)
+
+    @property
+    def length_ns(self):
+        """ Duration of one pass through the program, accounting for loops
+        and subroutines. """
+        return (self.length * self.repeats()).sum()
+
+    @property
+    def main_length(self):
+        """ Number of instructions up to and including the first BRANCH or STOP,
+        which ends the main body of the program. """
+        ends = np.flatnonzero((self.opcode == Inst.BRANCH) | (self.opcode == Inst.STOP))
+        return int(ends[0]) + 1 if len(ends) else len(self)
+
+    def _loop_ends(self):
+        """ Map of the address of each LOOP instruction to its END_LOOP. """
+        ends = np.flatnonzero(self.opcode == Inst.END_LOOP)
+        return dict(zip(self.inst_data[ends].tolist(), ends.tolist()))
+
+    def _sub_end(self, start):
+        """ Address of the RTS instruction ending the subroutine at `start`. """
+        return start + int(np.argmax(self.opcode[start:] == Inst.RTS))
+
+    def repeats(self):
+        """ Number of times each instruction is executed during one pass
+        through the program. """
+        n = self.main_length
+        mult = np.zeros(len(self), dtype=np.int64)
+        mult[:n] = 1
+        for start, end in self._loop_ends().items():
+            mult[start:end + 1] *= self.inst_data[start]
+        # Subroutines are executed once for every execution of a call
+        for addr in np.flatnonzero(self.opcode[:n] == Inst.JSR):
+            start = self.inst_data[addr]
+            mult[start:self._sub_end(start) + 1] += mult[addr]
+        return mult
+
+    def trace(self):
+        """ Addresses of the instructions in the order they are executed
+        during one pass through the program, with loops unrolled. """
+        loop_ends = self._loop_ends()
+        def expand(lo, hi):
+            parts = []
+            addr = lo
+            while addr < hi:
+                if self.opcode[addr] == Inst.LOOP:
+                    end = loop_ends[addr]
+                    body = np.concatenate([[addr], expand(addr + 1, end), [end]])
+                    parts.append(np.tile(body, self.inst_data[addr]))
+                    addr = end + 1
+                elif self.opcode[addr] == Inst.JSR:
+                    start = self.inst_data[addr]
+                    parts.append([addr])
+                    parts.append(np.arange(start, self._sub_end(start) + 1))
+                    addr += 1
+                else:
+                    parts.append([addr])
+                    addr += 1
+            return np.concatenate(parts).astype(int) if parts else np.zeros(0, dtype=int)
+        return expand(0, self.main_length)
+
+    @property
+    def nbytes(self):
+        return sum(arr.nbytes for arr in self._fields())
+
+    def save(self, fname):
+        """ Save the program to a `.npz` file, which can be read
+        again with `CompiledProgram.load()`. """
+        names = sorted(self.bit_names)
+        steps = {}
+        if self.step_starts is not None:
+            steps["step_starts"] = self.step_starts
+            steps["step_lengths"] = self.step_lengths
+            steps.update({"axis_" + k: v for k, v in self.axes.items()})
+        np.savez(fname, flags=self.flags, opcode=self.opcode,
+            inst_data=self.inst_data, length=self.length, used_flags=self.used_flags,
+            bit_nums=np.array(names, dtype=int),
+            bit_names=np.array([self.bit_names[k] for k in names], dtype=str), **steps)
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as data:
+            bit_names = dict(zip(data["bit_nums"].tolist(), data["bit_names"].tolist()))
+            prog = cls(data["flags"], data["opcode"], data["inst_data"], data["length"],
+                bit_names=bit_names, used_flags=data["used_flags"])
+            if "step_starts" in data:
+                prog.step_starts = data["step_starts"]
+                prog.step_lengths = data["step_lengths"]
+                prog.axes = {k[5:]: data[k] for k in data.files if k.startswith("axis_")}
+            return prog
+
+    def frames(self):
+        """ Return the duration and flag word of each instruction, in the
+        order the board executes them. """
+        order = self.trace()
+        return self.length[order], self.flags[order]
+
+    def save_txt(self, fname):
+        """ Save frames as a text file, in the same format as `RawSequence.save_txt()`. """
+        t_ax, words = self.frames()
+        frames = (words[:, None] >> self.used_flags.astype(np.uint32)) & 1
+        full = np.concatenate([t_ax.reshape(-1, 1), frames], axis=1)
+        header = ",".join(["dt", *[str(x) for x in self.used_flags]])
+        np.savetxt(fname, full, fmt="%d", delimiter=",", header=header, comments="")
+
+    def plot_sequence(self):
+        import matplotlib.pyplot as plt # Slow to import, only needed here
+        t_ax, words = self.frames()
+        flag_nums = self.used_flags
+        frames = (words[:, None] >> flag_nums.astype(np.uint32)) & 1
+        # Turn time axis into one we can plot, starting with a t=0 frame
+        t_ax = np.concatenate([[0], t_ax.cumsum()])
+        frames = np.concatenate([frames[[0]], frames[:]], axis=0)
+        # Vertically separate each flag to make it look better
+        plot_shifts = np.arange(len(flag_nums)) * 1.1
+        plt.plot(t_ax, frames + plot_shifts, drawstyle='steps-pre')
+        plt.legend([self.bit_names.get(i, str(i)) for i in flag_nums])
+        plt.show()
+
+    # The methods below let a compiled program be used in place of
+    # a pulse sequence, eg by `PulseManager`.
+
+    def set_controller(self, controller):
+        self._controller = controller
+
+    @property
+    def controller(self):
+        return self._controller
+
+    def program_seq(self, end_action=None):
+        """ Program the board with this instruction table. The end action
+        is fixed when compiling, so `end_action` must be `None`. """
+        if end_action is not None:
+            raise ValueError("The end action of a compiled program can not be changed.")
+        if self._controller is None:
+            raise Exception("Controller for this program has not yet been set.")
+        self._controller.program(self)
+        return 0
+
+    def start(self):
+        self._controller.run()
+
+    def stop(self):
+        self._controller.stop()
+
+
+def _frozen(arr, dtype):
+    arr = np.array(arr, dtype=dtype)
+    arr.flags.writeable = False
+    return arr
+
+
+class Frames:
+    def __init__(self, t_ax, words):
+        """ A block of consecutive frames, as returned by `merge_flag_words`.
+        Adjacent frames with the same flag word are joined into one. """
+        t_ax = np.asarray(t_ax)
+        words = np.asarray(words, dtype=np.uint32)
+        if len(words) > 1:
+            keep = np.append(True, words[1:] != words[:-1])
+            if not keep.all():
+                t_ax = np.add.reduceat(t_ax, np.flatnonzero(keep))
+                words = words[keep]
+        self.t_ax = t_ax
+        self.words = words
+        self._digest = None
+
+    def __len__(self):
+        return len(self.words)
+
+    def __add__(self, other):
+        return Frames(np.concatenate([self.t_ax, other.t_ax]),
+            np.concatenate([self.words, other.words]))
+
+    def digest(self):
+        """ Hex digest of the frames, blocks with the same content have the same digest. """
+        if self._digest is None:
+            h = hashlib.sha1(self.t_ax.astype(np.float64).tobytes())
+            h.update(self.words.tobytes())
+            self._digest = h.hexdigest()
+        return self._digest
+
+
+class Loop:
+    def __init__(self, body, count):
+        """ A list of blocks (`Frames`, `Loop` or `Call`) repeated `count` times. """
+        self.body = list(body)
+        self.count = int(count)
+
+
+class Call:
+    def __init__(self, frames:Frames):
+        """ A block of frames which is programmed once as a subroutine.
+        The first frame is output by the JSR instruction at each call,
+        the rest are in the subroutine, ending with an RTS instruction. """
+        self.frames = frames
+        self.key = frames.digest()
+
+    def __len__(self):
+        return 1
+
+
+def link(items, end_action=None, loops=True, subroutines=False, **kwargs):
+    """ Lay out a list of `Frames` and `Loop` blocks as a `CompiledProgram`.
+
+    If `loops=True` (default), loops become LOOP/END_LOOP instruction pairs,
+    nested at most `MAX_LOOP_DEPTH` deep, with deeper loops being unrolled.
+    Otherwise all loops are unrolled.
+
+    If `subroutines=True` (default `False`), blocks of frames which appear
+    more than once are programmed once, as a subroutine, and called with JSR
+    instructions. The number of instructions saved (compared to programming
+    every block in place) is stored in the `saved_instructions` attribute
+    of the program.
+
+    The last instruction performs `end_action`, which must be a `Branch`
+    action or `None` to branch back to the first instruction.
+
+    Extra keyword arguments are passed to `CompiledProgram`.
+    """
+    if end_action is None:
+        end_action = actions.Branch(0)
+    elif end_action.inst != Inst.BRANCH:
+        raise Exception("End action is:", type(end_action), end_action.inst)
+    if subroutines:
+        items = _make_calls(items)
+    items = _normalise(items, max_depth=MAX_LOOP_DEPTH if loops else 0)
+    if not items:
+        raise ValueError("Can not compile an empty sequence.")
+    # The last instruction is needed for the end action
+    if isinstance(items[-1], Loop):
+        items = _join(items[:-1] + _peel(items[-1], last=True))
+    if isinstance(items[-1], Call):
+        items = _join(items[:-1] + [items[-1].frames])
+    if subroutines:
+        # Subroutines which are only called once are not worth keeping
+        counts = {}
+        _count_calls(items, counts)
+        items = _inline_calls(items, {k for k, n in counts.items() if n < 2})
+
+    t_chunks, w_chunks, patches, calls = [], [], [], []
+    n = _emit(items, t_chunks, w_chunks, patches, calls, 0)
+    patches.append((n - 1, end_action.inst, end_action.data))
+    # Subroutines go after the end of the main program
+    sub_addrs = {}
+    saved = 0
+    for addr, call in calls:
+        if call.key not in sub_addrs:
+            sub_addrs[call.key] = n
+            t_chunks.append(call.frames.t_ax[1:])
+            w_chunks.append(call.frames.words[1:])
+            n += len(call.frames) - 1
+            patches.append((n - 1, Inst.RTS, 0))
+            saved -= len(call.frames) - 1
+        saved += len(call.frames) - 1
+        patches.append((addr, Inst.JSR, sub_addrs[call.key]))
+
+    opcode = np.full(n, Inst.CONTINUE, dtype=np.int32)
+    inst_data = np.zeros(n, dtype=np.int32)
+    for addr, inst, data in patches:
+        opcode[addr] = inst
+        inst_data[addr] = data
+    prog = CompiledProgram(np.concatenate(w_chunks), opcode, inst_data,
+        np.concatenate(t_chunks), **kwargs)
+    prog.saved_instructions = saved
+    return prog
+
+
+def duration(items):
+    """ Total duration of a list of blocks, in nanoseconds. """
+    total = 0
+    for item in items:
+        if isinstance(item, Loop):
+            total += max(item.count, 0) * duration(item.body)
+        elif isinstance(item, Call):
+            total += item.frames.t_ax.sum()
+        else:
+            total += item.t_ax.sum()
+    return total
+
+
+def _emit(items, t_chunks, w_chunks, patches, calls, addr):
+    for item in items:
+        if isinstance(item, Loop):
+            start = addr
+            addr = _emit(item.body, t_chunks, w_chunks, patches, calls, addr)
+            patches.append((start, Inst.LOOP, item.count))
+            patches.append((addr - 1, Inst.END_LOOP, start))
+        elif isinstance(item, Call):
+            t_chunks.append(item.frames.t_ax[:1])
+            w_chunks.append(item.frames.words[:1])
+            calls.append((addr, item))
+            addr += 1
+        else:
+            t_chunks.append(item.t_ax)
+            w_chunks.append(item.words)
+            addr += len(item)
+    return addr
+
+
+def _join(items):
+    """ Join adjacent `Frames` blocks. """
+    out = []
+    for item in items:
+        if out and isinstance(item, Frames) and isinstance(out[-1], Frames):
+            out[-1] = out[-1] + item
+        elif not isinstance(item, Frames) or len(item):
+            out.append(item)
+    return out
+
+
+def _make_calls(items):
+    """ Replace blocks of frames which appear more than once with `Call`s. """
+    # Count the most times each block could be programmed, ie as if all loops
+    # were unrolled. Calls which end up being used once are inlined by `link()`.
+    counts = {}
+    def count(items, mult=1):
+        for item in items:
+            if isinstance(item, Loop):
+                count(item.body, mult * max(item.count, 0))
+            elif len(item) > 1 and mult:
+                counts[item.digest()] = counts.get(item.digest(), 0) + mult
+    def replace(items):
+        out = []
+        for item in items:
+            if isinstance(item, Loop):
+                out.append(Loop(replace(item.body), item.count))
+            elif len(item) > 1 and counts.get(item.digest(), 0) > 1:
+                out.append(Call(item))
+            else:
+                out.append(item)
+        return out
+    count(items)
+    return replace(items)
+
+
+def _count_calls(items, counts):
+    for item in items:
+        if isinstance(item, Loop):
+            _count_calls(item.body, counts)
+        elif isinstance(item, Call):
+            counts[item.key] = counts.get(item.key, 0) + 1
+
+
+def _inline_calls(items, keys):
+    """ Replace `Call`s to the subroutines in `keys` with their frames. """
+    out = []
+    for item in items:
+        if isinstance(item, Loop):
+            out.append(Loop(_inline_calls(item.body, keys), item.count))
+        elif isinstance(item, Call) and item.key in keys:
+            out.append(item.frames)
+        else:
+            out.append(item)
+    return _join(out)
+
+
+def _normalise(items, depth=0, max_depth=MAX_LOOP_DEPTH):
+    """ Rewrite blocks so that every loop can be programmed as a LOOP/END_LOOP pair. """
+    out = []
+    for item in items:
+        if isinstance(item, Loop):
+            out.extend(_normalise_loop(item, depth, max_depth))
+        else:
+            out.append(item)
+    return _join(out)
+
+
+def _normalise_loop(loop, depth, max_depth):
+    body = _normalise(loop.body, depth + 1, max_depth)
+    count = loop.count
+    if count <= 0 or not body:
+        return []
+    if count == 1:
+        return body
+    if len(body) == 1 and isinstance(body[0], Frames) and len(body[0]) == 1:
+        # Repeating a single frame is the same as one longer frame
+        return [Frames(body[0].t_ax * count, body[0].words)]
+    if depth >= max_depth:
+        return _join(body * count)
+    # The LOOP and END_LOOP instructions can not also start or end an
+    # inner loop or a subroutine call, so take an iteration out of any
+    # loop at the edges of the body, and don't use calls there.
+    if isinstance(body[0], Call):
+        body = [body[0].frames] + body[1:]
+    if isinstance(body[-1], Call):
+        body = body[:-1] + [body[-1].frames]
+    if len(body) == 1 and isinstance(body[0], Loop):
+        inner = body[0]
+        middle = [Loop(inner.body, inner.count - 2)] if inner.count > 3 else inner.body * (inner.count - 2)
+        body = inner.body + middle + inner.body
+    else:
+        if isinstance(body[0], Loop):
+            body = _peel(body[0], last=False) + body[1:]
+        if isinstance(body[-1], Loop):
+            body = body[:-1] + _peel(body[-1], last=True)
+    body = _join(body)
+    loops = [Loop(body, MAX_LOOP_COUNT) for _ in range(count // MAX_LOOP_COUNT)]
+    remainder = count % MAX_LOOP_COUNT
+    if remainder == 1:
+        return _join(loops + body)
+    if remainder:
+        loops.append(Loop(body, remainder))
+    return loops
+
+
+def _peel(loop, last):
+    """ Split the first (or last) iteration from a normalised loop. """
+    rest = [Loop(loop.body, loop.count - 1)] if loop.count > 2 else loop.body
+    return rest + loop.body if last else loop.body + rest
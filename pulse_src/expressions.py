@@ -0,0 +1,291 @@
+""" Time expressions used in pulse sequences, eg:
+
+    pi_h+tau
+    tau+pi+tau+tau+pi+tau
+    2*(tau+pi) - 10ns
+
+An expression may contain parameter names, numbers (nanoseconds unless a
+unit of time is given), `+`, `-`, `*`, `/` and parentheses. It is parsed
+once into a small tree and then reduced to a `Linear` form, a constant plus
+a multiple of each parameter, which is all that is needed to evaluate it:
+
+    >>> expr = linear("2*(tau+pi) - 10ns")
+    >>> expr.const, expr.terms
+    (-10, {'tau': 2, 'pi': 2})
+    >>> expr(tau=100, pi=80)
+    350
+
+Products and quotients must have a constant on at least one side (a
+constant divisor), so every expression stays linear in its parameters.
+"""
+import re
+from fractions import Fraction
+from functools import lru_cache
+
+from .units import unit_ns
+
+_TOKEN_RE = re.compile(r"""
+    \s*(?:
+        (?P<num>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)(?P<unit>[a-zA-Zµ]+)?
+        | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+        | (?P<op>[-+*/()])
+    )""", re.VERBOSE)
+
+_NAME_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*\Z")
+
+
+class ExpressionError(ValueError):
+    def __init__(self, text, pos, msg):
+        self.text = text
+        self.pos = pos
+        super().__init__("%s at column %d of '%s'" % (msg, pos + 1, text))
+
+
+# Expression tree
+class Num:
+    def __init__(self, value):
+        self.value = value
+
+class Name:
+    def __init__(self, name):
+        self.name = name
+
+class Neg:
+    def __init__(self, arg):
+        self.arg = arg
+
+class BinOp:
+    def __init__(self, op, left, right, pos):
+        self.op = op
+        self.left = left
+        self.right = right
+        self.pos = pos
+
+
+def tokenize(text):
+    """ Split `text` into a list of `(kind, value, column)` tokens, `kind`
+    being "num", "name" or "op". Numbers are converted to nanoseconds. """
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = _TOKEN_RE.match(text, pos)
+        if m is None or m.end() == pos:
+            raise ExpressionError(text, pos, "Unexpected character '%s'" % text[pos])
+        start = m.start(m.lastgroup if m.lastgroup != "unit" else "num")
+        if m.group("num") is not None:
+            num = m.group("num")
+            value = Fraction(num) if any(c in num for c in ".eE") else int(num)
+            unit = m.group("unit")
+            if unit is not None:
+                try:
+                    value = value * unit_ns(unit)
+                except ValueError:
+                    raise ExpressionError(text, m.start("unit"), "Unknown unit '%s'" % unit) from None
+            tokens.append(("num", value, start))
+        elif m.group("name") is not None:
+            tokens.append(("name", m.group("name"), start))
+        else:
+            tokens.append(("op", m.group("op"), start))
+        pos = m.end()
+    return tokens
+
+
+class _Parser:
+    """ Recursive descent parser for
+
+        sum     := product (("+" | "-") product)*
+        product := unary (("*" | "/") unary)*
+        unary   := "-" unary | atom
+        atom    := number | name | "(" sum ")"
+    """
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.i = 0
+
+    def peek(self):
+        if self.i < len(self.tokens):
+            return self.tokens[self.i]
+        return (None, None, len(self.text))
+
+    def next(self):
+        tok = self.peek()
+        self.i += 1
+        return tok
+
+    def parse(self):
+        if not self.tokens:
+            raise ExpressionError(self.text, 0, "Empty expression")
+        tree = self.sum()
+        kind, value, pos = self.peek()
+        if kind is not None:
+            raise ExpressionError(self.text, pos, "Unexpected '%s'" % value)
+        return tree
+
+    def sum(self):
+        tree = self.product()
+        while self.peek()[1] in ("+", "-") and self.peek()[0] == "op":
+            _, op, pos = self.next()
+            tree = BinOp(op, tree, self.product(), pos)
+        return tree
+
+    def product(self):
+        tree = self.unary()
+        while self.peek()[1] in ("*", "/") and self.peek()[0] == "op":
+            _, op, pos = self.next()
+            tree = BinOp(op, tree, self.unary(), pos)
+        return tree
+
+    def unary(self):
+        if self.peek()[:2] == ("op", "-"):
+            self.next()
+            return Neg(self.unary())
+        return self.atom()
+
+    def atom(self):
+        kind, value, pos = self.next()
+        if kind == "num":
+            return Num(value)
+        if kind == "name":
+            return Name(value)
+        if value == "(":
+            tree = self.sum()
+            kind, value, pos = self.next()
+            if value != ")":
+                raise ExpressionError(self.text, pos, "Expected ')'")
+            return tree
+        if kind is None:
+            raise ExpressionError(self.text, pos, "Unexpected end of expression")
+        raise ExpressionError(self.text, pos, "Unexpected '%s'" % value)
+
+
+def parse(text):
+    """ Parse `text` into an expression tree. """
+    return _Parser(text).parse()
+
+
+def _simplify(value):
+    """ Fractions with a denominator of 1 become ints. """
+    if isinstance(value, Fraction) and value.denominator == 1:
+        return value.numerator
+    return value
+
+
+class Linear:
+    """ An expression reduced to `const + sum(coef * params[name])`, with
+    `terms` mapping each parameter name to its coefficient. """
+    __slots__ = ("const", "terms")
+
+    def __init__(self, const=0, terms=None):
+        self.const = _simplify(const)
+        self.terms = {k:_simplify(v) for k, v in (terms or {}).items() if v != 0}
+
+    def __repr__(self):
+        return "Linear(%r)" % str(self)
+
+    def __str__(self):
+        parts = []
+        for name, coef in self.terms.items():
+            parts.append(name if coef == 1 else "%s*%s" % (_format(coef), name))
+        if self.const or not parts:
+            parts.append(_format(self.const))
+        return "+".join(parts).replace("+-", "-")
+
+    def __eq__(self, other):
+        return isinstance(other, Linear) and (self.const, self.terms) == (other.const, other.terms)
+
+    def __hash__(self):
+        return hash((self.const, tuple(sorted(self.terms.items()))))
+
+    @property
+    def symbols(self):
+        """ Names of the parameters used. """
+        return set(self.terms)
+
+    @property
+    def is_const(self):
+        return not self.terms
+
+    def __call__(self, **params):
+        """ Value of the expression, every parameter used must be given. """
+        value = self.const
+        for name, coef in self.terms.items():
+            value = value + coef * params[name]
+        return _simplify(value)
+
+    def substitute(self, **params):
+        """ A new `Linear` with the given parameters replaced by their values. """
+        const = self.const
+        terms = {}
+        for name, coef in self.terms.items():
+            if name in params:
+                const = const + coef * params[name]
+            else:
+                terms[name] = coef
+        return Linear(const, terms)
+
+    # Arithmetic used while reducing a tree
+    def __add__(self, other):
+        terms = dict(self.terms)
+        for name, coef in other.terms.items():
+            terms[name] = terms.get(name, 0) + coef
+        return Linear(self.const + other.const, terms)
+
+    def scale(self, factor):
+        return Linear(self.const * factor, {k:v * factor for k, v in self.terms.items()})
+
+
+def _format(value):
+    if isinstance(value, Fraction):
+        return repr(float(value))
+    return str(value)
+
+
+def reduce(tree, text=""):
+    """ Reduce an expression tree to its `Linear` form. """
+    if isinstance(tree, Num):
+        return Linear(tree.value)
+    if isinstance(tree, Name):
+        return Linear(0, {tree.name: 1})
+    if isinstance(tree, Neg):
+        return reduce(tree.arg, text).scale(-1)
+    left = reduce(tree.left, text)
+    right = reduce(tree.right, text)
+    if tree.op == "+":
+        return left + right
+    if tree.op == "-":
+        return left + right.scale(-1)
+    if tree.op == "*":
+        if left.is_const:
+            return right.scale(left.const)
+        if right.is_const:
+            return left.scale(right.const)
+        raise ExpressionError(text, tree.pos, "Parameters can only be multiplied by constants")
+    # Division
+    if not right.is_const:
+        raise ExpressionError(text, tree.pos, "Can only divide by a constant")
+    if right.const == 0:
+        raise ExpressionError(text, tree.pos, "Division by zero")
+    return left.scale(Fraction(1) / right.const)
+
+
+@lru_cache(maxsize=4096)
+def linear(text) -> Linear:
+    """ Parse and reduce the expression `text`. The result is cached, and
+    must not be modified. """
+    if _NAME_RE.match(text):
+        # Plain parameter name, by far the most common
+        return Linear(0, {text: 1})
+    return reduce(parse(text), text)
+
+
+def symbols(text):
+    """ Names of the parameters used in the expression `text`. """
+    return linear(text).symbols
+
+
+if __name__ == "__main__":
+    for text in ["tau", "pi_h+tau", "tau+pi+tau+tau+pi+tau", "2*(tau + pi) - 10ns", "1.5us/2 + pi/4"]:
+        expr = linear(text)
+        print("%-24s -> %-20s = %s" % (text, expr, expr(tau=100, pi=80, pi_h=40)))
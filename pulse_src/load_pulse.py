@@ -1,11 +1,40 @@
 from os import read
 from .structured_seq import parse_complex_structure
 import numpy as np
-from astropy import units as u
 import re
 
 from . import pulse_utils as pu
 from . import _actions as actions
+from . import expressions
+from .units import parse_time_ns
+
+# Tokens of a sequence line, after the bit number
+_SEQ_TOKEN_RE = re.compile(r"""
+      (?P<space>[\s,]+)
+    | (?P<sep>\|)
+    | (?P<num>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?[a-zA-Zµ]*)
+    | (?P<name>[A-Za-z_]\w*)
+    | (?P<op>[-+*/])
+    | (?P<open>\()
+    | (?P<close>\))
+    | (?P<bad>.)
+""", re.VERBOSE)
+_BIT_RE = re.compile(r"\s*(\d+)\s*(?:\((.*)\))?\s*:")
+
+
+class PulseFileError(ValueError):
+    """ A problem in a pulse file, with the line and column where it is. """
+    def __init__(self, msg, filename="<string>", line=None, col=None):
+        self.filename = filename
+        self.line = line
+        self.col = col
+        where = filename
+        if line is not None:
+            where += ":%d" % line
+            if col is not None:
+                where += ":%d" % col
+        super().__init__("%s: %s" % (where, msg))
+
 
 def ignore_comments(line:str):
     # Ignore any characters after a '#'
@@ -16,100 +45,130 @@ def ignore_comments(line:str):
     else:
         return line[:end]
 
-def read_pulse_file(filename):
-    """ Read data from a file and create a pulse object. """
-    f = open(filename, 'r')
-    lines = f.readlines()
-    f.close()
-    # sections = {k:None for k in ["PARAMS", "SEQ", "STRUCT"]}
-    # pu.AbstractSequence(None)
-
-    found_symbols = {}
-    # Get the parameter values
-    for line in lines:
-        line = ignore_comments(line)
-        if not line: continue
-        if "!" in line: break
-        if "=" in line: continue
-        sym, value = line.split(":")
-        sym, value = sym.strip(), value.strip()
-        if sym not in found_symbols:
-            print(f"Found symbol: {sym}")
-            if "." not in value:
-                dtype = int
-            else:
-                dtype = float
-            found_symbols[sym] = u.Quantity(value, dtype=dtype)
 
-    pulses = []
+def _sequence_words(text):
+    """ Split the sequences part of a line into words, yielding `(word,
+    column)` and `("|", column)` between sequences. Expressions are joined
+    into one word, without spaces, eg "tau + pi" -> "tau+pi". Columns are
+    0-based from the start of `text`. """
+    word = []
+    start = None
+    # Expecting the next operand of an expression, or a closing bracket
+    open_ops = 0
+    depth = 0
+    for m in _SEQ_TOKEN_RE.finditer(text):
+        kind = m.lastgroup
+        if kind == "space":
+            continue
+        if kind == "bad":
+            raise PulseFileError("Unexpected character '%s'" % m.group(), col=m.start())
+        if kind == "sep" or (kind in ("num", "name", "open") and word
+                and not open_ops and not depth):
+            # Anything but an operator or bracket after a complete word starts a new one
+            if word:
+                yield "".join(word), start
+                word = []
+            if kind == "sep":
+                yield "|", m.start()
+                continue
+        if not word:
+            start = m.start()
+        word.append(m.group())
+        if kind == "op":
+            open_ops = 1
+        elif kind == "open":
+            depth += 1
+            open_ops = 0
+        elif kind == "close":
+            depth -= 1
+        else:
+            open_ops = 0
+    if word:
+        yield "".join(word), start
 
 
-    # Go through each line
-    in_params_block = True
+def parse_pulse_lines(lines, filename="<string>"):
+    """ Create a pulse object from the lines of a pulse file, see
+    `read_pulse_file()`. `lines` can be any iterable of strings, and is only
+    read once, up to the end of the structure. """
+    found_symbols = {}
+    pulses = []
     structure = None
-    for ln, line in enumerate(lines):
+    section = "params"
+    for ln, line in enumerate(lines, 1):
         line = ignore_comments(line)
-        if not line: continue
-        if in_params_block:
-            if "!" in line:
-                in_params_block = False
-            continue
+        if section == "structure":
+            if not line.strip(): continue
+            structure = line.strip()
+            print("Found structure: ", structure)
+            break
         if "!" in line:
-            # When we find the second ! we are entering the structure or 
+            if section == "params":
+                section = "sequence"
+                continue
+            # When we find the second ! we are entering the structure or
             # comments section, either way we are done reading the sequence
             if "structure" in line.lower():
-                structure = lines[ln+1]
-                structure = structure.replace("\n", "")
-                print("Found structure: ", structure)
+                section = "structure"
+                continue
             break
+        if not line.strip(): continue
+
+        if section == "params":
+            if "=" in line: continue
+            sym, sep, value = line.partition(":")
+            sym, value = sym.strip(), value.strip()
+            if not sep or not sym:
+                raise PulseFileError("Expected 'name : value'", filename, ln)
+            if sym not in found_symbols:
+                print(f"Found symbol: {sym}")
+                try:
+                    found_symbols[sym] = parse_time_ns(value)
+                except ValueError as e:
+                    raise PulseFileError(str(e), filename, ln, line.index(value) + 1) from None
+            continue
+
         # After this point we know we are in the sequence part of the file
-        bit, seq = line.split(":")
-        if "(" in bit and ")" in bit:
-            try:
-                bit, bit_name = re.split("\((.*)\)", bit)[:2]
-            except Exception as e:
-                print("Unable to read bit name of bit %s" % bit)
-                print("Can't continue, actual bit value can not be determined.")
-                raise e
-            else:
-                print("Read bit name of bit %s as %s" % (bit, bit_name))
-        else:
-            bit_name = None
-        bit = int(bit)
-        seq = seq.replace(",", " ")
-        seq = seq.replace("+", " 0 ")
-        seq = seq.split()
+        m = _BIT_RE.match(line)
+        if m is None:
+            raise PulseFileError("Expected 'bit : sequences' or 'bit (name) : sequences'",
+                filename, ln, 1)
+        bit, bit_name = int(m.group(1)), m.group(2)
+        if bit_name is not None:
+            print("Read bit name of bit %s as %s" % (bit, bit_name))
         # Begin with the first sequence, increase after each '|' character
-        seq_num = 0
         seq_all = [[]]
-        for i, word in enumerate(seq):
-            if seq_num >= len(seq_all):
-                # Create a new sequence list if there isn't already enough
-                seq_all.append(list())
-            try:
-                if word == '|':
+        try:
+            for word, col in _sequence_words(line[m.end():]):
+                if word == "|":
                     # Move onto the next sequence
-                    seq_num += 1
+                    seq_all.append([])
                     continue
-                if "." not in word:
-                    dtype = int
-                else:
-                    dtype = float
-                val = u.Quantity(word, dtype=dtype)
-                if str(val.unit) == '':
-                    val *= u.ns
-            except (ValueError, TypeError):
-                # Try keep it as a symbol
-                val = word
-                if val not in found_symbols:
-                    print(f"Found symbol: {val}")
-                    found_symbols[val] = None
-            else:
-                val = round(val.to("ns").value) # Convert to value in nanoseconds
-            finally:
-                if word != "|":
-                    seq_all[seq_num].append(val)
-        while seq_num >= len(pulses):
+                val = None
+                if word[0] in "0123456789.":
+                    try:
+                        val = parse_time_ns(word)
+                    except ValueError:
+                        pass
+                if val is None:
+                    # Try keep it as a symbol or an expression of symbols
+                    try:
+                        expr = expressions.linear(word)
+                    except expressions.ExpressionError as e:
+                        raise PulseFileError(str(e), col=col + e.pos) from None
+                    if expr.is_const:
+                        val = round(expr.const)
+                    else:
+                        val = word
+                    for sym in expr.symbols:
+                        if sym not in found_symbols:
+                            print(f"Found symbol: {sym}")
+                            found_symbols[sym] = None
+                seq_all[-1].append(val)
+        except PulseFileError as e:
+            raise PulseFileError(str(e).partition(": ")[2], filename, ln,
+                m.end() + e.col + 1) from None
+        while len(seq_all) > len(pulses):
             new_pulse = pu.AbstractSequence(None)
             new_pulse.set_param_default(**found_symbols)
             pulses.append(new_pulse)
@@ -117,13 +176,24 @@ def read_pulse_file(filename):
             pulse.add_seq([bit], [seq])
             if bit_name is not None:
                 pulse.bit_names[bit] = bit_name
+    if not pulses:
+        raise PulseFileError("No sequences found", filename)
     if len(pulses) == 1:
-        return pulse
+        return pulses[0]
     else:
         struct_pulse = parse_complex_structure(pulses, structure)
         return struct_pulse
 
 
+def read_pulse_file(filename):
+    """ Read data from a file and create a pulse object.
+
+    The file is read in a single pass, line by line. Problems in the file
+    raise a `PulseFileError` giving the line and column. """
+    with open(filename, 'r') as f:
+        return parse_pulse_lines(f, filename)
+
+
 if __name__ == "__main__":
     # p = read_pulse_file("pulses/Ramsey.pls")
     # p.set_controller(pu.SequenceProgram())
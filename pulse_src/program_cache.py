@@ -0,0 +1,227 @@
+""" In-process cache of pulse files and the programs compiled from them.
+
+Programs are keyed by the content of the pulse file and the resolved
+parameter values, so a cache hit skips reading, evaluating and merging
+the sequence entirely:
+    >>> prog = CACHE.compile_file("pulses/IR_ON.pls", tau=100)
+    >>> prog.program_seq()
+
+Entries are evicted least recently used first once the cached programs
+take up more than `max_bytes`.
+
+The cache may be used from any thread (the Tk, board and compute threads
+all use `CACHE`). Two threads which miss on the same key may both compile
+it, the last to finish being kept.
+
+Parsed pulse files are also saved in a sidecar folder (`CACHE_DIR`) next to
+the files, so they don't need parsing again after a restart. A sidecar is
+only used while the contents of its pulse file are unchanged.
+"""
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from . import load_pulse
+from .compiler import CompiledProgram
+
+MAX_BYTES = 64 * 2**20  # Default memory budget, bytes
+CACHE_DIR = ".pulse_cache"  # Sidecar folder, made in the folder of each pulse file. None to disable
+DISK_VERSION = 2    # Increase when the saved pulse objects change, to ignore old sidecars
+
+
+def file_digest(filename):
+    """ SHA1 hex digest of the contents of `filename`. """
+    with open(filename, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _params_key(params):
+    return tuple(sorted(
+        (k, None if v is None else tuple(np.ravel(v).tolist())) for k, v in params.items()
+    ))
+
+
+def _end_key(end_action):
+    if end_action is None:
+        return None
+    return (end_action.inst, end_action.data)
+
+
+class ProgramCache:
+    def __init__(self, max_bytes=MAX_BYTES, cache_dir=CACHE_DIR):
+        """ Cache of parsed pulse files and compiled programs, using at most
+        `max_bytes` of memory. Parsed files are also kept on disk in
+        `cache_dir`, unless it is None. """
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._entries = OrderedDict()   # key -> (value, size in bytes)
+        self._nbytes = 0
+        self._stats = {}    # path -> (mtime, size, digest)
+        # Held to use the entries or stats, not while reading or compiling
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "ProgramCache(%d entries, %d / %d bytes, %d hits, %d misses, %d from disk)" % (
+            len(self._entries), self._nbytes, self.max_bytes, self.hits, self.misses, self.disk_hits)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self):
+        """ Memory used by the cached entries, in bytes. """
+        return self._nbytes
+
+    def clear(self):
+        """ Empty the in memory cache, sidecar files are left as they are. """
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+            self._stats.clear()
+
+    def _get(self, key, count=True):
+        with self._lock:
+            try:
+                value, _ = self._entries[key]
+            except KeyError:
+                if count:
+                    self.misses += 1
+                return None
+            if count:
+                self.hits += 1
+            self._entries.move_to_end(key)
+            return value
+
+    def _put(self, key, value, size):
+        with self._lock:
+            if key in self._entries:
+                self._nbytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                # Would evict everything else and still not fit
+                return
+            self._entries[key] = (value, size)
+            self._nbytes += size
+            while self._nbytes > self.max_bytes:
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self._nbytes -= old_size
+
+    def digest(self, filename):
+        """ `file_digest(filename)`, only reading the file again if its
+        modification time or size have changed. """
+        st = os.stat(filename)
+        path = os.path.abspath(filename)
+        with self._lock:
+            known = self._stats.get(path)
+        if known is not None and known[:2] == (st.st_mtime_ns, st.st_size):
+            return known[2]
+        digest = file_digest(filename)
+        with self._lock:
+            self._stats[path] = (st.st_mtime_ns, st.st_size, digest)
+        return digest
+
+    def sidecar(self, filename):
+        """ Path of the file the parsed `filename` is saved in. """
+        folder, name = os.path.split(os.path.abspath(filename))
+        return os.path.join(folder, self.cache_dir, name + ".pkl")
+
+    def _load_sidecar(self, filename, digest):
+        """ The pickled pulse saved for `filename` and the pulse, or None if
+        there isn't one for `digest` which can still be loaded. """
+        try:
+            with open(self.sidecar(filename), "rb") as f:
+                version, saved_digest, data = pickle.load(f)
+            if version != DISK_VERSION or saved_digest != digest:
+                return None
+            pulse = pickle.loads(data)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print("Ignoring pulse cache for %s: %s" % (filename, e))
+            return None
+        return data, pulse
+
+    def _save_sidecar(self, filename, digest, data):
+        path = self.sidecar(filename)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump((DISK_VERSION, digest, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            print("Unable to save pulse cache %s: %s" % (path, e))
+
+    def _read(self, filename, digest, count=True):
+        key = ("pulse", digest)
+        data = self._get(key, count)
+        if data is not None:
+            return pickle.loads(data)
+        loaded = None
+        if self.cache_dir is not None:
+            loaded = self._load_sidecar(filename, digest)
+        if loaded is not None:
+            self.disk_hits += 1
+            data, pulse = loaded
+        else:
+            pulse = load_pulse.read_pulse_file(filename)
+            # Kept pickled, so every caller gets its own copy to modify
+            data = pickle.dumps(pulse)
+            if self.cache_dir is not None:
+                self._save_sidecar(filename, digest, data)
+        self._put(key, data, len(data))
+        return pulse
+
+    def read_pulse_file(self, filename):
+        """ Like `load_pulse.read_pulse_file()`, but the file is only parsed
+        again if its contents have changed. """
+        return self._read(filename, self.digest(filename))
+
+    def compile_file(self, filename, end_action=None, loops=True, subroutines=False,
+                     **kw_params) -> CompiledProgram:
+        """ Read a pulse file and compile it with the given parameters, see
+        `StructuredSequence.compile()`. Parameters which are not given take
+        their default values from the file.
+
+        The returned program is shared with the cache and other callers. Its
+        instructions can not be modified, but `set_controller()` changes
+        the controller of every caller's program, which is fine while the
+        app has a single controller.
+        """
+        digest = self.digest(filename)
+        pulse = None
+        params_key = _params_key(kw_params)
+        # Resolving the parameters needs the parsed file, so remember them
+        resolved = self._get(("params", digest, params_key), count=False)
+        if resolved is None:
+            pulse = self._read(filename, digest, count=False)
+            resolved = pulse.params.copy()
+            resolved.update(kw_params)
+            resolved = _params_key(resolved)
+            self._put(("params", digest, params_key), resolved, len(repr(resolved)))
+        key = ("program", digest, resolved, loops, subroutines, _end_key(end_action))
+        prog = self._get(key)
+        if prog is None:
+            if pulse is None:
+                pulse = self._read(filename, digest, count=False)
+            prog = pulse.compile(end_action=end_action, loops=loops,
+                subroutines=subroutines, **kw_params)
+            self._put(key, prog, prog.nbytes)
+        return prog
+
+
+CACHE = ProgramCache()
+
+
+if __name__ == "__main__":
+    import time
+    for i in range(3):
+        t0 = time.perf_counter()
+        prog = CACHE.compile_file("pulses/CPMG-2.pls", N=8, M=8)
+        print("%.2f ms" % ((time.perf_counter() - t0) * 1e3), prog)
+    print(CACHE)
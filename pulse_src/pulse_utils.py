@@ -1,12 +1,12 @@
 import threading
 import sys
+from array import array
 
-import matplotlib.pyplot as plt
 import numpy as np
-from astropy import units as u
-from scipy import interpolate
 
 from . import _actions as actions
+from . import expressions
+from .compiler import CompiledProgram
 from .spinapi import *
 
 LOG_PROG = True
@@ -18,6 +18,8 @@ MIN_TIME = 10               # nanoseconds, absolute minimum instruction length,
                             # Instructions shorter than this will raise a ShortPulseException
 LONG_PULSE_DURATION = 10    # nanoseconds, shortest pulse length that does not use the short pulse feature
 SAFE_MODE = False           # Prevent any instructions actually going to the Pulse Blaster
+INCREMENTAL_PROG = False    # Only rewrite the instructions that changed since the last program,
+                            # off until it has been checked on the board
 log_n = 0                   # Log file number
 
 # The top 3 bits control the short pulse feature.
@@ -56,6 +58,56 @@ class ShortPulseException(ProgrammingError):
 class InvalidInstructionError(ProgrammingError):
     def __init__(self, message, inst=None):
         super(InvalidInstructionError, self).__init__(message, inst=inst)
+
+class PreflightReport:
+    """ Instructions found by `SequenceProgram.preflight()` to be too short.
+
+    `extended` and `errors` are arrays of instruction addresses. Extended
+    instructions have been lengthened to `MIN_TIME`, errors can not be
+    programmed as they are. `length` holds the requested lengths.
+    """
+    def __init__(self, flags, length, extended, errors, bit_names=None):
+        self.flags = flags
+        self.length = length
+        self.extended = extended
+        self.errors = errors
+        self.bit_names = bit_names if bit_names else {}
+
+    def __bool__(self):
+        """ True if nothing needed changing. """
+        return not (len(self.extended) or len(self.errors))
+
+    def describe(self, addr):
+        """ Describe the instruction at `addr`, naming the flags that are on. """
+        flags = int(self.flags[addr])
+        names = [self.bit_names.get(bit, str(bit)) for bit in range(21) if flags >> bit & 1]
+        return "%d: %g ns [%s]" % (addr, self.length[addr], ", ".join(names) or "all off")
+
+    def exception(self):
+        """ The exception to raise for the first error, or None. """
+        if not len(self.errors):
+            return None
+        if self.length[self.errors[0]] < LONG_PULSE_DURATION:
+            exc = InvalidInstructionError(
+                "Short pulse feature disabled, minimum pulse length is %d" % LONG_PULSE_DURATION)
+        else:
+            exc = ShortPulseException(pulse_duration=self.length[self.errors[0]])
+        exc.report = self
+        return exc
+
+    def __str__(self):
+        lines = []
+        if len(self.extended):
+            lines.append("Extended %d instructions to %d ns:" % (len(self.extended), MIN_TIME))
+            lines.extend("    " + self.describe(a) for a in self.extended[:10])
+            if len(self.extended) > 10:
+                lines.append("    ...")
+        if len(self.errors):
+            lines.append("%d instructions are too short:" % len(self.errors))
+            lines.extend("    " + self.describe(a) for a in self.errors[:10])
+            if len(self.errors) > 10:
+                lines.append("    ...")
+        return "\n".join(lines)
 # # Configure the core clock
 # pb_core_clock(500)
 
@@ -90,10 +142,13 @@ def init_board():
     pb_core_clock(500)
 
     SequenceProgram.board_initialised = True
+    SequenceProgram.uploaded = None
     
 def check_board_init():
+    """ Initialise the board if it hasn't been yet, so this happens when the
+    board is first used rather than at start up. """
     if not SequenceProgram.board_initialised:
-        raise InvalidBoardAction("The board has not yet been initialised (call 'init_board()')")
+        init_board()
 
 
 class SequenceProgram(threading.Thread):
@@ -101,6 +156,7 @@ class SequenceProgram(threading.Thread):
     running = False
     board_initialised = False
     extend_short_pulses = True
+    uploaded = None # The `CompiledProgram` currently on the board, if known
 
     def __init__(self, name=None):
         threading.Thread.__init__(self)#, group=None)
@@ -108,7 +164,9 @@ class SequenceProgram(threading.Thread):
             name = "Untitled Sequence"
         self.name = name
         self.in_prog = False
-        self.inst_seq = []
+        # Flag words and lengths of the instructions programmed so far
+        self.inst_flags = array('I')
+        self.inst_lengths = array('d')
 
 
     def run(self):
@@ -149,6 +207,11 @@ class SequenceProgram(threading.Thread):
 
         self.in_prog = True
         SequenceProgram.prog_mode = True
+        # The board will no longer hold a known program
+        SequenceProgram.uploaded = None
+        # Programming starts again from the first instruction
+        self.inst_flags = array('I')
+        self.inst_lengths = array('d')
         pb_start_programming(PULSE_PROGRAM)
 
     def stop(self):
@@ -204,7 +267,8 @@ class SequenceProgram(threading.Thread):
                 f"inst_data:  {inst_data}\n"
                 f"length:  {length}\n")
                 # "Message: "+str(e))
-        self.inst_seq.append(inst)
+        self.inst_flags.append(inst[0].value & 0xFFFFFFFF)
+        self.inst_lengths.append(length)
         if log is not None:
             try:
                 log.write(f"[{flags:08b}] inst: {inst[1].value} inst_data: {inst[2].value} dt: {int(inst[3])} \n")
@@ -216,6 +280,153 @@ class SequenceProgram(threading.Thread):
         else:
             return 0
 
+    def preflight(self, flags, length, bit_names=None):
+        """ Check a block of instructions before programming any of them.
+
+        Applies the same rules as `add_instruction()` to the whole block at
+        once: instructions shorter than `MIN_TIME` are extended (if
+        `extend_short_pulses` is set), and the short pulse bits are set on
+        the flags. The board is not touched.
+
+        Returns `(flags, length, report)` where `flags` and `length` are new
+        arrays ready to be programmed and `report` is a `PreflightReport`
+        listing every instruction that was extended or can not be programmed,
+        using `bit_names` to name the flags.
+        """
+        flags = np.array(flags, dtype=np.int64).ravel()
+        length = np.array(length, dtype=np.float64).ravel()
+        if len(flags) != len(length):
+            raise InvalidInstructionError("Instruction arrays have different lengths: "
+                f"{len(flags)}, {len(length)}")
+        requested = length.copy()
+        extended = np.flatnonzero(length < MIN_TIME) if self.extend_short_pulses else np.array([], dtype=int)
+        length[extended] = MIN_TIME
+        short_pulse = length < LONG_PULSE_DURATION
+        bad = ~short_pulse & (length < MIN_TIME)
+        if not SHORT_PULSE_ALLOWED:
+            bad |= short_pulse
+        errors = np.flatnonzero(bad)
+        flags[~short_pulse] |= LONG_PULSE_BITS
+        if SHORT_PULSE_ALLOWED:
+            flags[short_pulse] |= (length[short_pulse] // PB_CLOCK_PERIOD).astype(np.int64) << 21
+        report = PreflightReport(flags, requested, extended, errors, bit_names=bit_names)
+        return flags, length, report
+
+    def add_instructions(self, flags, inst, inst_data, length, log=None):
+        """ Add a block of instructions, given as arrays of equal length.
+
+        The block is checked with `preflight()` before anything is sent to
+        the board, then the instructions are added in a single pass.
+        Lengths must be in nanoseconds.
+
+        Returns a list of the values returned when adding each instruction.
+        """
+        check_board_init()
+        flags, length, report = self.preflight(flags, length)
+        if not report:
+            print(report)
+        if len(report.errors):
+            raise report.exception()
+        return self._add_checked(flags, inst, inst_data, length, log=log)
+
+    def _add_checked(self, flags, inst, inst_data, length, log=None):
+        """ `add_instructions()` for `flags` and `length` which have already
+        been through `preflight()`. """
+        inst = np.asarray(inst, dtype=np.int64).ravel()
+        inst_data = np.asarray(inst_data, dtype=np.int64).ravel()
+        if not (len(flags) == len(inst) == len(inst_data)):
+            raise InvalidInstructionError("Instruction arrays have different lengths: "
+                f"{len(flags)}, {len(inst)}, {len(inst_data)}, {len(length)}")
+        if not self.in_prog:
+            raise ProgrammingError("Must be in programming mode before adding instructions.")
+        # ctypes.c_int wraps around, as in `add_instruction()`
+        flags = flags.astype(np.uint32).astype(np.int32)
+        self.inst_flags.frombytes(flags.astype(np.uint32).tobytes())
+        self.inst_lengths.frombytes(length.tobytes())
+        if log is not None:
+            try:
+                log.writelines(f"[{f:08b}] inst: {i} inst_data: {d} dt: {int(t)} \n"
+                    for f, i, d, t in zip(flags.tolist(), inst.tolist(),
+                        inst_data.tolist(), length.tolist()))
+            except EnvironmentError as e:
+                print("Error writing to log:", e)
+        if not SAFE_MODE:
+            return pb_inst_pbonly_many(flags.tolist(), inst.tolist(),
+                inst_data.tolist(), length.tolist())
+        else:
+            return [0] * len(flags)
+
+    def program(self, program:CompiledProgram, incremental=None):
+        """ Program the board with every instruction in `program`, a `CompiledProgram`.
+
+        If `incremental=True` (default: `INCREMENTAL_PROG`), and the board holds
+        a program with the same instructions and branch targets, the whole
+        prefix from address 0 to the last instruction that changed is
+        rewritten, including any unchanged instructions in it, as SpinAPI
+        always programs from the first instruction. The instructions after
+        it are left as they are on the board. If nothing changed, the board
+        is not touched.
+
+        Returns a list of the values returned when adding each instruction.
+        """
+        global log_n
+        # Check every instruction before entering programming mode, so
+        # nothing is left half programmed on the board
+        check_board_init()
+        flags, length, report = self.preflight(program.flags, program.length,
+            bit_names=program.bit_names)
+        if not report:
+            print(report)
+        if len(report.errors):
+            raise report.exception()
+        if incremental is None:
+            incremental = INCREMENTAL_PROG
+        n_write = len(program)
+        if incremental and self._same_layout(program, SequenceProgram.uploaded):
+            changed = program.diff(SequenceProgram.uploaded)
+            if not len(changed):
+                print("Program unchanged, not reprogramming.")
+                return []
+            n_write = changed[-1] + 1
+        err = 0
+        log = None
+        if LOG_PROG:
+            log = open(f"{LOG_FILE}_{log_n}", "w")
+        try:
+            self.prog_enter()
+            refs = self._add_checked(flags[:n_write], program.opcode[:n_write],
+                program.inst_data[:n_write], length[:n_write], log=log)
+            # The rest of the program is already on the board
+            self.inst_flags.frombytes(flags[n_write:].astype(np.uint32).tobytes())
+            self.inst_lengths.frombytes(length[n_write:].tobytes())
+        except Exception as e:
+            err = 1
+            raise e
+        else:
+            return refs
+        finally:
+            if err:
+                print("Aborting programming, exiting programming mode.")
+            else:
+                print("Programming completed successfully. Sequence length: %.2f ms / %d instructions" % (program.length_ns / 1e6, len(program)))
+                if n_write < len(program):
+                    print("Rewrote %d of %d instructions." % (n_write, len(program)))
+                if program.saved_instructions:
+                    print("Subroutines saved %d instructions." % program.saved_instructions)
+            self.prog_exit()
+            if not err:
+                SequenceProgram.uploaded = program
+            if log is not None:
+                log.close()
+                log_n += 1
+
+    @staticmethod
+    def _same_layout(program, other):
+        """ True if `program` and `other` differ only in their flags and lengths. """
+        return (other is not None and len(program) == len(other)
+            and np.array_equal(program.opcode, other.opcode)
+            and np.array_equal(program.inst_data, other.inst_data))
+
     def get_flag_data(self, flag):
         """ Flag should be an integer representing the bit in interest.
         Returns the sequence as so far programmed for that bit.
@@ -231,13 +442,11 @@ class SequenceProgram(threading.Thread):
             >>> plt.plot(*s, drawstyle='steps-pre')
         Will produce a visual plot of the programmed instructions.
         """
-        flag_b = 2**flag
-        # Get time values from all instructions
-        t_ax = [x[3] for x in self.inst_seq]
-        # Get flags of all instructions
-        flags = np.array([x[0].value for x in self.inst_seq])
+        # Get time values and flags of all instructions
+        t_ax = np.frombuffer(self.inst_lengths, dtype=np.float64)
+        flags = np.frombuffer(self.inst_flags, dtype=np.uint32)
         # Find which flags have the required bit enabled
-        vals = (flags & flag_b) // flag_b
+        vals = (flags >> flag) & 1
         # Convert time axis to cumulative values with a zero at the start.
         t_ax = np.concatenate([[0], np.cumsum(t_ax)], axis=0)
         vals = np.concatenate([[vals[0]], vals], axis=0)
@@ -248,6 +457,7 @@ class SequenceProgram(threading.Thread):
         communication with the board, without affecting program execution.
         ie, if a sequence is currently running, this will not stop it."""
         SequenceProgram.board_initialised = False
+        SequenceProgram.uploaded = None
         pb_stop()
     
     def init(self):
@@ -314,6 +524,16 @@ class PulseSequence:
         else:
             self._controller = controller
 
+    def __getstate__(self):
+        # The controller belongs to this process, and can not be pickled
+        state = self.__dict__.copy()
+        state["_controller"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._controller = EmptyController()
+
     def add_raw(self, raw_seq):
         if type(raw_seq) is not RawSequence:
             raise TypeError("raw_seq must be a RawSequence object.")
@@ -358,10 +578,56 @@ class Marker:
 class RawSequence(PulseSequence):
     def __init__(self, controller, *args, save_refs=True, **kwargs):
         super(RawSequence, self).__init__(controller, *args, **kwargs)
-        self.flag_seqs = { n:None for n in range(self.n_bits) }
+        # No sequences yet
+        self._set_buffer(np.zeros(0, dtype=np.int64), np.zeros(self.n_bits + 1, dtype=np.int64),
+            np.zeros(self.n_bits, dtype=bool), totals=np.zeros(self.n_bits, dtype=np.int64))
         self.save_refs = save_refs
         self.markers = {}
 
+    # Toggle durations are stored for all flags in one flat buffer, flag n
+    # using _edges[_offsets[n]:_offsets[n+1]]. _defined marks the flags which
+    # have a sequence (which may be empty), _totals holds the sum of each.
+    @property
+    def flag_seqs(self):
+        """ Dict of the toggle durations of each flag, `None` for flags
+        without a sequence. The arrays are copies, assign a new dict (or use
+        `add_seq()`) to change the sequences. """
+        return {
+            n: (self._seq(n).copy() if self._defined[n] else None) for n in range(self.n_bits)
+        }
+
+    @flag_seqs.setter
+    def flag_seqs(self, flag_seqs):
+        seqs = [None] * self.n_bits
+        for n, seq in flag_seqs.items():
+            seqs[n] = seq
+        self._set_seqs(seqs)
+
+    def _set_seqs(self, seqs):
+        """ Replace all the sequences, given as a list with an array (or
+        `None`) per flag. """
+        defined = np.array([seq is not None for seq in seqs], dtype=bool)
+        pieces = [_as_edges(seq) for seq in seqs if seq is not None]
+        counts = np.zeros(len(seqs), dtype=np.int64)
+        counts[defined] = [len(piece) for piece in pieces]
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        edges = np.concatenate(pieces) if pieces else np.zeros(0, dtype=np.int64)
+        self._set_buffer(edges, offsets, defined)
+
+    def _set_buffer(self, edges, offsets, defined, totals=None):
+        """ Use `edges` as the edge buffer, laid out as given by `offsets`
+        and `defined`. The arrays are not copied. """
+        self._edges = edges
+        self._offsets = offsets
+        self._defined = defined
+        if totals is None:
+            totals = _segment_sums(edges, offsets)
+        self._totals = totals
+
+    def _seq(self, n):
+        """ View of the durations of flag `n`. """
+        return self._edges[self._offsets[n]:self._offsets[n+1]]
+
     def get_marker(self, frame):
         """ Get a marker object for the specified frame. The first frame
         is frame 0.
@@ -387,43 +653,60 @@ class RawSequence(PulseSequence):
         is equivalent to:
             >>> C = A + B
         """
-        this_flags = {k:(v.copy() if v else None) for k, v in self.flag_seqs.items()}
-        other_flags = {k:(v.copy() if v else None) for k, v in other.flag_seqs.items()}
-        new_seq = {k:None for k in self.flag_seqs}
-        if stretch:
-            # work out the end time:
-            times = [sum(seq) for seq in this_flags.values() if seq is not None]
-            end_time = max(times)
-        for key in this_flags:
-            th_seq = this_flags[key] # This_seq
-            if th_seq is not None: 
-                th_seq = th_seq.copy()
-            ot_seq = other_flags[key] # Other_seq
-            if ot_seq is not None:
-                ot_seq = ot_seq.copy()
-            # None + None
-            if th_seq is None and ot_seq is None: continue
-            # None + [...]
-            if th_seq is None and ot_seq is not None:
-                new_seq[key] = [end_time, 0] + ot_seq
-                continue
-            t_full = sum(th_seq)
-            if toggle_odd:# and ot_seq is not None:
-                if len(th_seq) % 2 != 0:
-                    # If prev seq finishes on an ON, add an 
-                    # OFF for the rest of the sequence
-                    th_seq.append(0)
-            if stretch:
-                # Assuming toggle_odd=True, the next term will be an OFF
-                if end_time > t_full:
-                    th_seq += [end_time-t_full, 0]
-            if ot_seq is None:
-                new_seq[key] = th_seq.copy()
-            else:
-                new_seq[key] = th_seq + ot_seq
-            # Otherwise they are both defined
-        new = RawSequence(self.controller, save_refs=self.save_refs)
-        new.flag_seqs = new_seq
+        return RawSequence.concat_all([self, other], stretch=stretch, toggle_odd=toggle_odd)
+
+    @staticmethod
+    def concat_all(sequences, stretch=True, toggle_odd=True):
+        """ Returns a new sequence which is each of `sequences` one after the
+        other, the same as
+            >>> sequences[0].concat(sequences[1]).concat(sequences[2])...
+        but built in a single pass, so the time taken grows linearly with the
+        number of sequences. See `concat()` for `stretch` and `toggle_odd`.
+        """
+        sequences = list(sequences)
+        if len(sequences) == 1:
+            return sequences[0]
+        first = sequences[0]
+        n_bits = first.n_bits
+        dtype = np.result_type(*[seq._edges.dtype for seq in sequences])
+        pad = lambda *values: np.array(values, dtype=dtype)
+        # State of the concatenation so far. Empty sequences are treated as
+        # missing, `started` marks flags with toggles so far.
+        pieces = [[] for _ in range(n_bits)]
+        started = np.zeros(n_bits, dtype=bool)
+        totals = np.zeros(n_bits, dtype=dtype)
+        odd = np.zeros(n_bits, dtype=bool)
+        bit_names = {}
+        for k, seq in enumerate(sequences):
+            counts = seq._offsets[1:] - seq._offsets[:-1]
+            nonempty = seq._defined & (counts > 0)
+            end_time = totals[started].max() if started.any() else 0
+            for bit in np.flatnonzero(started | nonempty):
+                if k == 0:
+                    pass
+                elif not started[bit]:
+                    # None + [...]
+                    pieces[bit].append(pad(end_time, 0))
+                    totals[bit] = end_time
+                else:
+                    if toggle_odd and odd[bit]:
+                        # If prev seq finishes on an ON, add an
+                        # OFF for the rest of the sequence
+                        pieces[bit].append(pad(0))
+                        odd[bit] = False
+                    if stretch and end_time > totals[bit]:
+                        # Assuming toggle_odd=True, the next term will be an OFF
+                        pieces[bit].append(pad(end_time - totals[bit], 0))
+                        totals[bit] = end_time
+                if nonempty[bit]:
+                    pieces[bit].append(seq._seq(bit))
+                    totals[bit] += seq._totals[bit]
+                    odd[bit] ^= bool(counts[bit] % 2)
+            started |= nonempty
+            bit_names.update(seq.bit_names)
+        new = RawSequence(first.controller, save_refs=first.save_refs)
+        new._set_seqs([np.concatenate(p) if p else None for p in pieces])
+        new.bit_names = bit_names
 
         return new
                 
@@ -469,20 +752,15 @@ class RawSequence(PulseSequence):
             flags = [flags]
             sequences = [sequences]
 
-        for sequence in sequences:
-            if not sequence: continue
-            for i in range(len(sequence)):
-                try:
-                    sequence[i] = sequence[i].to('ns').value 
-                except ValueError:
-                    pass
-
+        seqs = [self._seq(n) if self._defined[n] else None for n in range(self.n_bits)]
         for flag, seq in zip(flags, sequences):
-            current = self.flag_seqs[flag]
+            seq = _as_edges([x.to('ns').value if hasattr(x, 'unit') else x for x in seq])
+            current = seqs[flag]
             if np.any(current):
-                self.flag_seqs[flag] = np.concatenate([current, current[-1]*t_rel + seq])
+                seqs[flag] = np.concatenate([current, current[-1]*t_rel + seq])
             else:
-                self.flag_seqs[flag] = seq
+                seqs[flag] = seq
+        self._set_seqs(seqs)
     
     def program_seq(self, end_action=None):
         """ Program the Pulse Blaster board with the defined sequences.
@@ -492,83 +770,42 @@ class RawSequence(PulseSequence):
 
         Returns 0 on success, or 1 on failure.
         """
-        global log_n
-        t_ax, frames = self._merge_sequences()
-        pin_sets = [flags_to_number(f) for f in frames]
-        # t_lens = (t_ax[1:] - t_ax[:-1])
-        t_lens = t_ax
-        if end_action is None:
-            # Assume we just want to end the sequence and loop back
-            end_action = actions.Branch(0)
-        elif end_action.inst != 6:
-            raise Exception("End action is:", type(end_action), end_action.inst)
-        err = 0
-        n_insts = 0
-        if LOG_PROG:
-            log = open(f"{LOG_FILE}_{log_n}", "w")
-        try:
-            self._controller.prog_enter()
-            # TODO: Loops? Jumps?
-            # Add the starting frame
-            start = self.controller.add_instruction(
-                pin_sets[0], Inst.CONTINUE, 0, t_lens[0], log=log
-            )
-            refs = [start]
-            n_insts += 1
-            # Add the other frames
-            for p, dt in zip(pin_sets[1:-1], t_lens[1:-1]):
-                refs.append(
-                    self.controller.add_instruction(
-                        p, Inst.CONTINUE, 0, dt, log=log
-                    )
-                )
-                n_insts += 1
-            # Add the final frame, which branches back to the beginning
-            refs.append(
-                self.controller.add_instruction(
-                    pin_sets[-1], end_action.inst, start, t_lens[-1], log=log
-                )
-            )
-            n_insts += 1
+        refs = self._controller.program(self.compile(end_action=end_action))
+        if self.save_refs:
+            self._refs = refs
+        return 0
 
-        except Exception as e:
-            err = 1
-            # err_msg = str(e)
-            raise e
-        else:
-            if self.save_refs:
-                self._refs = refs
-            return err
+    def compile(self, end_action=None, loops=False, subroutines=False):
+        """ Merge the sequences into a `CompiledProgram`, which can be
+        programmed to the board repeatedly without merging again.
 
-        finally:
-            if err:
-                print("Aborting programming, exiting programming mode.")
-                # print("Error message: " + err_msg)
-            else:
-                print("Programming completed successfully. Sequence length: %.2f ms / %d instructions" % (self.length_ns / 1e6, n_insts))
-            self.controller.prog_exit()
-            if LOG_PROG:
-                log.close()
-                log_n += 1
+        `end_action` is the action performed by the last instruction,
+        see `program_seq()`. A raw sequence has no repetitions, `loops` and
+        `subroutines` are only accepted for compatibility with
+        `StructuredSequence.compile()`.
+        """
+        t_ax, words = self._merge_words()
+        prog = CompiledProgram.from_frames(t_ax, words, end_action=end_action,
+            bit_names=self.bit_names, used_flags=self.used_flags)
+        if self._controller != None:
+            prog.set_controller(self._controller)
+        return prog
 
     def plot_sequence(self):
-        # Get frame flags (ie on/off values for each frame, for each flag)
-        t_ax, frames = self._merge_sequences()
+        import matplotlib.pyplot as plt # Slow to import, only needed here
+        # Get packed flag words for each frame
+        t_ax, words = self._merge_words()
         # Pick the flags which are not all zeros
-        nonz_flags = np.array([k for k, v in self.flag_seqs.items() if v is not None])
+        flag_nums = self.used_flags
+        frames = unpack_flag_words(words, flag_nums)
         # Turn time axis into one we can plot
         t_ax = t_ax.cumsum()
         if t_ax[0] != 0:
             # If the time axis doesn't start at zero, add a t=0 frame
             t_ax = np.concatenate([[0], t_ax])
             frames = np.concatenate([frames[[0]], frames[:]], axis=0)
-        # Get flag numbers to show on plot
-        flag_nums = np.arange(frames.shape[1])
-        # Exclude frames which are all zero
-        frames = frames[:,nonz_flags]
-        flag_nums = flag_nums[nonz_flags]
         # Vertically separate each flag to make it look better
-        plot_shifts = np.arange(len(nonz_flags)) * 1.1
+        plot_shifts = np.arange(len(flag_nums)) * 1.1
         plt.plot(t_ax, frames + plot_shifts, drawstyle='steps-pre')
         plt.legend([str(i) for i in flag_nums])
         plt.show()
@@ -580,37 +817,42 @@ class RawSequence(PulseSequence):
 
         The first row will be dt, n... where n is each non-empty flag.
         """
-        # Get frame flags (ie on/off values for each frame, for each flag)
-        t_ax, frames = self._merge_sequences()
-        # Pick the flags which are not all zeros
-        nonz_flags = np.array([k for k, v in self.flag_seqs.items() if v is not None])
-        # Get flag numbers to write in file
-        flag_nums = np.arange(frames.shape[1])
-        flag_nums = flag_nums[nonz_flags]
-        # Exclude frames which are all zero
-        frames = frames[:,nonz_flags]
+        # Get packed flag words for each frame
+        t_ax, words = self._merge_words()
+        # Only write the flags which are not all zeros
+        flag_nums = self.used_flags
+        frames = unpack_flag_words(words, flag_nums)
         full = np.concatenate([t_ax.reshape(-1, 1), frames], axis=1)
         header = ",".join(["dt", *[str(x) for x in flag_nums]])
         np.savetxt(fname, full, fmt="%d", delimiter=",", header=header, comments="")
         
+    def _flag_seq_list(self):
+        # A list of (probably mostly empty) sequences for all bits
+        return [self._seq(n) for n in range(self.n_bits)]
+
     def _merge_sequences(self):
         """ Merge the current sequences to create flag frames,
         intended to be used by the PulseSequence class. 
         """
-
-        # self.flag_seqs is a dict. Create a list of (probably mostly empty)
-        # sequences for all required bits. (Maybe just store self.flag_seqs as a list?)
-        flag_seqs = []
-        for f in range(self.n_bits):
-            seq = self.flag_seqs[f]
-            if seq is not None:
-                flag_seqs.append(seq)
-            else:
-                flag_seqs.append([])
-        
-        t_ax, frames = merge_flag_seqs(flag_seqs)
+        t_ax, frames = merge_flag_seqs(self._flag_seq_list())
         return t_ax, frames
 
+    def _merge_words(self):
+        """ Merge the current sequences into frame durations and packed
+        flag words, see `merge_flag_words`. """
+        t_ax, words = merge_flag_words(self._flag_seq_list())
+        return t_ax, words
+
+    @property
+    def used_params(self):
+        """ Set of parameters which appear in the sequences. """
+        return set()
+
+    @property
+    def used_flags(self):
+        """ Array of the flags which have a sequence defined. """
+        return np.flatnonzero(self._defined)
+
     def add_raw(self, *args, **kwargs):
         raise NotImplementedError(f"add_raw() not available for subtype {type(self)}")
 
@@ -626,20 +868,90 @@ class RawSequence(PulseSequence):
     
     @property
     def length_ns(self):
-        lengths = [sum(x) for x in self.flag_seqs.values() if x is not None]
-        return max(lengths)
+        return self._totals[self._defined].max().item()
 
     @property
     def inst_count(self):
-        t_ax, _ = self._merge_sequences()
+        t_ax, _ = self._merge_words()
         return len(t_ax)
         
 
 
+def sweep_axes(table, n_steps, dtype=None):
+    """ Make the parameter axes for a sweep of `n_steps` steps. `table` maps
+    each parameter name to one of:
+
+        ("LIN", start, stop)    `n_steps` values evenly spaced from start to stop
+        ("LOG", start, stop)    `n_steps` values evenly spaced on a log scale
+        [v0, v1, ...]           the values themselves, one per step
+
+    Returns a dict of arrays, converted to `dtype` if given, eg:
+
+        >>> sweep_axes({"tau": ("LIN", 100, 500), "pi": [80, 80, 90]}, 3, dtype=int)
+        {'tau': array([100, 300, 500]), 'pi': array([80, 80, 90])}
+    """
+    axes = {}
+    for k, spec in table.items():
+        if isinstance(spec, tuple) and len(spec) == 3 and isinstance(spec[0], str):
+            mode, start, stop = spec
+            if mode.upper() == "LIN":
+                axis = np.linspace(start, stop, n_steps)
+            elif mode.upper() == "LOG":
+                axis = np.logspace(*np.log10([start, stop]), n_steps)
+            else:
+                raise ValueError("Unknown progression %s for %s, use LIN or LOG." % (mode, k))
+        else:
+            axis = np.asarray(spec)
+        if dtype is not None:
+            axis = axis.astype(dtype)
+        axes[k] = axis
+    check_axes(axes, n_steps)
+    return axes
+
+
+def check_axes(axes, n_steps=None):
+    """ Check that every axis in `axes` has `n_steps` values (if given) and
+    return the axes as arrays along with the number of steps. """
+    axes = {k:np.asarray(v) for k, v in axes.items()}
+    for k, v in axes.items():
+        if n_steps is None:
+            n_steps = len(v)
+        elif len(v) != n_steps:
+            raise ValueError("Axis for %s has %d values, expected %d." % (k, len(v), n_steps))
+    if n_steps is None:
+        raise ValueError("The number of steps must be given if no parameters are swept.")
+    return axes, n_steps
+
+
+def _segment_sums(edges, offsets):
+    """ Sum of each flag's durations in an edge buffer (or in each row of a
+    2D array of edge buffers), using one reduceat. """
+    totals = np.zeros(edges.shape[:-1] + (len(offsets) - 1,), dtype=edges.dtype)
+    nonempty = offsets[1:] > offsets[:-1]
+    if nonempty.any():
+        totals[..., nonempty] = np.add.reduceat(edges, offsets[:-1][nonempty], axis=-1)
+    return totals
+
+
+def _as_edges(seq):
+    """ Convert a sequence of durations to an array for `RawSequence`'s edge
+    buffer. Whole numbers of nanoseconds are stored as int64, anything else
+    as float64. """
+    seq = np.asarray(seq)
+    if seq.dtype.kind in "biu":
+        return seq.astype(np.int64)
+    seq = seq.astype(np.float64)
+    if np.all(seq == np.round(seq)):
+        return seq.astype(np.int64)
+    return seq
+
+
 def extract_ns(value):
     """ If `value` is a Quantity, convert to nanoseconds and return dimensionless value,
     otherwise just return value. In any case if `value` is dimensionless or a unit of time
     then the output will be dimensionless nanoseconds. Non time units will raise an error."""
+    if type(value) in (int, float):
+        return value
     try:
         value.unit
     except AttributeError:
@@ -655,8 +967,71 @@ class AbstractSequence(RawSequence):
     and remain undetermined until then. """
     def __init__(self, controller, *args, **kwargs):
         super(AbstractSequence, self).__init__(controller, *args, **kwargs)
+        self.flag_seqs = { n:None for n in range(self.n_bits) }
         self.params = {}
 
+    # Sequences may contain parameter names, so they are kept as a dict of
+    # lists rather than in `RawSequence`'s edge buffer.
+    @property
+    def flag_seqs(self):
+        """ Dict of the toggle durations (or parameter names) of each flag,
+        `None` for flags without a sequence. """
+        return self._symbolic_seqs
+
+    @flag_seqs.setter
+    def flag_seqs(self, flag_seqs):
+        self._symbolic_seqs = flag_seqs
+        self._template = None
+
+    @property
+    def template(self):
+        """ The sequences compiled for evaluation, as `(base, offsets,
+        defined, symbols)`. `base` is an edge buffer laid out like
+        `RawSequence`'s, holding the constant part of each duration, and
+        `symbols` maps each parameter name to `(indices, coefficients)`, the
+        entries of `base` it is added to and how many times.
+
+        The template is rebuilt after `add_seq()` or assigning `flag_seqs`,
+        but not if the lists in `flag_seqs` are changed in place.
+        """
+        if self._template is None:
+            values = []
+            symbols = {}
+            defined = np.zeros(self.n_bits, dtype=bool)
+            counts = np.zeros(self.n_bits, dtype=np.int64)
+            for bit, seq in self.flag_seqs.items():
+                if seq is None: continue
+                defined[bit] = True
+                counts[bit] = len(seq)
+                for value in seq:
+                    if type(value) == str:
+                        expr = expressions.linear(value)
+                        for name, coef in expr.terms.items():
+                            idx, coefs = symbols.setdefault(name, ([], []))
+                            idx.append(len(values))
+                            coefs.append(coef)
+                        value = expr.const
+                    values.append(extract_ns(value))
+            base = _as_edges(values)
+            offsets = np.concatenate([[0], np.cumsum(counts)])
+            symbols = {k: (np.array(idx, dtype=np.int64), _as_edges(coefs))
+                for k, (idx, coefs) in symbols.items()}
+            self._template = (base, offsets, defined, symbols)
+        return self._template
+
+    def _flag_seq_list(self):
+        return self.eval()._flag_seq_list()
+
+    @property
+    def used_flags(self):
+        """ Array of the flags which have a sequence defined. """
+        return np.array([k for k, v in self.flag_seqs.items() if v is not None], dtype=int)
+
+    @property
+    def length_ns(self):
+        """ Length of the sequence using the default parameter values. """
+        return self.eval().length_ns
+
     def set_param_default(self, **params):
         """ Provide a parameter and a value as a keyword argument
         to set the default value for that parameter. eg:
@@ -672,6 +1047,18 @@ class AbstractSequence(RawSequence):
             params[k] = extract_ns(val)
         self.params.update(**params)
 
+    @property
+    def used_params(self):
+        """ Set of parameters which appear in the sequences. Parameters
+        with default values which are not used are not included. """
+        used = set()
+        for seq in self.flag_seqs.values():
+            if seq is None: continue
+            for x in seq:
+                if type(x) == str:
+                    used.update(expressions.symbols(x))
+        return used
+
     def add_seq(self, flags, sequences, t_rel=True):
         """ Add flag toggle times, flags must be integers,
         sequences must be a list of lists of strings (to make a new parameter)
@@ -695,9 +1082,11 @@ class AbstractSequence(RawSequence):
                 self.flag_seqs[flag] = seq
             for x in seq:
                 if type(x) == str:
-                    if x not in self.params:
-                        # Add the new parameter
-                        self.params[x] = None
+                    for name in expressions.symbols(x):
+                        if name not in self.params:
+                            # Add the new parameter
+                            self.params[name] = None
+        self._template = None
 
     def program_seq(self, end_action=None, **params):
         """ Program the sequence to the board. Provide values
@@ -710,8 +1099,7 @@ class AbstractSequence(RawSequence):
         value, it must be given a value here, otherwise a ValueError
         will be raised.
 
-        After evaluating and programming, the original parameterised sequence
-        will be restored.
+        The parameterised sequence itself is not changed.
         """
         # Check params
         # self.evaluate_params(**params)
@@ -727,28 +1115,10 @@ class AbstractSequence(RawSequence):
 
             raise ValueError("Values must be provided for: %s" % missing)
 
-        # Convert units to scalars
-        for k, v in temp_params.items():
-            temp_params[k] = extract_ns(v)
-
-        # Create copy of original parameters
-        original_seqs = {
-            k:(seq.copy() if seq is not None else None) for k, seq in self.flag_seqs.items()
-        }
-        # Substitute params
-        for k, seq in self.flag_seqs.items():
-            # Skip empty sequences
-            if seq is None: continue
-            # Otherwise go through sequence and replace symbols
-            for i, v in enumerate(seq):
-                if v in temp_params:
-                    seq[i] = temp_params[v]
-
-        # Program
-        super(AbstractSequence, self).program_seq(end_action=end_action)
-
-        # Return original sequence
-        self.flag_seqs = original_seqs
+        # Evaluate and program, the parameterised sequence is left as it is
+        refs = self._controller.program(self.compile(end_action=end_action, **params))
+        if self.save_refs:
+            self._refs = refs
 
     def eval(self, **kw_params) -> RawSequence:
         """ Completely evaluate the sequence, using the given parameter 
@@ -756,28 +1126,78 @@ class AbstractSequence(RawSequence):
         
         A `RawSequence` object is returned.
         """
+        return self.eval_many(**kw_params)[0]
+
+    def eval_many(self, **kw_params) -> list:
+        """ Evaluate the sequence for several sets of parameter values at once.
+        Parameters may be given as sequences of equal length, and a list with
+        a `RawSequence` for each set of values is returned:
+
+        >>> a, b, c = absq.eval_many(tau=[100, 200, 300], pi=80)
+
+        Parameters given as single values, or not given, are the same in
+        every returned sequence. If no sequences are given, a list with one
+        `RawSequence` is returned.
+        """
+        base, offsets, defined, symbols = self.template
         new_params = self.params.copy()
         new_params.update(kw_params)
-        if None in new_params.items():
-            bad_params = [k for k, v in new_params.items() if v is None]
+        bad_params = [k for k in symbols if new_params.get(k) is None]
+        if bad_params:
             raise ValueError('The following parameters do not have default values and need to be specified:\n%s'%bad_params)
 
-        # Create a copy for the new sequences, note this is a shallow copy,
-        # the references to the sequence lists is probably being re-used.
-        new_sequence = self.flag_seqs.copy()
-        for k, seq in self.flag_seqs.items():
-            if seq is None:
-                continue
-            new_sequence[k] = seq.copy()
-            for i, value in enumerate(seq):
-                if value in new_params:
-                    val = new_params[value]
-                    new_sequence[k][i] = extract_ns(val)
-
-        ret = RawSequence(self.controller, save_refs=self.save_refs) 
-        ret.flag_seqs = new_sequence
+        # Convert the values used, one row per returned sequence
+        values = {}
+        n = None
+        for k in symbols:
+            val = new_params[k]
+            if np.ndim(val) > 0 and not hasattr(val, "unit"):
+                val = _as_edges([extract_ns(x) for x in val])
+                if n is not None and len(val) != n:
+                    raise ValueError("Parameter %s has %d values, expected %d." % (k, len(val), n))
+                n = len(val)
+            else:
+                val = _as_edges(extract_ns(val))
+            values[k] = val
+        if n is None:
+            n = 1
+        dtype = np.result_type(base.dtype, *[v.dtype for v in values.values()],
+            *[coefs.dtype for _, coefs in symbols.values()])
+        edges = np.tile(base.astype(dtype), (n, 1))
+        for k, (idx, coefs) in symbols.items():
+            # Each parameter appears at most once per entry, see `template`
+            edges[:, idx] += values[k].reshape(-1, 1) * coefs
+        totals = _segment_sums(edges, offsets)
+
+        ret = []
+        for row, row_totals in zip(edges, totals):
+            raw = RawSequence(self.controller, save_refs=self.save_refs)
+            raw._set_buffer(row, offsets, defined, totals=row_totals)
+            raw.bit_names = self.bit_names.copy()
+            ret.append(raw)
         return ret
 
+    def compile(self, end_action=None, loops=False, subroutines=False, **kw_params):
+        """ Evaluate the sequence with the given parameters (see `eval()`)
+        and compile it into a `CompiledProgram`. """
+        return self.eval(**kw_params).compile(end_action=end_action)
+
+    def sweep(self, axes, n_steps=None, end_action=None, loops=False, subroutines=False,
+              **kw_params) -> CompiledProgram:
+        """ Compile a scan over parameter values, the whole sequence being
+        repeated once for each step. See `StructuredSequence.sweep()`. """
+        axes, n_steps = check_axes(axes, n_steps)
+        params = dict(kw_params)
+        params.update(axes)
+        raws = self.eval_many(**params)
+        if len(raws) != n_steps:
+            raws = raws * n_steps
+        prog = RawSequence.concat_all(raws).compile(end_action=end_action)
+        prog.step_lengths = np.array([raw.length_ns for raw in raws], dtype=np.float64)
+        prog.step_starts = np.concatenate([[0], np.cumsum(prog.step_lengths)[:-1]])
+        prog.axes = axes
+        return prog
+
     def evaluate_params(self, *params, **kw_params):
         """ Evaluate the given parameters using the default values,
         or a value given here. eg,
@@ -808,14 +1228,19 @@ class AbstractSequence(RawSequence):
 
         new_sequence = self.flag_seqs.copy()
 
+        values = {k:extract_ns(v) for k, v in kw_params.items()}
         for k, seq in self.flag_seqs.items():
             if seq is None:
                 continue
+            new_sequence[k] = seq.copy()
             for i, value in enumerate(seq):
-                new_sequence[k] = seq.copy()
-                if value in kw_params:
-                    val = kw_params[value]
-                    new_sequence[k][i] = extract_ns(val)
+                if type(value) != str:
+                    continue
+                expr = expressions.linear(value)
+                if expr.symbols.isdisjoint(values):
+                    continue
+                expr = expr.substitute(**values)
+                new_sequence[k][i] = _as_edges(expr.const).item() if expr.is_const else str(expr)
         ret = AbstractSequence(self.controller, save_refs=self.save_refs)
         ret.flag_seqs = new_sequence
         return ret
@@ -830,12 +1255,101 @@ def flags_to_number(flags):
     """ Convert an array of flags to a number,
     assumes the array has only FLAG_OFF's and FLAG_ON's, and that
     the left (0th) element is the least significant.
+
+    A 2D array of frames (one row per frame) is converted to an array
+    of numbers, one for each frame.
+    """
+    flags = np.asarray(flags)
+    twos = np.left_shift(1, np.arange(flags.shape[-1], dtype=np.int64))
+    return ((flags == FLAG_ON) @ twos).astype(np.int32)
+
+
+def unpack_flag_words(words, flags):
+    """ Inverse of packing flags into words. Returns an integer array with
+    a row for each word and a column for each flag number in `flags`,
+    containing FLAG_ON or FLAG_OFF.
+    """
+    flags = np.asarray(flags, dtype=np.uint32)
+    return ((np.asarray(words, dtype=np.uint32)[:, None] >> flags) & 1).astype(int)
+
+
+def merge_flag_words(sequences, relative_times=True):
+    """ Merge sequences for individual flags into packed flag words.
+
+    Takes the same input as `merge_flag_seqs`, but instead of a frames matrix
+    returns one unsigned integer per frame with bit `n` set if flag `n` is on
+    during that frame:
+
+        >>> t, words = merge_flag_words([[0.1, 0.3], [0.3, 0.2]])
+        >>> t
+        [0.1, 0.2, 0.1, 0.1]
+        >>> words
+        [0, 1, 3, 2]
+
+    Every toggle edge of every flag is sorted once and the flag states are
+    recovered with a cumulative XOR over the packed words, so the cost scales
+    with the number of edges rather than (flags x edges).
+
+    Each flag's toggle times are assumed to be non-decreasing (ie no negative
+    durations). As with `merge_flag_seqs`, toggles which coincide with
+    another toggle of the same flag cancel in pairs, and a flag is turned
+    off after its last toggle.
     """
-    # TODO: Could change this to be a vector-able function?
-    l = len(flags)
-    a = np.arange(l)
-    twos = 2**a
-    return np.int32(sum(twos * (flags == FLAG_ON).astype(int)))
+    if len(sequences) > 32:
+        raise ValueError("At most 32 flags can be packed into a flag word.")
+    times = []
+    bits = []
+    for bit, seq in enumerate(sequences):
+        if seq is None or len(seq) == 0:
+            continue
+        seq = np.asarray(seq)
+        if relative_times:
+            seq = np.cumsum(seq)
+        times.append(seq)
+        bits.append(np.full(len(seq), bit, dtype=np.int64))
+    if not times:
+        return np.zeros(0), np.zeros(0, dtype=np.uint32)
+    t_edges = np.concatenate(times)
+    b_edges = np.concatenate(bits)
+
+    # Group consecutive equal times of the same flag. An even number of
+    # toggles at the same time cancel, an odd number leaves a single toggle.
+    new_run = np.ones(len(t_edges), dtype=bool)
+    new_run[1:] = (t_edges[1:] != t_edges[:-1]) | (b_edges[1:] != b_edges[:-1])
+    run_starts = np.flatnonzero(new_run)
+    run_lens = np.diff(np.append(run_starts, len(t_edges)))
+    keep = run_starts[run_lens % 2 == 1]
+    t_edges = t_edges[keep]
+    b_edges = b_edges[keep]
+
+    # Flags are forced off after their last toggle, so if a flag has an odd
+    # number of toggles its last one only marks a frame boundary.
+    is_toggle = np.ones(len(t_edges), dtype=bool)
+    if len(t_edges):
+        counts = np.bincount(b_edges, minlength=len(sequences))
+        last = np.flatnonzero(np.append(b_edges[1:] != b_edges[:-1], True))
+        is_toggle[last[counts[b_edges[last]] % 2 == 1]] = False
+
+    t_all = np.sort(t_edges)
+    if len(t_all):
+        t_all = t_all[np.append(True, t_all[1:] != t_all[:-1])]
+    # A toggle at t_all[k] changes the state of every frame after frame k.
+    # After cancelling pairs each (time, flag) is unique, so summing the bits
+    # landing on the same frame is the same as OR-ing them.
+    idx = np.searchsorted(t_all, t_edges[is_toggle]) + 1
+    weights = np.left_shift(1, b_edges[is_toggle]).astype(np.float64)
+    changes = np.bincount(idx, weights=weights, minlength=len(t_all) + 1)
+    words = np.bitwise_xor.accumulate(changes.astype(np.uint32))[:-1]
+
+    if relative_times:
+        t_all = np.diff(t_all, prepend=0)
+        nonz_ts = t_all != 0
+        words = words[nonz_ts]
+        t_all = t_all[nonz_ts]
+    else:
+        print("pulse_utils.merge_flag_words(): Warning: "
+              "I haven't checked behaviour for relative_times=False")
+    return t_all, words
 
 
 def merge_flag_seqs(sequences, relative_times=True):
@@ -865,59 +1379,16 @@ def merge_flag_seqs(sequences, relative_times=True):
         [0.1, 0.2, 0.1, 0.1]
         >>> frames
         [[0, 0], [1, 0], [1, 1], [0, 1]]
+
+    This unpacks the result of `merge_flag_words`, which should be preferred
+    where the packed flag words can be used directly.
     """        
-    # Perform cum sum if needed:
-    if relative_times:
-        sequences = [np.cumsum(sequence) for sequence in sequences]
-    # Try pre-emptively remove zero length frames:
-    for i, seq in enumerate(sequences):
-        # Mask of which values to keep
-        fin_mask = np.ones(len(seq), dtype=np.bool8)
-        # If two adjacent values are equal then remove both
-        skip_flag = False
-        for k, t in enumerate(seq[:-1]):
-            if skip_flag:
-                # Skip the second of two consecutive values
-                # This is important because a third consecutive value 
-                # should not be removed (ie only even quantities should be removed)
-                skip_flag = False
-                continue
-            if t == seq[k+1]:
-                fin_mask[k] = False
-                fin_mask[k+1] = False
-                skip_flag = True
-                
-        sequences[i] = seq[fin_mask]
-
-    # Make sure sequences is an array
-    flat_seqs = np.unique(np.concatenate(sequences))
-    # Sort time steps
-    t_all = np.sort(flat_seqs)
-    frames = []
-    toggles_full = ([(FLAG_ON if i%2 else FLAG_OFF) for i in range(len(t_all))])
-    for seq in sequences:
-        if len(seq) == 0:
-            frames.append(np.full(t_all.shape, FLAG_OFF))
-            continue
-        toggles = toggles_full[:len(seq)]
-        interp = interpolate.interp1d(
-            seq, toggles, kind="next", 
-            fill_value=(FLAG_OFF, FLAG_OFF),
-            bounds_error=False
-        )
-        frame = interp(t_all)
-        frames.append(frame)
-
-    frames = np.array(frames)
-    if relative_times:
-        t_all = np.diff(t_all, prepend=0)
-        nonz_ts = t_all != 0
-        frames = frames[:, nonz_ts]
-        t_all = t_all[nonz_ts]
-    else:
-        print("pulse_utils.merge_flag_seqs(): Warning: "
-              "I haven't checked behaviour for relative_times=False")
-    return t_all, frames.T
-        
+    t_all, words = merge_flag_words(sequences, relative_times=relative_times)
+    if any(seq is None or len(seq) == 0 for seq in sequences):
+        # Empty sequences have always made the time axis floating point.
+        t_all = t_all.astype(np.float64)
+    frames = (words[:, None] >> np.arange(len(sequences), dtype=np.uint32)) & 1
+    return t_all, frames.astype(np.float64)
+
 if __name__ == "__main__":
     print("Hello there")
@@ -38,24 +38,40 @@ import ctypes
 PULSE_PROGRAM = 0
 FREQ_REGS = 1  
 
-DBG_MODE = False
+DBG_MODE = False	# Only valid once the library is loaded, see is_debug_mode()
+spinapi = None
 
-try:
-	spinapi = ctypes.CDLL("C:\SpinCore\SpinAPI\lib\spinapi64.dll")
-except:
+def _load():
+	""" Load the SpinAPI library, or use TEST MODE if it can't be found.
+	This happens on the first call of a pb_ function rather than on import,
+	so importing this module is quick. """
+	global spinapi, DBG_MODE
+	if spinapi is not None:
+		return
 	try:
-		spinapi = ctypes.CDLL("spinapi")
+		spinapi = ctypes.CDLL("C:\SpinCore\SpinAPI\lib\spinapi64.dll")
 	except:
-		print("Failed to load spinapi library.")
-		print("If this is unexpected, you may need to check the "\
-			  "location of the spinapi library in spinapi.py.")
-		print("Using spinapi TEST MODE")
-		DBG_MODE = True
-		spinapi = spinapi_debug()
-		pass
-finally:
-	if type(spinapi) != spinapi_debug:
-		print("spinapi module loaded successfully")
+		try:
+			spinapi = ctypes.CDLL("spinapi")
+		except:
+			print("Failed to load spinapi library.")
+			print("If this is unexpected, you may need to check the "\
+				  "location of the spinapi library in spinapi.py.")
+			print("Using spinapi TEST MODE")
+			DBG_MODE = True
+			spinapi = spinapi_debug()
+			pass
+	finally:
+		if type(spinapi) != spinapi_debug:
+			print("spinapi module loaded successfully")
+			_declare_types()
+	globals().update(_debug_functions() if DBG_MODE else _real_functions())
+
+def is_debug_mode():
+	""" True if the SpinAPI library could not be loaded, in which case the
+	pb_ functions do nothing. Loads the library if it hasn't been yet. """
+	_load()
+	return DBG_MODE
 
 	
 def enum(**enums):
@@ -82,82 +98,87 @@ Inst = enum(
 	WAIT = 8,
 	RTI = 9
 )
-spinapi.pb_get_version.restype = (ctypes.c_char_p)
-spinapi.pb_get_error.restype = (ctypes.c_char_p)
 
-spinapi.pb_count_boards.restype = (ctypes.c_int)
 
-spinapi.pb_init.restype = (ctypes.c_int)
+def _declare_types():
+	""" Argument and return types of the library functions. """
+	spinapi.pb_get_version.restype = (ctypes.c_char_p)
+	spinapi.pb_get_error.restype = (ctypes.c_char_p)
 
-spinapi.pb_select_board.argtype = (ctypes.c_int)
-spinapi.pb_select_board.restype = (ctypes.c_int)
+	spinapi.pb_count_boards.restype = (ctypes.c_int)
 
-spinapi.pb_set_debug.argtype = (ctypes.c_int)
-spinapi.pb_set_debug.restype = (ctypes.c_int)
+	spinapi.pb_init.restype = (ctypes.c_int)
 
-spinapi.pb_set_defaults.restype = (ctypes.c_int)
+	spinapi.pb_select_board.argtype = (ctypes.c_int)
+	spinapi.pb_select_board.restype = (ctypes.c_int)
 
-spinapi.pb_core_clock.argtype = (ctypes.c_double)
-spinapi.pb_core_clock.restype = (ctypes.c_int)
+	spinapi.pb_set_debug.argtype = (ctypes.c_int)
+	spinapi.pb_set_debug.restype = (ctypes.c_int)
 
-spinapi.pb_write_register.argtype = (ctypes.c_int, ctypes.c_int)
-spinapi.pb_write_register.restype = (ctypes.c_int)
+	spinapi.pb_set_defaults.restype = (ctypes.c_int)
 
-spinapi.pb_start_programming.argtype = (ctypes.c_int)
-spinapi.pb_start_programming.restype = (ctypes.c_int)
+	spinapi.pb_core_clock.argtype = (ctypes.c_double)
+	spinapi.pb_core_clock.restype = (ctypes.c_int)
 
-spinapi.pb_stop_programming.restype = (ctypes.c_int)
+	spinapi.pb_write_register.argtype = (ctypes.c_int, ctypes.c_int)
+	spinapi.pb_write_register.restype = (ctypes.c_int)
 
-spinapi.pb_start.restype = (ctypes.c_int)
-spinapi.pb_stop.restype = (ctypes.c_int)
-spinapi.pb_reset.restype = (ctypes.c_int)
-spinapi.pb_close.restype = (ctypes.c_int)
+	spinapi.pb_start_programming.argtype = (ctypes.c_int)
+	spinapi.pb_start_programming.restype = (ctypes.c_int)
 
+	spinapi.pb_stop_programming.restype = (ctypes.c_int)
 
-spinapi.pb_inst_pbonly.argtype = (
-        ctypes.c_int, #flags
-	ctypes.c_int, #inst
-	ctypes.c_int, #inst data
-	ctypes.c_double, #length (double)
-)
-spinapi.pb_inst_pbonly.restype = (ctypes.c_int)
-
-
-spinapi.pb_inst_radio.argtype = (
-        ctypes.c_int, #Frequency register 
-	ctypes.c_int, #Cosine phase
-	ctypes.c_int, #Sin phase
-	ctypes.c_int, #tx phase
-	ctypes.c_int, #tx enable
-	ctypes.c_int, #phase reset
-	ctypes.c_int, #trigger scan
-	ctypes.c_int, #flags
-	ctypes.c_int, #inst
-	ctypes.c_int, #inst data
-	ctypes.c_double, #length (double)
-)
-spinapi.pb_inst_radio.restype = (ctypes.c_int)
-
-
-spinapi.pb_inst_dds2.argtype = (
-	ctypes.c_int, #Frequency register DDS0
-	ctypes.c_int, #Phase register DDS0
-	ctypes.c_int, #Amplitude register DDS0
-	ctypes.c_int, #Output enable DDS0
-	ctypes.c_int, #Phase reset DDS0
-	ctypes.c_int, #Frequency register DDS1
-	ctypes.c_int, #Phase register DDS1
-	ctypes.c_int, #Amplitude register DDS1
-	ctypes.c_int, #Output enable DDS1,
-	ctypes.c_int, #Phase reset DDS1,
-	ctypes.c_int, #Flags
-	ctypes.c_int, #inst
-	ctypes.c_int, #inst data
-	ctypes.c_double, #timing value (double)
-)
-spinapi.pb_inst_dds2.restype = (ctypes.c_int)
+	spinapi.pb_start.restype = (ctypes.c_int)
+	spinapi.pb_stop.restype = (ctypes.c_int)
+	spinapi.pb_reset.restype = (ctypes.c_int)
+	spinapi.pb_close.restype = (ctypes.c_int)
+
+
+	spinapi.pb_inst_pbonly.argtypes = (
+	        ctypes.c_int, #flags
+		ctypes.c_int, #inst
+		ctypes.c_int, #inst data
+		ctypes.c_double, #length (double)
+	)
+	spinapi.pb_inst_pbonly.restype = (ctypes.c_int)
+
+
+	spinapi.pb_inst_radio.argtype = (
+	        ctypes.c_int, #Frequency register 
+		ctypes.c_int, #Cosine phase
+		ctypes.c_int, #Sin phase
+		ctypes.c_int, #tx phase
+		ctypes.c_int, #tx enable
+		ctypes.c_int, #phase reset
+		ctypes.c_int, #trigger scan
+		ctypes.c_int, #flags
+		ctypes.c_int, #inst
+		ctypes.c_int, #inst data
+		ctypes.c_double, #length (double)
+	)
+	spinapi.pb_inst_radio.restype = (ctypes.c_int)
 
-if not DBG_MODE:
+
+	spinapi.pb_inst_dds2.argtype = (
+		ctypes.c_int, #Frequency register DDS0
+		ctypes.c_int, #Phase register DDS0
+		ctypes.c_int, #Amplitude register DDS0
+		ctypes.c_int, #Output enable DDS0
+		ctypes.c_int, #Phase reset DDS0
+		ctypes.c_int, #Frequency register DDS1
+		ctypes.c_int, #Phase register DDS1
+		ctypes.c_int, #Amplitude register DDS1
+		ctypes.c_int, #Output enable DDS1,
+		ctypes.c_int, #Phase reset DDS1,
+		ctypes.c_int, #Flags
+		ctypes.c_int, #inst
+		ctypes.c_int, #inst data
+		ctypes.c_double, #timing value (double)
+	)
+	spinapi.pb_inst_dds2.restype = (ctypes.c_int)
+
+def _real_functions():
+	""" The pb_ functions, calling the library. """
 	def pb_get_version():
 		"""Return library version as UTF-8 encoded string."""
 		ret = spinapi.pb_get_version()
@@ -206,6 +227,13 @@ if not DBG_MODE:
 			args = tuple(t)
 			return spinapi.pb_inst_pbonly(*args)
 
+	def pb_inst_pbonly_many(flags, inst, inst_data, length):
+		"""Add a block of instructions, given as sequences of python ints
+		(and floats for the length). Returns a list of the return values."""
+		# argtypes are declared, so ctypes converts the arguments itself
+		add = spinapi.pb_inst_pbonly
+		return [add(*args) for args in zip(flags, inst, inst_data, length)]
+
 	def pb_inst_radio(*args):
 			t = list(args)
 			#Argument 10 must be a double
@@ -231,8 +259,10 @@ if not DBG_MODE:
 		
 	def pb_close():
 		return spinapi.pb_close()
-	
-else:
+	return locals()
+
+def _debug_functions():
+	""" Stand-ins for the pb_ functions in TEST MODE. """
 	def pb_get_version():
 		return "1"
 	def pb_get_error():
@@ -257,6 +287,8 @@ else:
 		return 1
 	def pb_inst_pbonly(*args):
 		return 1
+	def pb_inst_pbonly_many(*args):
+		return [pb_inst_pbonly(*inst) for inst in zip(*args)]
 	def pb_inst_radio(*args):
 		return 1
 	def pb_inst_dds2(*args):
@@ -268,4 +300,18 @@ else:
 	def pb_reset():
 		return 1
 	def pb_close():
-		return 1
\ No newline at end of file
+		return 1
+	return locals()
+
+
+def _lazy(name):
+	def load_and_call(*args):
+		_load()
+		return globals()[name](*args)
+	load_and_call.__name__ = name
+	return load_and_call
+
+# Until the library is loaded each pb_ function is a stand-in which loads it
+# and then calls the real function (or its TEST MODE version).
+for _name in _debug_functions():
+	globals()[_name] = _lazy(_name)
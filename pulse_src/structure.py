@@ -0,0 +1,161 @@
+""" Structure strings, giving the order and repetitions of the children of
+a `StructuredSequence`, eg:
+
+    2, 3, 0, 4, (1, 5)^N, 6
+    0, (1, 2^N)^M, 3     # Comments run to the end of the line
+
+The grammar is
+
+    structure := term ("," term)*
+    term      := atom ("^" reps)?
+    atom      := index | "(" structure ")"
+    reps      := integer | name
+
+A structure is parsed once into a list of `Term`s, a tree which is walked
+to evaluate or compile the sequence:
+
+    >>> parse("0, (1, 2^N)^M")
+    [Term(0), Term([Term(1), Term(2, 'N')], 'M')]
+"""
+import re
+
+_TOKEN_RE = re.compile(r"""
+      (?P<space>\s+|\#[^\n]*)
+    | (?P<int>\d+)
+    | (?P<name>[A-Za-z_]\w*)
+    | (?P<punct>[,()^])
+    | (?P<bad>.)
+""", re.VERBOSE)
+
+
+class StructureError(ValueError):
+    def __init__(self, text, pos, msg):
+        self.text = text
+        self.pos = pos
+        super().__init__("%s at column %d of structure '%s'" % (msg, pos + 1, text))
+
+
+class Term:
+    """ Child number `body`, or the group of terms `body` if it is a list,
+    repeated `reps` times. `reps` is an int or the name of a parameter. """
+    __slots__ = ("body", "reps")
+
+    def __init__(self, body, reps=1):
+        self.body = body
+        self.reps = reps
+
+    def __repr__(self):
+        if self.reps == 1:
+            return "Term(%r)" % (self.body,)
+        return "Term(%r, %r)" % (self.body, self.reps)
+
+    def __eq__(self, other):
+        return isinstance(other, Term) and (self.body, self.reps) == (other.body, other.reps)
+
+    @property
+    def is_group(self):
+        return isinstance(self.body, list)
+
+
+def tokenize(text):
+    """ List of `(kind, value, column)` tokens in `text`, `kind` being "int",
+    "name" or "punct". """
+    tokens = []
+    for m in _TOKEN_RE.finditer(text):
+        kind = m.lastgroup
+        if kind == "space":
+            continue
+        if kind == "bad":
+            raise StructureError(text, m.start(), "Unexpected character '%s'" % m.group())
+        value = int(m.group()) if kind == "int" else m.group()
+        tokens.append((kind, value, m.start()))
+    return tokens
+
+
+class _Parser:
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.i = 0
+
+    def peek(self):
+        if self.i < len(self.tokens):
+            return self.tokens[self.i]
+        return (None, None, len(self.text))
+
+    def next(self):
+        tok = self.peek()
+        self.i += 1
+        return tok
+
+    def expect(self, punct):
+        kind, value, pos = self.next()
+        if (kind, value) != ("punct", punct):
+            raise StructureError(self.text, pos, "Expected '%s'" % punct)
+
+    def parse(self):
+        terms = self.structure()
+        kind, value, pos = self.peek()
+        if kind is not None:
+            raise StructureError(self.text, pos, "Unexpected '%s'" % value)
+        return terms
+
+    def structure(self):
+        terms = [self.term()]
+        while self.peek()[:2] == ("punct", ","):
+            self.next()
+            terms.append(self.term())
+        return terms
+
+    def term(self):
+        kind, value, pos = self.next()
+        if kind == "int":
+            body = value
+        elif (kind, value) == ("punct", "("):
+            body = self.structure()
+            self.expect(")")
+        elif kind is None:
+            raise StructureError(self.text, pos, "Unexpected end of structure")
+        else:
+            raise StructureError(self.text, pos, "Expected a child number or '('")
+        reps = 1
+        if self.peek()[:2] == ("punct", "^"):
+            self.next()
+            kind, reps, pos = self.next()
+            if kind not in ("int", "name"):
+                raise StructureError(self.text, pos, "Expected a number of repetitions")
+        return Term(body, reps)
+
+
+def parse(text):
+    """ Parse the structure string `text` into a list of `Term`s. """
+    return _Parser(text).parse()
+
+
+def to_string(terms):
+    """ Inverse of `parse()`, without whitespace or comments. """
+    parts = []
+    for term in terms:
+        part = "(%s)" % to_string(term.body) if term.is_group else str(term.body)
+        if term.reps != 1:
+            part += "^%s" % term.reps
+        parts.append(part)
+    return ", ".join(parts)
+
+
+def walk(terms):
+    """ Yield every term, including those inside groups. """
+    for term in terms:
+        yield term
+        if term.is_group:
+            yield from walk(term.body)
+
+
+def indices(terms):
+    """ Set of the child numbers used anywhere in `terms`. """
+    return {term.body for term in walk(terms) if not term.is_group}
+
+
+def rep_names(terms):
+    """ Set of the repetitions parameters used anywhere in `terms`. """
+    return {term.reps for term in walk(terms) if type(term.reps) is str}
@@ -1,23 +1,16 @@
 from src.pulse_instance import PulseManager
-from .pulse_utils import RawSequence, AbstractSequence, SequenceProgram
-import re
+from . import compiler
+from .compiler import CompiledProgram
+from .pulse_utils import RawSequence, AbstractSequence, SequenceProgram, check_axes, merge_flag_words
+from . import structure as grammar
+import numpy as np
 
 def parse_complex_structure(children_list, structure):
     """ For parsing structures such as:
         structure="0, 1, (2, (0, 1)^M)^N, 3"
+    Groups are kept in the structure's tree, see `structure.parse()`.
     """
-    parts = re.split(r"\([\d\s\w\^,]*?\)", structure, maxsplit=1)
-    if len(parts) == 1:
-        # No more subparts
-        return StructuredSequence(*children_list, structure=structure)
-    else:
-        A, B = parts
-        An, Bn = len(A), len(B)
-        sub_str = structure[An+1:-(Bn+1)]
-        new_child = parse_complex_structure(children_list, sub_str)
-        new_n = len(children_list)
-        new_struct = A + str(new_n) + B
-        return parse_complex_structure(children_list + [new_child], new_struct)
+    return StructuredSequence(*children_list, structure=structure)
 
 
 
@@ -67,41 +60,32 @@ class StructuredSequence:
         Integers can also be used here to 
         set a fixed number of repetitions. Note that when parameters
         like these are being used, then a call to eval must specify the value of each.
+
+        Groups of children can be repeated too, eg "0, (1, 2^N)^M, 3". See
+        `structure.py` for the grammar. The structure is parsed once, into
+        the tree `self.tree`.
         """
-        self._rep_params = set()
         if structure is None:
-            self._struct_order = list(range(len(self.children)))
-            self._reps = [1 for _ in self.children]
-            return
-        terms = structure.split(',')
-        self._reps = []
-        self._struct_order = []
-        for t in terms:
-            t = t.strip()
-            if "^" in t:
-                # This is a repeated term
-                idx, reps = t.split("^")
-                idx = int(idx)
-                try: 
-                    reps = int(reps)
-                except:
-                    # Add the new parameter
-                    self._rep_params.add(reps)
-            else:
-                idx = int(t)
-                reps = 1
-            try:
-                self.children[idx]
-            except:
+            tree = [grammar.Term(i) for i in range(len(self.children))]
+        else:
+            tree = grammar.parse(structure)
+        for idx in grammar.indices(tree):
+            if idx >= len(self.children):
                 raise IndexError("Values in structure string must be valid indices, %d is invalid" % idx)
-            self._reps.append(reps)
-            self._struct_order.append(idx)
+        self._tree = tree
+        # Only the outermost repetitions, those in groups are in `params`
+        self._rep_params = {t.reps for t in tree if type(t.reps) is str}
         self._structure = structure
 
     @property
     def rep_params(self):
         return list(self._rep_params)
 
+    @property
+    def tree(self):
+        """ The parsed structure, a list of `structure.Term`. """
+        return self._tree
+
     @property
     def structure(self):
         return self._structure
@@ -113,6 +97,7 @@ class StructuredSequence:
     @property
     def params(self):
         params = {k:None for k in self.rep_params}
+        params.update({k:None for k in grammar.rep_names(self._tree)})
         params.update(self.c_params)
         # for c in self.children:
         #     try:
@@ -121,6 +106,21 @@ class StructuredSequence:
         #         pass
         return params
 
+    @property
+    def used_params(self):
+        """ Set of parameters which are used by the structure or by any
+        of the children included in it. """
+        return self._used_params(self._tree)
+
+    def _used_params(self, terms):
+        used = grammar.rep_names(terms)
+        for idx in grammar.indices(terms):
+            try:
+                used.update(self.children[idx].used_params)
+            except AttributeError:
+                pass
+        return used
+
     @property
     def c_params(self):
         """ Parameters only of the children. No repetition parameters included."""
@@ -135,7 +135,8 @@ class StructuredSequence:
 
 
     def eval(self, **kw_params) -> RawSequence:
-        total = None
+        # Collect every evaluated child, then concatenate them all at once
+        parts = []
         # Check for lists
         list_params = {}
         for k, v in kw_params.items():
@@ -146,24 +147,160 @@ class StructuredSequence:
             else:
                 list_params[k] = v
                 kw_params[k] = v[0]
-        for idx, reps in zip(self._struct_order, self._reps):
+        self._eval_parts(self._tree, kw_params, list_params, parts)
+        if not parts:
+            return None
+        return RawSequence.concat_all(parts)
+
+    def _eval_parts(self, terms, kw_params, list_params, parts):
+        """ Append the evaluated children of `terms` to `parts`, in order. """
+        for term in terms:
+            reps = _reps_value(term.reps, kw_params)
+            if term.is_group:
+                if not list_params:
+                    group = []
+                    self._eval_parts(term.body, kw_params, {}, group)
+                    parts.extend(group * reps)
+                    continue
+                for i in range(reps):
+                    new_kw = kw_params.copy()
+                    new_kw.update({k:v[i] for k, v in list_params.items()})
+                    self._eval_parts(term.body, new_kw, {}, parts)
+                continue
             # Get the relevant child.
-            child = self.children[idx]
+            child = self.children[term.body]
             if not list_params:
                 c = child.eval(**kw_params)
-            
-            if type(reps) is str:
-                try:
-                    reps = int(kw_params[reps])
-                except KeyError:
-                    raise ValueError("Value for repetitions parameter %s must be supplied." % reps)
-            for i in range(reps):
-                if list_params:
+                parts.extend([c] * reps)
+            elif isinstance(child, AbstractSequence):
+                # Evaluate every repetition at once
+                new_kw = kw_params.copy()
+                new_kw.update({k:[v[i] for i in range(reps)] for k, v in list_params.items()})
+                if reps > 0:
+                    c = child.eval_many(**new_kw)
+                    parts.extend(c if len(c) == reps else c * reps)
+            else:
+                for i in range(reps):
+                    new_kw = kw_params.copy()
+                    new_kw.update({k:v[i] for k, v in list_params.items()})
+                    parts.append(child.eval(**new_kw))
+
+    def compile(self, end_action=None, loops=False, subroutines=False,
+                **kw_params) -> CompiledProgram:
+        """ Evaluate the sequence with the given parameters (see `eval()`)
+        and compile it into a `CompiledProgram`.
+
+        If `loops=True` (default `False`), repetitions are programmed as
+        hardware loops instead of being unrolled, wherever every repetition
+        is the same (ie no list parameters used by the repeated child vary
+        between repetitions). The output is the same, but with far fewer
+        instructions.
+
+        If `subroutines=True` (default `False`), blocks that occur several
+        times in the program are programmed once as a subroutine and called
+        with JSR/RTS instead of being repeated.
+        """
+        if not (loops or subroutines):
+            prog = self.eval(**kw_params).compile(end_action=end_action)
+        else:
+            info = {"bit_names": {}, "used_flags": set()}
+            items = _end_as_eval(self._compile_items(kw_params, info))
+            prog = compiler.link(items, end_action=end_action,
+                loops=loops, subroutines=subroutines,
+                bit_names=info["bit_names"], used_flags=sorted(info["used_flags"]))
+        if self.controller is not None:
+            prog.set_controller(self.controller)
+        return prog
+
+    def sweep(self, axes, n_steps=None, end_action=None, loops=True, subroutines=False,
+              **kw_params) -> CompiledProgram:
+        """ Compile a scan over parameter values, with one step for each
+        repetition of the structure's repetitions parameter (eg `N` in
+        "0, 1^N, 2"), which is set to the number of steps.
+
+        `axes` maps parameter names to a value for each step, see
+        `pulse_utils.sweep_axes()`. The number of steps is the length of the axes, or
+        `n_steps` if no parameters are swept. Other parameters are given as
+        keyword arguments. See `compile()` for `loops` and `subroutines`.
+
+        Returns a `CompiledProgram` with the start time and length (ns) of
+        each step in `step_starts` and `step_lengths`, and the axes in `axes`.
+        """
+        if len(self.rep_params) != 1:
+            raise ValueError("A sweep needs exactly one repetitions parameter, not %s" % self.rep_params)
+        step_param = self.rep_params[0]
+        axes, n_steps = check_axes(axes, n_steps)
+        params = dict(kw_params)
+        params.update(axes)
+        params[step_param] = n_steps
+        info = {"bit_names": {}, "used_flags": set()}
+        steps = {"param": step_param}
+        items = _end_as_eval(self._compile_items(params, info, steps=steps))
+        prog = compiler.link(items, end_action=end_action,
+            loops=loops, subroutines=subroutines,
+            bit_names=info["bit_names"], used_flags=sorted(info["used_flags"]))
+        prog.step_lengths = np.array(steps["lengths"], dtype=np.float64)
+        prog.step_starts = steps["start"] + np.concatenate([[0], np.cumsum(prog.step_lengths)[:-1]])
+        prog.axes = axes
+        if self.controller is not None:
+            prog.set_controller(self.controller)
+        return prog
+
+    def _compile_items(self, kw_params, info, steps=None, terms=None):
+        """ Evaluate the structure (or `terms` of it) as a list of
+        `compiler.Frames` and `compiler.Loop` blocks, walking the structure's
+        tree. `info` collects bit names and used flags.
+
+        If `steps` is a dict, the start time of the repetitions of
+        `steps["param"]` and the length of each are added to it. """
+        if terms is None:
+            terms = self._tree
+        kw_params = kw_params.copy()
+        list_params = {}
+        for k, v in kw_params.items():
+            try:
+                v[0]
+            except:
+                continue
+            else:
+                list_params[k] = v
+                kw_params[k] = v[0]
+        items = []
+        for term in terms:
+            is_step = steps is not None and term.reps == steps["param"]
+            if is_step:
+                if "start" in steps:
+                    raise ValueError("The sweep parameter %s repeats more than one child." % term.reps)
+                steps["start"] = compiler.duration(items)
+            reps = _reps_value(term.reps, kw_params)
+            if term.is_group:
+                used = self._used_params(term.body)
+            else:
+                child = self.children[term.body]
+                used = child.used_params
+            varying = list_params and not used.isdisjoint(list_params)
+            if not varying:
+                if term.is_group:
+                    body = self._compile_items(kw_params, info, terms=term.body)
+                else:
+                    body = _child_items(child, kw_params, info)
+                items.append(compiler.Loop(body, reps))
+                if is_step:
+                    steps["lengths"] = [compiler.duration(body)] * reps
+                continue
+            if term.is_group:
+                reps_items = []
+                for i in range(reps):
                     new_kw = kw_params.copy()
                     new_kw.update({k:v[i] for k, v in list_params.items()})
-                    c = child.eval(**new_kw)
-                total = total + c
-        return total
+                    reps_items.append(self._compile_items(new_kw, info, terms=term.body))
+            else:
+                reps_items = _child_items_many(child, kw_params, list_params, reps, info)
+            for rep in reps_items:
+                items.extend(rep)
+            if is_step:
+                steps["lengths"] = [compiler.duration(rep) for rep in reps_items]
+        return items
 
     def program_seq(self, end_action=None, **kw_params):
         try:
@@ -179,6 +316,12 @@ class StructuredSequence:
         for c in self.children:
             c.set_controller(controller)
 
+    def __getstate__(self):
+        # The controller belongs to this process, and can not be pickled
+        state = self.__dict__.copy()
+        state["controller"] = None
+        return state
+
     def set_param_default(self, **kw_params):
         for c in self.children:
             c.set_param_default(**kw_params)
@@ -194,5 +337,106 @@ class StructuredSequence:
     def stop(self):
         self.controller.stop()
 
+def _reps_value(reps, kw_params):
+    """ Number of repetitions, looking up `reps` in `kw_params` if it is a
+    parameter name. """
+    if type(reps) is str:
+        try:
+            return int(kw_params[reps])
+        except KeyError:
+            raise ValueError("Value for repetitions parameter %s must be supplied." % reps)
+    return reps
+
+def _child_items(child, kw_params, info):
+    if isinstance(child, StructuredSequence):
+        return child._compile_items(kw_params, info)
+    return _raw_items(child.eval(**kw_params), info)
+
+def _child_items_many(child, kw_params, list_params, reps, info):
+    """ Items for each of `reps` repetitions of `child`, repetition `i`
+    using element `i` of each list parameter. """
+    if isinstance(child, AbstractSequence) and reps > 0:
+        # Evaluate every repetition at once
+        new_kw = kw_params.copy()
+        new_kw.update({k:[v[i] for i in range(reps)] for k, v in list_params.items()})
+        raws = child.eval_many(**new_kw)
+        return [_raw_items(raw, info) for raw in (raws if len(raws) == reps else raws * reps)]
+    reps_items = []
+    for i in range(reps):
+        new_kw = kw_params.copy()
+        new_kw.update({k:v[i] for k, v in list_params.items()})
+        reps_items.append(_child_items(child, new_kw, info))
+    return reps_items
+
+def _raw_items(raw, info):
+    info["bit_names"].update(raw.bit_names)
+    info["used_flags"].update(raw.used_flags.tolist())
+    # Merge the child as it is in `eval()`, followed by another sequence
+    # (see `RawSequence.concat_all()`): flags left on are turned off, so
+    # that toggles which coincide cancel in the same way. Toggles at the
+    # end may cancel, so pad with all flags off to the child's length.
+    seqs = [np.append(seq, 0) if len(seq) % 2 else seq for seq in raw._flag_seq_list()]
+    t_ax, words = merge_flag_words(seqs)
+    gap = raw.length_ns - t_ax.sum() if len(t_ax) else raw.length_ns
+    if gap > 0:
+        t_ax = np.append(t_ax, gap)
+        words = np.append(words, np.zeros(1, dtype=words.dtype))
+    frames = compiler.Frames(t_ax, words)
+    frames.raw = raw    # For _end_as_eval()
+    return [frames]
+
+def _end_as_eval(items):
+    """ `items` with the children at the end merged as they are at the end
+    of `eval()`, where the last isn't followed by another sequence, the
+    last toggle of a flag left on is ignored and the program ends with the
+    last toggle. Children are taken from the end, and their iterations out
+    of any loops, until those toggles are among them. """
+    tail = []
+    while True:
+        items, frames = _pop_child(items)
+        if frames is None:
+            break
+        tail.insert(0, frames.raw)
+        seq = RawSequence.concat_all(tail)
+        t_ax, words = seq._merge_words()
+        if t_ax.sum() > 0 and _last_toggles_inside(seq):
+            break
+    if not tail:
+        return items
+    return items + [compiler.Frames(t_ax, words)]
+
+def _last_toggles_inside(seq):
+    """ Does every flag with an odd number of toggles in `seq` have one
+    after its start, which can't be cancelled by a toggle before `seq`? """
+    for bit in np.flatnonzero(seq._defined):
+        edges = seq._seq(bit)
+        if len(edges) % 2 == 0:
+            continue
+        times = np.cumsum(edges)
+        _, counts = np.unique(times[times > 0], return_counts=True)
+        if not (counts % 2).any():
+            return False
+    return True
+
+def _pop_child(items):
+    """ Split the frames of the last child off `items`. Returns the rest of
+    `items` and the frames, or `None` if there are none. """
+    items = list(items)
+    empty = []     # Loops with no iterations, left at the end
+    while items:
+        last = items.pop()
+        if isinstance(last, compiler.Loop):
+            if last.count <= 0:
+                empty.insert(0, last)
+                continue
+            if last.count > 1:
+                items.append(compiler.Loop(last.body, last.count - 1))
+            items.extend(last.body)
+        elif hasattr(last, "raw"):
+            return items + empty, last
+        else:
+            return items + [last] + empty, None
+    return empty, None
+
 if __name__ == "__main__":
     A = StructuredSequence(1, 2, 3, structure="0, 1^N, 0^M, 2")
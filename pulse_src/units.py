@@ -0,0 +1,78 @@
+""" Times written with units, eg "3000ns", "10 us" or "1.5ms", converted to
+nanoseconds.
+
+The common units of time are handled here directly. astropy is only
+imported, if it is installed, for anything else, and astropy Quantities
+are accepted wherever a time is:
+
+    >>> parse_time_ns("1.5us")
+    1500
+    >>> to_ns(2 * u.us)       # with astropy
+    2000
+"""
+import re
+from fractions import Fraction
+
+# Nanoseconds per unit
+UNITS = {"ps": Fraction(1, 1000), "ns": 1, "us": 1000, "µs": 1000, "ms": 10**6, "s": 10**9}
+
+_TIME_RE = re.compile(r"\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*([A-Za-zµ]*)\s*\Z")
+
+
+def unit_ns(unit):
+    """ Number of nanoseconds in one `unit`. Units not in `UNITS` are looked
+    up with astropy. Raises a ValueError if `unit` isn't a unit of time. """
+    try:
+        return UNITS[unit]
+    except KeyError:
+        pass
+    try:
+        from astropy import units as u
+    except ImportError:
+        raise ValueError("Unknown unit of time '%s'" % unit) from None
+    try:
+        return u.Unit(unit).to("ns")
+    except (ValueError, u.UnitsError):
+        raise ValueError("'%s' is not a unit of time" % unit) from None
+
+
+def parse_time_ns(text, rounding=True):
+    """ Read a time such as "3000ns", "10 us" or "200" (nanoseconds if no
+    unit is given) from `text`. The result is rounded to a whole number of
+    nanoseconds unless `rounding=False`.
+
+    Raises a ValueError if `text` is not a single number with an optional unit.
+    """
+    m = _TIME_RE.match(text)
+    if m is None:
+        raise ValueError("Could not read a time from '%s'" % text)
+    number, unit = m.groups()
+    if "." in number or "e" in number or "E" in number:
+        value = float(number)
+    else:
+        value = int(number)
+    if unit:
+        value = value * unit_ns(unit)
+    if rounding:
+        return round(value)
+    if isinstance(value, Fraction):
+        return float(value)
+    return value
+
+
+def to_ns(value):
+    """ Convert `value` to nanoseconds. Strings are read with
+    `parse_time_ns()` and astropy Quantities are converted, both rounded to
+    whole nanoseconds. Anything else is returned as it is. """
+    if isinstance(value, str):
+        return parse_time_ns(value)
+    try:
+        value.unit
+    except AttributeError:
+        return value
+    return round(value.to("ns").value)
+
+
+if __name__ == "__main__":
+    for text in ["3000ns", "10 us", "1.5ms", "200", "2.5", "1e3ps"]:
+        print("%-8s -> %s" % (text, parse_time_ns(text)))
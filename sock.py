@@ -1,10 +1,129 @@
+import asyncio
+import itertools
+import queue
 import socket as sc
+import struct
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future, TimeoutError as FutureTimeout
 from threading import Thread
 
+import numpy as np
+
 PORT = 33710
 HOST = "localhost"
 byte_order = "big"
 
+# Messages to and from the control server are framed with their length
+HEADER = struct.Struct(">I")
+MAX_FRAME = 1 << 20     # Longest frame accepted, bytes
+TELEMETRY_QUEUE = 100   # Telemetry messages kept by a client until read
+DATA_TIMEOUT = 60.0     # Seconds `get_data()` waits for a sequence to be programmed
+
+def pack_frame(payload):
+    """ `payload` (bytes) prefixed with its length, see `recv_frame()`. """
+    return HEADER.pack(len(payload)) + payload
+
+# Sent by a client as soon as it connects, so that the server knows it is
+# framed before any telemetry is sent. Its reply is ignored, as ids start at 1.
+_HELLO = pack_frame(b"0:STATUS")
+
+def recv_exactly(sock, n):
+    """ Read exactly `n` bytes from `sock`. Raises ConnectionError if the
+    stream ends first. """
+    data = b""
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if len(chunk) == 0:
+            raise ConnectionError("Stream ended")
+        data += chunk
+    return data
+
+def recv_frame(sock):
+    """ Read one frame from `sock` and return its payload. """
+    n, = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    if n > MAX_FRAME:
+        raise ConnectionError("Frame of %d bytes is too long" % n)
+    return recv_exactly(sock, n)
+
+# Telemetry about a newly programmed sequence, sent to framed clients:
+#   prefix      magic b"PBWX", version, size of the fixed part (bytes)
+#   fixed part  length (ns, uint64), instruction count, number of steps,
+#               number of axes (uint32 each)
+#   arrays      step start times and lengths (ns), n_steps float64 each,
+#               then for each axis its name (uint16 size + utf-8) and n_steps float64 values
+# all big-endian. Later versions only add to the end of the fixed part, so
+# older decoders can skip what they don't know. Version 1 sent the length as
+# a float64, which is still decoded.
+TELEMETRY_MAGIC = b"PBWX"
+TELEMETRY_VERSION = 2
+_TELEMETRY_PREFIX = struct.Struct(">4sHH")
+_TELEMETRY_FIXED = struct.Struct(">QIII")
+_TELEMETRY_FIXED_V1 = struct.Struct(">dIII")
+_NAME_SIZE = struct.Struct(">H")
+_FLOATS = np.dtype(">f8")
+
+Telemetry = namedtuple("Telemetry",
+    "version length_ns inst_count step_starts step_lengths axes")
+
+def encode_telemetry(program):
+    """ Telemetry message for `program`, a `CompiledProgram` or any pulse
+    with `length_ns`. The steps and axes are those of a swept program (see
+    `StructuredSequence.sweep()`), and left empty for any other. """
+    starts = getattr(program, "step_starts", None)
+    if starts is None:
+        starts, lengths, axes = [], [], {}
+    else:
+        lengths, axes = program.step_lengths, program.axes
+    n_steps = len(starts)
+    parts = [
+        _TELEMETRY_PREFIX.pack(TELEMETRY_MAGIC, TELEMETRY_VERSION, _TELEMETRY_FIXED.size),
+        _TELEMETRY_FIXED.pack(int(round(program.length_ns)), getattr(program, "inst_count", 0),
+            n_steps, len(axes)),
+        np.asarray(starts, dtype=_FLOATS).tobytes(),
+        np.asarray(lengths, dtype=_FLOATS).tobytes(),
+    ]
+    for name, values in axes.items():
+        name = name.encode()
+        values = np.broadcast_to(np.asarray(values, dtype=_FLOATS), n_steps)
+        parts += [_NAME_SIZE.pack(len(name)), name, values.tobytes()]
+    return b"".join(parts)
+
+def is_telemetry(payload):
+    return payload[:len(TELEMETRY_MAGIC)] == TELEMETRY_MAGIC
+
+def decode_telemetry(payload):
+    """ Read a message from `encode_telemetry()` into a `Telemetry`, with
+    the arrays as float64 numpy arrays and `axes` a dict of name to array.
+    Raises a ValueError if `payload` is not a telemetry message. """
+    if not is_telemetry(payload):
+        raise ValueError("Not a telemetry message")
+    try:
+        magic, version, fixed_size = _TELEMETRY_PREFIX.unpack_from(payload)
+        pos = _TELEMETRY_PREFIX.size
+        fixed = _TELEMETRY_FIXED_V1 if version < 2 else _TELEMETRY_FIXED
+        length_ns, inst_count, n_steps, n_axes = fixed.unpack_from(payload, pos)
+        length_ns = int(length_ns)
+        pos += fixed_size
+        def floats():
+            nonlocal pos
+            values = np.frombuffer(payload, dtype=_FLOATS, count=n_steps, offset=pos)
+            pos += values.nbytes
+            return values.astype(np.float64)
+        starts = floats()
+        lengths = floats()
+        axes = {}
+        for _ in range(n_axes):
+            size, = _NAME_SIZE.unpack_from(payload, pos)
+            pos += _NAME_SIZE.size
+            name = payload[pos:pos + size].decode()
+            pos += size
+            axes[name] = floats()
+    except (struct.error, ValueError) as e:
+        raise ValueError("Telemetry message is truncated or corrupt: %s" % e) from None
+    return Telemetry(version, length_ns, inst_count, starts, lengths, axes)
+
 class _ReceiverThread(Thread):
     def __init__(self, start_func, stop_func, **kwargs):
         super(_ReceiverThread, self).__init__(group=None)
@@ -25,19 +144,22 @@ class PulseCommunicator:
     def do_connect(self):
         try:
             self.sock.connect((HOST, PORT))
-        except Exception as e:
+        except OSError as e:
             print("Unable to connect to %s:%d"%(HOST, PORT))
             raise e
 
     def send_info(self, raw_seq, acq_delay=0):
-        # Send pulse length:
-        length = raw_seq.length_ns
-        length = int(length).to_bytes(16, byte_order)
+        # Send telemetry about the pulse, framed as by the control server
+        message = pack_frame(encode_telemetry(raw_seq))
         try:
-            self.sock.send(length)
-        except:
+            self.sock.sendall(message)
+        except OSError:
+            # Not connected yet or the connection was lost, and a socket
+            # can only be connected once
+            self.sock.close()
+            self.sock = sc.socket()
             self.do_connect()
-            self.sock.send(length)
+            self.sock.sendall(message)
 
 
     def __enter__(self):
@@ -66,50 +188,390 @@ class MockClient:
         print("Connection received from:", addr)
         print("Displaying all received data:")
         while True:
-            a = conn.recv(32)
-            if len(a) == 0:
+            try:
+                telemetry = decode_telemetry(recv_frame(conn))
+            except ConnectionError:
                 break
-            a = int.from_bytes(a, byte_order)
-            print(a)
+            print(telemetry)
         print("Stream ended.")
     
     def __del__(self):
         self.sock.close()
     
 
-# TODO: Replace old _conn variables with client
+class CommandError(Exception):
+    """ The control server replied with an error. """
+
+
+def _reply_result(reply):
+    """ The result in reply `reply` to a command, eg "running" from
+    "OK STATUS running", or raise a CommandError for an error reply. """
+    status, _, rest = reply.partition(" ")
+    if status != "OK":
+        raise CommandError(rest or reply)
+    return rest.partition(" ")[2]
+
+
+class PulseClient:
+    def __init__(self, host=HOST, port=PORT, timeout=5.0, retries=5, backoff=0.05,
+                 max_backoff=2.0):
+        """ Connection to the control server (see src/control_server.py),
+        made when first needed and kept for every request.
+
+        A connection which fails is made again, waiting `backoff` seconds
+        after the first failed attempt and twice as long after each one
+        after, up to `max_backoff` seconds, for `retries` attempts. A STATUS
+        request is sent on connecting, so that the server sends telemetry
+        (see `next_telemetry()`) before any other command.
+
+        Commands carry an id which the server gives to its reply, so several
+        can be sent before any reply has arrived with `submit()`:
+
+            >>> with PulseClient() as client:
+            ...     replies = [client.submit("STOP") for _ in range(100)]
+            ...     [reply.result() for reply in replies]
+            ...     client.status()
+            'stopped'
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sock = None
+        self._lock = threading.Lock()   # Held to connect or send
+        self._ids = itertools.count(1)
+        self._pending = {}  # id -> (future, socket it was sent on)
+        self._telemetry = queue.Queue(maxsize=TELEMETRY_QUEUE)
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def connect(self):
+        """ Connect, if not already connected. Raises ConnectionError if
+        every attempt fails. """
+        with self._lock:
+            self._connect()
+
+    def _connect(self):
+        if self.sock is not None:
+            return
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(delay)
+                delay = min(2 * delay, self.max_backoff)
+            try:
+                sock = sc.create_connection((self.host, self.port), timeout=self.timeout)
+                sock.sendall(_HELLO)
+            except OSError as e:
+                error = e
+                continue
+            sock.setsockopt(sc.IPPROTO_TCP, sc.TCP_NODELAY, 1)
+            sock.settimeout(None)
+            self.sock = sock
+            Thread(target=self._read, args=(sock,), name="pulse client", daemon=True).start()
+            return
+        raise ConnectionError("Unable to connect to %s:%d: %s" % (self.host, self.port, error))
+
+    def _drop(self, sock, error):
+        """ Forget `sock` and fail the requests waiting for a reply on it. """
+        with self._lock:
+            if self.sock is sock:
+                self.sock = None
+        sock.close()
+        for ident, (future, sent_on) in list(self._pending.items()):
+            if sent_on is sock and self._pending.pop(ident, None) is not None:
+                future.set_exception(ConnectionError("Connection lost: %s" % error))
+
+    def _read(self, sock):
+        try:
+            while True:
+                payload = recv_frame(sock)
+                if is_telemetry(payload):
+                    _put_latest(self._telemetry, decode_telemetry(payload))
+                    continue
+                ident, _, reply = payload.decode(errors="replace").partition(":")
+                future, _ = self._pending.pop(ident, (None, None))
+                if future is None:
+                    continue
+                try:
+                    future.set_result(_reply_result(reply))
+                except CommandError as e:
+                    future.set_exception(e)
+        except (OSError, ValueError) as e:
+            self._drop(sock, e)
+
+    def submit(self, command):
+        """ Send `command` and return a `concurrent.futures.Future` for the
+        result in its reply (see `request()`), without waiting for it. """
+        return self._submit(command)[1]
+
+    def _submit(self, command):
+        ident = str(next(self._ids))
+        future = Future()
+        message = pack_frame(("%s:%s" % (ident, command)).encode())
+        with self._lock:
+            # A dropped connection is often only noticed when sending, the
+            # command can then be sent again as it never arrived
+            for attempt in range(2):
+                self._connect()
+                sock = self.sock
+                self._pending[ident] = (future, sock)
+                try:
+                    sock.sendall(message)
+                    return ident, future
+                except OSError as e:
+                    error = e
+                    self._pending.pop(ident, None)
+                    self.sock = None
+                    sock.close()
+        raise ConnectionError("Unable to send %s: %s" % (command, error))
+
+    def request(self, command, timeout=None):
+        """ Send `command` and wait for the reply, returning the result in
+        it, eg "running" for STATUS or "" for START. Raises a CommandError if
+        the server replies with an error, and ConnectionError if the
+        connection is lost before the reply arrives. """
+        ident, future = self._submit(command)
+        try:
+            return future.result(self.timeout if timeout is None else timeout)
+        except FutureTimeout:
+            self._pending.pop(ident, None)
+            raise TimeoutError("No reply to %s" % command) from None
+
+    def start(self):
+        self.request("START")
+
+    def stop(self):
+        self.request("STOP")
+
+    def status(self):
+        """ "running" or "stopped". """
+        return self.request("STATUS")
+
+    def next_telemetry(self, timeout=None):
+        """ Wait for the telemetry of the next sequence programmed (see
+        `decode_telemetry()`). Only the latest `TELEMETRY_QUEUE` are kept
+        until read. """
+        try:
+            return self._telemetry.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError("No telemetry received") from None
+
+    def close(self):
+        with self._lock:
+            sock, self.sock = self.sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(sc.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+
+class AsyncPulseClient:
+    def __init__(self, host=HOST, port=PORT, timeout=5.0, retries=5, backoff=0.05,
+                 max_backoff=2.0):
+        """ The asyncio version of `PulseClient`, with the same arguments:
+
+            >>> async with AsyncPulseClient() as client:
+            ...     await asyncio.gather(*[client.request("STOP") for _ in range(100)])
+            ...     await client.status()
+            'stopped'
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.writer = None
+        self._reader = None
+        self._lock = None
+        self._ids = itertools.count(1)
+        self._pending = {}  # id -> (future, writer it was sent on)
+        self._telemetry = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def connect(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+            self._telemetry = asyncio.Queue(maxsize=TELEMETRY_QUEUE)
+        async with self._lock:
+            await self._connect()
+
+    async def _connect(self):
+        if self.writer is not None:
+            return
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(delay)
+                delay = min(2 * delay, self.max_backoff)
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port), self.timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                error = e
+                continue
+            writer.get_extra_info("socket").setsockopt(sc.IPPROTO_TCP, sc.TCP_NODELAY, 1)
+            writer.write(_HELLO)
+            self.writer = writer
+            self._reader = asyncio.ensure_future(self._read(reader, writer))
+            return
+        raise ConnectionError("Unable to connect to %s:%d: %s" % (self.host, self.port, error))
+
+    def _drop(self, writer, error):
+        if self.writer is writer:
+            self.writer = None
+        writer.close()
+        for ident, (future, sent_on) in list(self._pending.items()):
+            if sent_on is writer:
+                del self._pending[ident]
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection lost: %s" % error))
+
+    async def _read(self, reader, writer):
+        try:
+            while True:
+                n, = HEADER.unpack(await reader.readexactly(HEADER.size))
+                if n > MAX_FRAME:
+                    raise ConnectionError("Frame of %d bytes is too long" % n)
+                payload = await reader.readexactly(n)
+                if is_telemetry(payload):
+                    _put_latest(self._telemetry, decode_telemetry(payload))
+                    continue
+                ident, _, reply = payload.decode(errors="replace").partition(":")
+                future, _ = self._pending.pop(ident, (None, None))
+                if future is None or future.done():
+                    continue
+                try:
+                    future.set_result(_reply_result(reply))
+                except CommandError as e:
+                    future.set_exception(e)
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            self._drop(writer, e)
+
+    async def submit(self, command):
+        """ Send `command` and return an asyncio future for the result in
+        its reply, see `PulseClient.submit()`. """
+        return (await self._submit(command))[1]
+
+    async def _submit(self, command):
+        if self._lock is None:
+            await self.connect()
+        ident = str(next(self._ids))
+        future = asyncio.get_running_loop().create_future()
+        message = pack_frame(("%s:%s" % (ident, command)).encode())
+        async with self._lock:
+            for attempt in range(2):
+                await self._connect()
+                writer = self.writer
+                self._pending[ident] = (future, writer)
+                try:
+                    writer.write(message)
+                    await writer.drain()
+                    return ident, future
+                except OSError as e:
+                    error = e
+                    self._pending.pop(ident, None)
+                    self.writer = None
+                    writer.close()
+        raise ConnectionError("Unable to send %s: %s" % (command, error))
+
+    async def request(self, command, timeout=None):
+        """ See `PulseClient.request()`. """
+        ident, future = await self._submit(command)
+        try:
+            return await asyncio.wait_for(future, self.timeout if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            self._pending.pop(ident, None)
+            raise TimeoutError("No reply to %s" % command) from None
+
+    async def start(self):
+        await self.request("START")
+
+    async def stop(self):
+        await self.request("STOP")
+
+    async def status(self):
+        return await self.request("STATUS")
+
+    async def next_telemetry(self, timeout=None):
+        if self._telemetry is None:
+            await self.connect()
+        try:
+            return await asyncio.wait_for(self._telemetry.get(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("No telemetry received") from None
+
+    async def close(self):
+        writer, self.writer = self.writer, None
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+
+def _put_latest(q, item):
+    """ Put `item` in the queue `q`, dropping the oldest item if it is full. """
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except (queue.Full, asyncio.QueueFull):
+            try:
+                q.get_nowait()
+            except (queue.Empty, asyncio.QueueEmpty):
+                pass
+
+
+# Shared client used by the functions below
 _client = None
-_conn = None
 def establish_client(force=False):
-    global _client, _conn
+    """ The shared `PulseClient`, connected. A new one is made if
+    `force=True`. """
+    global _client
     if _client is None or force:
-        _client = sc.socket()
-        _client.connect((HOST,PORT))
-        # Try connect
-        _conn, addr = _client, None
+        if _client is not None:
+            _client.close()
+        _client = PulseClient()
+    _client.connect()
+    return _client
     
-def get_data(byte_order=byte_order, n_bytes=16):
-    establish_client()
-    byts = _conn.recv(n_bytes)
-    num = int.from_bytes(byts, byte_order)
-    return num
+def get_data(byte_order=byte_order, n_bytes=16, timeout=DATA_TIMEOUT):
+    """ Wait for the next sequence to be programmed and return its length
+    in ns. Raises a TimeoutError if none is within `timeout` seconds.
+    (`byte_order` and `n_bytes` are no longer used.) """
+    return int(establish_client().next_telemetry(timeout).length_ns)
 
 def send_start():
-    establish_client()
-    _conn.send(b"START")
+    establish_client().start()
 
 
 def send_stop():
-    establish_client()
-    _conn.send(b"STOP")
+    establish_client().stop()
 
 def send_exit():
-    establish_client()
-    _conn.send(b"EXIT")
+    establish_client().request("EXIT")
 
 def send_bytes(bytes):
-    establish_client()
-    _conn.send(bytes)
+    """ Send `bytes` as one message, returning the result in the reply. """
+    return establish_client().request(bytes.decode())
 
 # def test_server():
 #     with PulseCommunicator() as pc:
@@ -2,11 +2,12 @@ import os
 import tkinter as tk
 import tkinter.ttk as ttk
 
-from pulse_src import load_pulse as loader
+from pulse_src.program_cache import CACHE
 
 from src.extras import parse_val
 
 from .pulse_instance import PulseManager, PulseManagerException
+from . import PulseFrames
 from .PulseFrames import RepetitionsFrame
 
 _SelPF_instance = None
@@ -42,7 +43,7 @@ class SelectPulseFrame(tk.LabelFrame):
         path = self.root_folder + "/" + self.selected_file.get()
         try:
             with open(path, "r") as f:
-                self.pulse = loader.read_pulse_file(path)
+                self.pulse = CACHE.read_pulse_file(path)
                 self.pulse.set_controller(self.pls_controller)
         except Exception as e:
             self.main.indicate_error()
@@ -191,8 +192,7 @@ class SetParameterFrame(tk.LabelFrame):
         self.pulse.plot_sequence(**self.params)
 
     def prog_and_start(self, *args, stopping=True):
-        self.program_pulse()
-        self.start_seq()
+        self.program_pulse(start=True)
 
     # @staticmethod
     # def program_a_pulse(pulse, params, *args, stopping=False):
@@ -206,40 +206,38 @@ class SetParameterFrame(tk.LabelFrame):
 
 
 
-    def program_pulse(self, *args, pulse=None, stopping=False):
-        original = PulseManager.get_pulse()
+    def program_pulse(self, *args, pulse=None, stopping=False, start=False):
+        """ Compile and program the pulse with the current parameters in the
+        background, and start it if `start=True`. """
         if pulse is None:
             pulse = self.pulse
-        raw_pulse = pulse.eval(**self.params)
-        try:
-            PulseManager.set_pulse(raw_pulse, notify=False)
-            PulseManager.program(stopping=True)
-            PulseManager.set_pulse(original, notify=False) 
-        except Exception as e:
-            self.main.indicate_error()
-            raise e
+        params = self.params.copy()
+        compile_pulse = lambda job: pulse.compile(loops=PulseFrames.HW_LOOPS,
+            subroutines=PulseFrames.HW_SUBROUTINES, **params)
+        self.main.jobs.submit("program", compile_pulse,
+            board=lambda job, raw_pulse: PulseManager.program_compiled(raw_pulse, start=start),
+            on_error=self.job_failed)
+
+    def job_failed(self, e):
+        print("Error: %s" % e)
+        self.main.indicate_error()
 
     def start_seq(self, *args):
+        self.main.jobs.run_on_board(self._start, on_error=self.job_failed)
+
+    @staticmethod
+    def _start():
         try:
             PulseManager.start()
         except PulseManagerException:
-            try:
-                PulseManager.start(allow_controller_start=True)
-            except PulseManagerException as e:
-                self.main.indicate_error()
-                raise e
-            else:
-                print("Starting sequence (Note: Starting Unknown Sequence)")
+            PulseManager.start(allow_controller_start=True)
+            print("Starting sequence (Note: Starting Unknown Sequence)")
         else:
             print("Starting sequence")
 
     def stop_seq(self, *args):
         print("Stopping sequence")
-        try:
-            PulseManager.stop()
-        except Exception as e:
-            self.main.indicate_error()
-            raise e
+        self.main.jobs.run_on_board(PulseManager.stop, on_error=self.job_failed)
 
             
 
@@ -1,4 +1,6 @@
+import threading
 import numpy as np
+from pulse_src.pulse_utils import sweep_axes
 from src.extras import parse_val
 from src.pulse_instance import PulseManager
 import tkinter as tk
@@ -10,6 +12,10 @@ WIDTH = 1 # Will be set from main.py
 HEIGHT = 1
 
 PARAM_SAVE_FOLDER = "./saved_params/"
+# Program constant repetitions as hardware loops, and repeated blocks once
+# as JSR/RTS subroutines. Off until the layout has been checked on the board
+HW_LOOPS = False
+HW_SUBROUTINES = False
 class PulseShapeFrame(ttk.Frame):
     def __init__(self, parent, **kwargs):
         global _PSF_instance
@@ -56,6 +62,10 @@ class RepetitionsFrame(tk.LabelFrame):
         self.progression_type = tk.StringVar(self, "LIN") # LIN or LOG
         self.end_vars = {}
         self.start_vars = {}
+        # Compiled program shared by the Program, Plot and Save Pulse buttons
+        # as (pulse, key, program), compiled on a worker thread
+        self._compiled = None
+        self._compiled_lock = threading.Lock()
         self.init_UI()
         PulseManager.register(self)
         _RF_instance = self
@@ -165,7 +175,7 @@ class RepetitionsFrame(tk.LabelFrame):
         f_name = PARAM_SAVE_FOLDER + f_name
 
         # Get pulse
-        pulse = self.eval_pulse()
+        pulse = self.compile_pulse()
         try:
             pulse.save_txt(f_name)
         except IOError as e:
@@ -253,32 +263,58 @@ class RepetitionsFrame(tk.LabelFrame):
                 self.to_remove.append(lbl)
                 self.to_remove.append(box)
                 self.to_remove.append(set_lbl)
-    def program_seq(self):
+    def program_seq(self, start=False):
+        """ Compile the pulse with the current repetition settings and
+        program it (and start it if `start=True`), in the background. A
+        previous request which hasn't been programmed yet is cancelled. """
         # End values are in self.end_vars
         # If any are less than the original, that one is constant
-        # Boxes.SetParameterFrame.program_pulse_reps(
-        #     n_reps=int(self.reps_num.get()), 
-        original = PulseManager.get_pulse()
-        pulse = self.eval_pulse()
-        try:
-            PulseManager.set_pulse(pulse, notify=False)
-            PulseManager.program(stopping=True)
-            # Restore previous pulse
-            PulseManager.set_pulse(original, notify=False)
-        except Exception as e:
-            self.main.indicate_error()
-            raise e
+        pulse_obj = PulseManager.get_pulse()
+        # Read the settings here, tk variables can't be used from other threads
+        these_params = self.sweep_params(pulse_obj)
+        self.main.jobs.submit("program",
+            lambda job: self._compile(pulse_obj, these_params),
+            board=lambda job, pulse: PulseManager.program_compiled(pulse, start=start),
+            on_error=self.job_failed)
 
     def prog_and_start(self, *args):
-        self.program_seq()
-        try:
-            PulseManager.start()
-        except Exception as e:
-            self.main.indicate_error()
-            raise e
+        self.program_seq(start=True)
+
+    def job_failed(self, e):
+        print("Unable to program sequence: %s" % e)
+        self.main.indicate_error()
 
     def eval_pulse(self):
         pulse_obj = PulseManager.get_pulse()
+        these_params = self.sweep_params(pulse_obj)
+        pulse = pulse_obj.eval(**these_params)
+        return pulse
+
+    def compile_pulse(self):
+        """ Evaluate and compile the pulse with the current repetition settings.
+        The same compiled program is returned until the pulse or any of its
+        parameters change. """
+        pulse_obj = PulseManager.get_pulse()
+        return self._compile(pulse_obj, self.sweep_params(pulse_obj))
+
+    def _compile(self, pulse_obj, these_params):
+        these_params = these_params.copy()
+        key = tuple((k, tuple(np.ravel(v).tolist())) for k, v in sorted(these_params.items()))
+        with self._compiled_lock:
+            compiled = self._compiled
+        if compiled is not None and compiled[0] is pulse_obj and compiled[1] == key:
+            return compiled[2]
+        n_reps = these_params.pop(pulse_obj.rep_params[0])
+        axes = {k: these_params.pop(k) for k in list(these_params) if np.ndim(these_params[k])}
+        program = pulse_obj.sweep(axes, n_steps=n_reps, loops=HW_LOOPS,
+            subroutines=HW_SUBROUTINES, **these_params)
+        with self._compiled_lock:
+            self._compiled = (pulse_obj, key, program)
+        return program
+
+    def sweep_params(self, pulse_obj):
+        """ Build the parameters for evaluating `pulse_obj`, with an axis
+        for each parameter being swept. """
         try:
             rep_params = pulse_obj.rep_params
             # print(rep_params)
@@ -305,11 +341,6 @@ class RepetitionsFrame(tk.LabelFrame):
         print("end:", end_vars)
         print("Num reps:", n_reps)
 
-        if rep_mode == 'LIN':
-            axis_f = np.linspace
-        else:
-            axis_f = lambda start, stop, *args, **kwargs: np.logspace(*np.log10([start, stop]), *args, **kwargs)
-
         for key in end_vars:
             if key not in these_params: continue
             if end_vars[key] == 0: continue
@@ -317,18 +348,16 @@ class RepetitionsFrame(tk.LabelFrame):
             if end_vars[key] != these_params[key]:
                 try:
                     print("Making axis for:", key)
-                    axis = axis_f(these_params[key], end_vars[key], n_reps, dtype=int)
+                    axis = sweep_axes({key: (rep_mode, these_params[key], end_vars[key])}, n_reps, dtype=int)
                 except:
                     print("Unable to create axis for %s" % key)
                     continue
                 else:
-                    these_params[key] = axis
-
-        pulse = pulse_obj.eval(**these_params)
-        return pulse
+                    these_params.update(axis)
+        return these_params
 
     def plot_sequence(self):
-        pulse = self.eval_pulse()
+        pulse = self.compile_pulse()
         print(f"Pulse length: {pulse.length_ns/1e6:.2} ms / {pulse.inst_count} instructions")
         pulse.plot_sequence()
         
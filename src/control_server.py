@@ -0,0 +1,270 @@
+""" The control server which LabVIEW (and scripts, see sock.py) connect to,
+to start and stop the sequence and be told the length of new programs.
+
+It runs an asyncio event loop in its own thread, alongside Tk, and serves
+any number of clients at once. Messages are framed with their length, a 4
+byte big-endian integer (see `sock.pack_frame()`):
+
+    client -> server    b"START", b"STOP", b"STATUS" or b"EXIT"
+    server -> client    b"OK <command>[ <result>]" or b"ERR <message>" in reply,
+                        telemetry (`sock.encode_telemetry()`) when a sequence is programmed
+
+A command may be prefixed with an id, eg b"12:STOP", which is then given
+to its reply, eg b"12:OK STOP", so that a client can send several
+commands before reading the replies (see `sock.PulseClient`).
+
+Commands are passed to `on_command` as soon as they are read. If it
+returns a `concurrent.futures.Future`, eg of a job on the board thread, the
+reply waits for it, so that b"OK START" is only sent once the sequence has
+started and a failure is sent as b"ERR <message>". The commands of a client
+are acted on one at a time, in order. EXIT closes the connection of the
+client which sent it.
+
+Clients which send bare commands, as LabVIEW always has, are recognised by
+their first byte (a frame starts with a 0 byte, as frames are short) and
+are served as before: commands are found in the stream, even when split
+across reads, nothing is sent in reply and the length of a new program is
+sent as bare 16 bytes. Until its first byte arrives a client is served as
+legacy, as LabVIEW may connect and only wait for the length, so framed
+clients send a command straight away (see `sock.PulseClient`).
+"""
+import asyncio
+import concurrent.futures
+import socket
+import threading
+
+from sock import HOST, PORT, HEADER, MAX_FRAME, encode_telemetry, pack_frame
+
+COMMANDS = ("START", "STOP", "STATUS", "EXIT")
+_LEGACY_COMMANDS = [b"START", b"STOP", b"EXIT"]
+_LEGACY_TAIL = max(len(c) for c in _LEGACY_COMMANDS) - 1
+
+
+def _ok(command, result):
+    if result is None:
+        return "OK %s" % command
+    return "OK %s %s" % (command, result)
+
+
+class _Client:
+    def __init__(self, writer, framed):
+        self.writer = writer
+        self.framed = framed
+        self.closing = False
+        self.waiting = None     # Future of the reply being waited for
+        self.task = asyncio.current_task()
+
+    def __repr__(self):
+        host, port = self.writer.get_extra_info("peername")[:2]
+        return "%s:%d (%s)" % (host, port, "framed" if self.framed else "legacy")
+
+
+class ControlServer(threading.Thread):
+    def __init__(self, connected_var=None, on_command=None, host=HOST, port=PORT):
+        """ Server for control clients, listening on `host:port` once
+        started. `on_command(command)` is called, on the server thread, with
+        "START", "STOP" or "STATUS" when a client sends it, and anything it
+        returns, or the result of a `concurrent.futures.Future` it returns,
+        is added to the reply. `connected_var` (a tk variable) is set
+        to whether any client is connected. """
+        super(ControlServer, self).__init__(name="control server", daemon=True)
+        # Bind now, so that a port in use is an error straight away
+        self.socket = socket.socket()
+        # As asyncio does, so the app can be restarted straight away
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.host, self.port = self.socket.getsockname()[:2]
+        self.connected_var = connected_var
+        self.on_command = on_command
+        self.clients = set()
+        self.loop = None
+        self.killed = False
+        self._listening = threading.Event()
+        # Notified when a client connects or leaves, or a wait is cancelled
+        self._state_changed = threading.Condition()
+        self._wait_cancelled = False
+
+    @property
+    def con_alive(self):
+        """ Is any client connected? """
+        return len(self.clients) > 0
+
+    def run(self):
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self._listening.set()
+            self.socket.close()
+
+    async def _serve(self):
+        self._stopping = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self._handle, sock=self.socket)
+        print("Control server listening on %s:%d" % (self.host, self.port))
+        self._listening.set()
+        async with server:
+            if not self.killed:
+                await self._stopping.wait()
+            clients = list(self.clients)
+            for client in clients:
+                client.writer.close()
+                # A handler may be waiting on the board rather than reading
+                if client.waiting is not None:
+                    client.waiting.cancel()
+            # Let the handlers see their connection close
+            await asyncio.gather(*[client.task for client in clients], return_exceptions=True)
+        print("Control server stopped.")
+
+    def wait_listening(self, timeout=None):
+        """ Block until the server is accepting connections. """
+        return self._listening.wait(timeout)
+
+    def kill(self):
+        """ Stop the server and close every connection, from any thread. """
+        with self._state_changed:
+            self.killed = True
+            self._state_changed.notify_all()
+        if self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self._stopping.set)
+            except RuntimeError:
+                # The loop has already closed
+                pass
+        elif not self.is_alive():
+            self.socket.close()
+
+    def _connection_changed(self):
+        with self._state_changed:
+            self._state_changed.notify_all()
+        if self.connected_var is not None:
+            try:
+                self.connected_var.set(self.con_alive)
+            except RuntimeError as e:
+                print("Unable to set connection status: " + str(e))
+
+    def wait_connected(self, timeout=None):
+        """ Block until a client is connected, `cancel_wait()` is called or
+        `timeout` seconds have passed. Returns whether a client is connected. """
+        with self._state_changed:
+            self._state_changed.wait_for(
+                lambda: self.con_alive or self._wait_cancelled or self.killed, timeout)
+            self._wait_cancelled = False
+            return self.con_alive
+
+    def cancel_wait(self):
+        """ Wake up `wait_connected()`, from any thread. """
+        with self._state_changed:
+            self._wait_cancelled = True
+            self._state_changed.notify_all()
+
+    async def _handle(self, reader, writer):
+        # A client is legacy until it sends a frame: LabVIEW connects and
+        # waits for the length of a program without sending anything
+        client = _Client(writer, framed=False)
+        self.clients.add(client)
+        self._connection_changed()
+        print("Control client connected: %s" % client)
+        try:
+            first = await reader.readexactly(1)
+            client.framed = first == b"\0"
+            if client.framed:
+                await self._read_frames(reader, client, first)
+            else:
+                await self._read_legacy(reader, client, first)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients.discard(client)
+            writer.close()
+            self._connection_changed()
+            print("Control client disconnected: %s" % client)
+
+    async def _read_frames(self, reader, client, first):
+        header = first + await reader.readexactly(HEADER.size - 1)
+        while True:
+            n, = HEADER.unpack(header)
+            if n > MAX_FRAME:
+                print("Frame of %d bytes from %s is too long, disconnecting" % (n, client))
+                return
+            payload = await reader.readexactly(n)
+            ident, sep, command = payload.decode(errors="replace").strip().rpartition(":")
+            reply = ident + sep + await self._reply(command, client)
+            client.writer.write(pack_frame(reply.encode()))
+            if client.closing:
+                await client.writer.drain()
+                return
+            header = await reader.readexactly(HEADER.size)
+
+    async def _read_legacy(self, reader, client, first):
+        buffer = first
+        while True:
+            # Commands in the order they arrived, keeping the end of the
+            # buffer in case a command has only partly arrived
+            while True:
+                found = [(buffer.find(c), c) for c in _LEGACY_COMMANDS if c in buffer]
+                if not found:
+                    break
+                pos, command = min(found)
+                buffer = buffer[pos + len(command):]
+                self._dispatch(command.decode(), client)
+                if client.closing:
+                    return
+            buffer = buffer[-_LEGACY_TAIL:]
+            data = await reader.read(256)
+            if len(data) == 0:
+                return
+            buffer += data
+
+    async def _reply(self, command, client):
+        """ Act on `command` from `client` and return the reply, once any
+        future `on_command` returned is done. """
+        reply = self._dispatch(command, client)
+        if not isinstance(reply, concurrent.futures.Future):
+            return reply
+        client.waiting = asyncio.wrap_future(reply)
+        try:
+            result = await client.waiting
+        except asyncio.CancelledError:
+            return "ERR server stopped"
+        except Exception as e:
+            print("Failed to act on %s: %s" % (command, e))
+            return "ERR %s" % (str(e) or type(e).__name__)
+        finally:
+            client.waiting = None
+        return _ok(command, result)
+
+    def _dispatch(self, command, client):
+        """ Act on `command` from `client` and return the reply, or the
+        `concurrent.futures.Future` `on_command` returned, whose result is
+        added to it. """
+        if command not in COMMANDS:
+            print("Received unknown message: %s" % command)
+            return "ERR unknown command %s" % command
+        if command != "STATUS":
+            print("Received %s request" % command.lower())
+        result = None
+        if command == "EXIT":
+            client.closing = True
+        elif self.on_command is not None:
+            try:
+                result = self.on_command(command)
+            except Exception as e:
+                print("Failed to act on %s: %s" % (command, e))
+                return "ERR %s" % e
+        if isinstance(result, concurrent.futures.Future):
+            return result
+        return _ok(command, result)
+
+    def send_info(self, raw_seq, byte_order="big"):
+        """ Send telemetry about `raw_seq` to every client, or just its length
+        to legacy clients, from any thread. """
+        if not self.con_alive or self.loop is None:
+            print("No connection to send data on yet")
+            return
+        length = int(raw_seq.length_ns).to_bytes(16, byte_order)
+        telemetry = pack_frame(encode_telemetry(raw_seq))
+        self.loop.call_soon_threadsafe(self._send_all, telemetry, length)
+
+    def _send_all(self, telemetry, length):
+        for client in self.clients:
+            client.writer.write(telemetry if client.framed else length)
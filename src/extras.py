@@ -1,4 +1,4 @@
-from astropy import units as u
+from pulse_src.units import parse_time_ns
 
 def parse_val(val, out_as=None, out_type=None, assume=None, rounding=False, round_digits=None):
     """ Parse a string written with units. 
@@ -10,20 +10,31 @@ def parse_val(val, out_as=None, out_type=None, assume=None, rounding=False, roun
     
     If `assume` is set, then that unit is assumed if none provided in the input.
 
+    Times converted to nanoseconds are read without astropy, which is
+    otherwise needed.
     """
-    
-    q = u.Quantity(val)
-    if str(q.unit) == "":
-        q *= u.ns
+    q = None
+    if out_as == "ns" and type(val) is str:
+        try:
+            q = parse_time_ns(val, rounding=False)
+        except ValueError:
+            # Left to astropy, which may know the unit
+            pass
 
-    if type(out_as) is str:
-        out_as = u.Unit(out_as)
+    if q is None:
+        from astropy import units as u
+        q = u.Quantity(val)
+        if str(q.unit) == "":
+            q *= u.ns
 
-    if out_as is not None:
-        try:
-            q = q.to(out_as).value
-        except:
-            raise ValueError("Output unit %s is not compatible with input unit %s" % (out_as, q.unit)) 
+        if type(out_as) is str:
+            out_as = u.Unit(out_as)
+
+        if out_as is not None:
+            try:
+                q = q.to(out_as).value
+            except:
+                raise ValueError("Output unit %s is not compatible with input unit %s" % (out_as, q.unit))
 
     if rounding:
         try:
@@ -32,5 +43,5 @@ def parse_val(val, out_as=None, out_type=None, assume=None, rounding=False, roun
             pass
     if out_type is not None:
         q = out_type(q)
-    
+
     return q
@@ -0,0 +1,205 @@
+""" Running slow work (evaluating, compiling and programming pulses) off the
+Tk main thread, so the interface stays responsive.
+
+A job has up to two stages:
+    compute(job)            run in a thread pool, eg evaluate and compile
+    board(job, result)      run on the single board thread, eg program
+and its callbacks (`on_done`, `on_error`, `on_progress`) are called back on
+the Tk thread, which polls for them with `after()`.
+
+All use of the board should go through the board thread, so only one
+thread ever talks to the board:
+
+    >>> jobs = JobExecutor(root)
+    >>> jobs.submit("program", lambda job: pulse.compile(N=100),
+    ...     board=lambda job, prog: PulseManager.program_compiled(prog))
+
+Submitting a job with the same name as one still waiting or being computed
+cancels the old one, so only the latest settings get programmed.
+"""
+import queue
+import threading
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+
+N_WORKERS = 2   # Threads for the compute stage
+POLL_MS = 20    # How often the Tk thread checks for callbacks, ms
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, executor, name, on_progress=None):
+        self.executor = executor
+        self.name = name
+        self.on_progress = on_progress
+        self._cancelled = threading.Event()
+        self.done = threading.Event()
+        # Result of the last stage, for threads other than Tk to wait on
+        self.future = Future()
+
+    def __repr__(self):
+        return "<Job %s%s>" % (self.name, " (cancelled)" if self.cancelled else "")
+
+    def cancel(self):
+        """ Stop the job at the start of its next stage. A board stage which
+        has already started runs to the end. """
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check(self):
+        """ Raise `JobCancelled` if the job has been cancelled, for long
+        stages to call now and then. """
+        if self.cancelled:
+            raise JobCancelled()
+
+    def progress(self, message):
+        """ Report progress, passed to `on_progress` on the Tk thread. """
+        if self.on_progress is not None:
+            self.executor.post(self.on_progress, message)
+
+
+class JobExecutor:
+    def __init__(self, root, workers=N_WORKERS, poll_ms=POLL_MS):
+        """ Executor whose callbacks are run by the Tk widget `root`. """
+        self.root = root
+        self.poll_ms = poll_ms
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="compute")
+        self._board = ThreadPoolExecutor(max_workers=1, thread_name_prefix="board")
+        self._board_thread = None
+        self._callbacks = queue.Queue()
+        self._latest = {}   # Name -> latest job with that name
+        self._closed = False
+        self.root.after(self.poll_ms, self._poll)
+
+    def _poll(self):
+        while True:
+            try:
+                f, args = self._callbacks.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                f(*args)
+            except Exception:
+                traceback.print_exc()
+        if not self._closed:
+            self.root.after(self.poll_ms, self._poll)
+
+    def post(self, f, *args):
+        """ Call `f(*args)` on the Tk thread, from any thread. """
+        self._callbacks.put((f, args))
+
+    def call_on_main(self, f, *args):
+        """ Call `f(*args)` on the Tk thread and wait for the result. """
+        if threading.current_thread() is threading.main_thread():
+            return f(*args)
+        done = threading.Event()
+        out = {}
+        def call():
+            try:
+                out["value"] = f(*args)
+            except Exception as e:
+                out["error"] = e
+            finally:
+                done.set()
+        self.post(call)
+        while not done.wait(0.1):
+            if self._closed:
+                raise JobCancelled()
+        if "error" in out:
+            raise out["error"]
+        return out["value"]
+
+    def on_board_thread(self):
+        return threading.current_thread() is self._board_thread
+
+    def _run_board(self, f, *args):
+        self._board_thread = threading.current_thread()
+        return f(*args)
+
+    def submit(self, name, compute=None, board=None, on_done=None, on_error=None,
+               on_progress=None) -> Job:
+        """ Run `compute(job)` in the thread pool, then `board(job, result)`
+        on the board thread with its result, then `on_done(result)` on the
+        Tk thread with the result of the last stage. If a stage raises an
+        exception other than `JobCancelled`, `on_error(exception)` is called
+        on the Tk thread instead (or the exception is printed). Either is
+        also set on `job.future`, a `concurrent.futures.Future`; cancelling
+        it only stops the wait, not the job.
+
+        An earlier job called `name` is cancelled, unless `name` is None.
+        """
+        job = Job(self, name, on_progress)
+        if name is not None:
+            previous = self._latest.get(name)
+            if previous is not None and not previous.done.is_set():
+                print("Cancelling superseded job %s" % name)
+                previous.cancel()
+            self._latest[name] = job
+
+        def finish(result=None, error=None):
+            job.done.set()
+            # Unless whoever was waiting on it has given up
+            waited = job.future.set_running_or_notify_cancel()
+            if error is None:
+                if waited:
+                    job.future.set_result(result)
+                if on_done is not None:
+                    self.post(on_done, result)
+                return
+            if waited:
+                job.future.set_exception(error)
+            if isinstance(error, JobCancelled):
+                print("Job %s cancelled" % name)
+            elif on_error is not None:
+                self.post(on_error, error)
+            else:
+                traceback.print_exception(type(error), error, error.__traceback__)
+
+        def board_stage(result):
+            try:
+                job.check()
+                if board is not None:
+                    result = board(job, result)
+            except BaseException as e:
+                finish(error=e)
+            else:
+                finish(result)
+
+        def compute_stage():
+            try:
+                job.check()
+                result = compute(job) if compute is not None else None
+                job.check()
+            except BaseException as e:
+                finish(error=e)
+            else:
+                self._board.submit(self._run_board, board_stage, result)
+
+        if compute is None:
+            # Straight to the board, keeping the order jobs are submitted in
+            self._board.submit(self._run_board, board_stage, None)
+        else:
+            self._pool.submit(compute_stage)
+        return job
+
+    def run_on_board(self, f, *args, on_done=None, on_error=None):
+        """ Call `f(*args)` on the board thread, see `submit()`. """
+        return self.submit(None, board=lambda job, _: f(*args),
+            on_done=on_done, on_error=on_error)
+
+    def cancel_all(self):
+        for job in self._latest.values():
+            job.cancel()
+
+    def shutdown(self):
+        """ Cancel everything and stop the threads, without waiting. """
+        self._closed = True
+        self.cancel_all()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._board.shutdown(wait=False, cancel_futures=True)
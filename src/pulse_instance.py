@@ -1,5 +1,6 @@
+import threading
 from enum import Enum
-from pulse_src.pulse_utils import PulseBlasterError, RawSequence, SequenceProgram, init_board
+from pulse_src.pulse_utils import PulseBlasterError, RawSequence, SequenceProgram
     
 
 class PulseManagerException(Exception):
@@ -11,6 +12,11 @@ _instance = None
 class PulseManager:
     """ Singleton instance for the PulseManager class. """
     pulse_name = None
+    # Called with a function to run it on the main (Tk) thread, set by the app
+    call_on_main = None
+    # Called after the PREPROGRAM event, on the thread programming, to wait
+    # until the program may be written. Raises an exception to not program.
+    wait_ready = None
 
     Event = Enum(
         value="Event",
@@ -20,9 +26,10 @@ class PulseManager:
         global _instance
         if _instance is not None:
             raise PulseManagerException("Cannot initialise multiple instances of PulseManager.")
-        init_board()
+        # The board is initialised when it is first used, see `check_board_init()`
         self.pulse = pulse
         self.controller = controller
+        self.programmed = None
         self.observers = []
         self.vars = {}
         # self.pulse_name = None
@@ -35,6 +42,11 @@ class PulseManager:
     #     return _instance
 
     def notify(self, event=None, data=None):
+        if PulseManager.call_on_main is not None and \
+                threading.current_thread() is not threading.main_thread():
+            # Observers are widgets, which can only be used from the main thread
+            PulseManager.call_on_main(lambda: self.notify(event=event, data=data))
+            return
         for obj in self.observers:
             obj.notify(event=event, data=data)
 
@@ -94,28 +106,54 @@ class PulseManager:
             _instance.notify(event=PulseManager.Event.CONTROLLER)
 
     @staticmethod
-    def program(*args, notify=True, stopping=False, **kwargs):
-        """ Call `program_seq(*args, **kwargs)` on the attached pulse object.
+    def program(*args, notify=True, stopping=False, pulse=None, **kwargs):
+        """ Call `program_seq(*args, **kwargs)` on the attached pulse object,
+        or on `pulse` if given.
         
         if `notify=True` (default), then notify all observers, first with an
         EVENT.PREPROGRAM event before programming, and then with an Event.PROGRAM event
         after programming, with `data` being set to the return value of the program call.
+        `wait_ready()` is called after the PREPROGRAM event, if it is set.
 
         if `stopping=True` (default `False`), then `stop()` will be called first, without notifying.
         """
         if notify:
             _instance.notify(event=PulseManager.Event.PREPROGRAM)
+            if PulseManager.wait_ready is not None:
+                PulseManager.wait_ready()
         if stopping:
             _instance.stop(notify=False)
+        if pulse is None:
+            pulse = _instance.pulse
+        elif _instance.controller is not None:
+            pulse.set_controller(_instance.controller)
         err = None
         try:
-            _instance.pulse.program_seq(*args, **kwargs)
+            pulse.program_seq(*args, **kwargs)
+            _instance.programmed = pulse
         except PulseBlasterError as e:
             err = e
             print("Programming failed, Error: %s, message: %s" % (type(e), e))
         finally:
             if notify:            
                 _instance.notify(event=PulseManager.Event.PROGRAM, data=err)
+        return err
+
+    @staticmethod
+    def program_compiled(program, start=False, notify=True):
+        """ Program `program`, eg a `CompiledProgram`, instead of the attached
+        pulse, which is left attached. If `start=True` (default `False`) it
+        is started too, once programmed; an error programming it is raised. """
+        err = PulseManager.program(notify=notify, stopping=True, pulse=program)
+        if err is not None:
+            raise err
+        if start:
+            PulseManager.start(notify=notify, allow_controller_start=True)
+
+    @staticmethod
+    def get_programmed():
+        """ The pulse most recently programmed successfully. """
+        return _instance.programmed
 
     @staticmethod
     def start(notify=True, allow_controller_start=False):
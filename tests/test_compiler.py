@@ -0,0 +1,15 @@
+from pulse_src import pulse_utils as pu
+from pulse_src.compiler import MAX_LOOP_COUNT
+from pulse_src.structured_seq import StructuredSequence
+
+
+def test_loop_split_into_max_count_chunks():
+    # Each chunk of a loop longer than MAX_LOOP_COUNT must be kept when the
+    # chunks are themselves repeated
+    a = pu.AbstractSequence(None)
+    a.add_seq(0, [30, 20, 50])
+    b = pu.AbstractSequence(None)
+    b.add_seq(1, [100])
+    seq = StructuredSequence(a, b, structure="(0^%d)^3" % (2 * MAX_LOOP_COUNT))
+    prog = seq.compile(loops=True)
+    assert prog.length_ns == 3 * 2 * MAX_LOOP_COUNT * 100
@@ -0,0 +1,78 @@
+import concurrent.futures
+import socket
+import time
+
+import pytest
+
+from sock import pack_frame, recv_exactly, recv_frame
+from src.control_server import ControlServer
+
+
+@pytest.fixture
+def board():
+    # Futures from on_command, completed by the test as a board job would be
+    futures = []
+    def on_command(command):
+        if command == "STATUS":
+            return "stopped"
+        futures.append(concurrent.futures.Future())
+        return futures[-1]
+    server = ControlServer(on_command=on_command, host="127.0.0.1", port=0)
+    server.start()
+    server.wait_listening()
+    sock = socket.create_connection((server.host, server.port), timeout=5)
+    yield sock, futures
+    sock.close()
+    server.kill()
+    server.join(5)
+
+
+def wait_for(futures, n):
+    for _ in range(500):
+        if len(futures) >= n:
+            return
+        time.sleep(0.01)
+    raise AssertionError("command not dispatched")
+
+
+def test_reply_waits_for_the_board(board):
+    sock, futures = board
+    sock.sendall(pack_frame(b"1:START"))
+    wait_for(futures, 1)
+    sock.settimeout(0.1)
+    with pytest.raises(socket.timeout):
+        recv_frame(sock)
+    sock.settimeout(5)
+    futures[0].set_result(None)
+    assert recv_frame(sock) == b"1:OK START"
+    sock.sendall(pack_frame(b"STATUS"))
+    assert recv_frame(sock) == b"OK STATUS stopped"
+
+
+def test_board_failure_reaches_the_client(board):
+    sock, futures = board
+    sock.sendall(pack_frame(b"2:STOP"))
+    wait_for(futures, 1)
+    futures[0].set_exception(RuntimeError("board not found"))
+    assert recv_frame(sock) == b"2:ERR board not found"
+
+
+class Program:
+    length_ns = 1234
+
+
+def test_legacy_client_which_only_reads():
+    # As LabVIEW does: connect, send nothing, wait for the program length
+    server = ControlServer(host="127.0.0.1", port=0)
+    server.start()
+    server.wait_listening()
+    sock = socket.create_connection((server.host, server.port), timeout=5)
+    try:
+        assert server.wait_connected(5)
+        server.send_info(Program())
+        assert recv_exactly(sock, 16) == (1234).to_bytes(16, "big")
+    finally:
+        sock.close()
+        server.kill()
+        server.join(5)
+    assert not server.is_alive()
@@ -0,0 +1,65 @@
+from fractions import Fraction
+
+import pytest
+
+from pulse_src import expressions, pulse_utils as pu
+from pulse_src.expressions import ExpressionError, Linear, linear
+
+
+@pytest.mark.parametrize("text, const, terms", [
+    ("tau", 0, {"tau": 1}),
+    ("pi_h+tau", 0, {"pi_h": 1, "tau": 1}),
+    ("tau+pi+tau+tau+pi+tau", 0, {"tau": 4, "pi": 2}),
+    ("2*(tau+pi) - 10ns", -10, {"tau": 2, "pi": 2}),
+    ("1.5us/2 + pi/4", 750, {"pi": Fraction(1, 4)}),
+    ("-(tau - 20)", 20, {"tau": -1}),
+    ("tau - tau + 5", 5, {}),
+    ("(tau)*3/3", 0, {"tau": 1}),
+])
+def test_linear(text, const, terms):
+    expr = linear(text)
+    assert (expr.const, expr.terms) == (const, terms)
+
+
+def test_evaluate():
+    expr = linear("2*(tau+pi) - 10ns")
+    assert expr(tau=100, pi=80) == 350
+    assert expr.substitute(pi=80) == Linear(150, {"tau": 2})
+    assert linear("1.5us").is_const
+
+
+def test_division_gives_fractions_of_ns():
+    expr = linear("tau/3")
+    assert expr(tau=100) == Fraction(100, 3)
+    assert expr(tau=99) == 33
+    assert isinstance(expr(tau=99), int)
+
+
+def test_non_integer_ns_in_a_sequence():
+    seq = pu.AbstractSequence(None)
+    seq.add_seq(0, [10, "tau/3", "2*tau/3"])
+    raw = seq.eval(tau=100)
+    assert raw.length_ns == pytest.approx(110)
+    assert seq.eval(tau=99).length_ns == 109
+
+
+@pytest.mark.parametrize("text, pos", [
+    ("tau*pi", 3),
+    ("tau/pi", 3),
+    ("tau/0", 3),
+    ("tau+", 4),
+    ("(tau", 4),
+    ("tau)", 3),
+    ("2 tau", 2),
+    ("tau$", 3),
+    ("3parsecs", 1),
+])
+def test_errors(text, pos):
+    with pytest.raises(ExpressionError) as info:
+        linear(text)
+    assert info.value.pos == pos
+
+
+def test_symbols():
+    assert expressions.symbols("2*(tau+pi) - t0") == {"tau", "pi", "t0"}
+    assert expressions.symbols("10us") == set()
@@ -0,0 +1,80 @@
+import os
+
+import pytest
+
+from pulse_src import load_pulse
+from pulse_src.load_pulse import PulseFileError, parse_pulse_lines, read_pulse_file
+from pulse_src.structured_seq import StructuredSequence
+
+PULSES = os.path.join(os.path.dirname(__file__), os.pardir, "pulses")
+
+FILE = """=== Params ===
+tau : 20ns
+pol : 1.5us
+!=============
+0 (Trig) : 0 200 100  | 30us
+1 (Green): 0 pol      | 0 tau + 10 (tau)*2
+!=== Structure
+1, 0^N
+"""
+
+
+@pytest.mark.parametrize("text, words", [
+    ("0 200 100", [("0", 0), ("200", 2), ("100", 6)]),
+    ("tau + pi 20", [("tau+pi", 0), ("20", 9)]),
+    ("2 * (tau + 1) tau", [("2*(tau+1)", 0), ("tau", 14)]),
+    ("a | b,c", [("a", 0), ("|", 2), ("b", 4), ("c", 6)]),
+    ("1.5us - tau 10ns", [("1.5us-tau", 0), ("10ns", 12)]),
+    ("(tau)(pi)", [("(tau)", 0), ("(pi)", 5)]),
+])
+def test_sequence_words(text, words):
+    assert list(load_pulse._sequence_words(text)) == words
+
+
+def test_parse_lines():
+    pulse = parse_pulse_lines(FILE.splitlines(True))
+    assert isinstance(pulse, StructuredSequence)
+    assert pulse.params == {"tau": 20, "pol": 1500, "N": None}
+    raw = pulse.eval(N=2)
+    # Child 1 is 30us long (bit 1 is 0 + 30 + 40), child 0 is pol long
+    assert raw.length_ns == 30000 + 2 * 1500
+    assert raw.bit_names == {0: "Trig", 1: "Green"}
+
+
+def test_reads_lines_once():
+    # Any iterable of lines, which is not read past the structure
+    lines = iter(FILE.splitlines(True) + ["!=== Comments\n", "not a pulse file\n"])
+    parse_pulse_lines(lines)
+    assert next(lines) == "!=== Comments\n"
+
+
+@pytest.mark.parametrize("line, col", [
+    ("0 : 10 $ 20", 8),
+    ("0 : 10 tau*pi", 11),
+    ("0 : 10 (tau", 12),
+    ("x : 10", 1),
+])
+def test_error_line_and_column(line, col):
+    text = FILE.replace("0 (Trig) : 0 200 100  | 30us", line)
+    with pytest.raises(PulseFileError) as info:
+        parse_pulse_lines(text.splitlines(True), "test.pls")
+    assert (info.value.filename, info.value.line, info.value.col) == ("test.pls", 5, col)
+    assert str(info.value).startswith("test.pls:5:%d: " % col)
+
+
+def test_bad_parameter():
+    text = FILE.replace("pol : 1.5us", "pol : 1.5parsecs")
+    with pytest.raises(PulseFileError) as info:
+        parse_pulse_lines(text.splitlines(True))
+    assert info.value.line == 3
+
+
+def test_no_sequences():
+    with pytest.raises(PulseFileError):
+        parse_pulse_lines(["tau : 20\n", "!====\n"])
+
+
+def test_read_pulse_file():
+    pulse = read_pulse_file(os.path.join(PULSES, "Rabi.pls"))
+    assert pulse.params["tau"] == 20
+    assert pulse.eval(N=1).length_ns > 0
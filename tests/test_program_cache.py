@@ -0,0 +1,128 @@
+import os
+import pickle
+import shutil
+import threading
+
+import pytest
+
+from pulse_src import program_cache
+from pulse_src.program_cache import ProgramCache
+
+PULSES = os.path.join(os.path.dirname(__file__), os.pardir, "pulses")
+
+
+FILE = """tau : 20ns
+!=====
+0 : 100 tau 50
+!=== Structure
+"""
+
+
+@pytest.fixture
+def pulse_file(tmp_path):
+    filename = str(tmp_path / "test.pls")
+    with open(filename, "w") as f:
+        f.write(FILE)
+    return filename
+
+
+def rewrite(filename, text):
+    # With a different size, so the change is seen whatever the mtime resolution
+    with open(filename, "w") as f:
+        f.write(text)
+
+
+def test_hits_and_parameters(pulse_file):
+    cache = ProgramCache(cache_dir=None)
+    prog = cache.compile_file(pulse_file)
+    assert cache.compile_file(pulse_file, tau=20) is prog
+    assert cache.compile_file(pulse_file, tau=30) is not prog
+    assert cache.compile_file(pulse_file).length_ns == 170
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_changed_file_is_read_again(pulse_file):
+    cache = ProgramCache(cache_dir=None)
+    assert cache.compile_file(pulse_file).length_ns == 170
+    rewrite(pulse_file, FILE.replace("100 tau", "1000 tau"))
+    assert cache.compile_file(pulse_file).length_ns == 1070
+    rewrite(pulse_file, FILE.replace("tau : 20ns", "tau : 2000ns"))
+    assert cache.compile_file(pulse_file).length_ns == 2150
+
+
+def test_pulses_are_copies(pulse_file):
+    cache = ProgramCache(cache_dir=None)
+    pulse = cache.read_pulse_file(pulse_file)
+    pulse.set_param_default(tau=1000)
+    assert cache.read_pulse_file(pulse_file).params["tau"] == 20
+
+
+def test_eviction(pulse_file):
+    cache = ProgramCache(cache_dir=None)
+    cache.max_bytes = 3 * cache.compile_file(pulse_file).nbytes
+    for tau in range(20, 40):
+        cache.compile_file(pulse_file, tau=tau)
+    assert cache.nbytes <= cache.max_bytes
+    assert cache.compile_file(pulse_file, tau=39).length_ns == 189
+    hits = cache.hits
+    cache.compile_file(pulse_file, tau=20)
+    assert cache.hits == hits
+
+
+def test_sidecar(pulse_file):
+    ProgramCache().read_pulse_file(pulse_file)
+    assert os.path.exists(ProgramCache().sidecar(pulse_file))
+    cache = ProgramCache()
+    assert cache.read_pulse_file(pulse_file).params["tau"] == 20
+    assert cache.disk_hits == 1
+    # Not used once the file has changed
+    rewrite(pulse_file, FILE.replace("tau : 20ns", "tau : 25ns"))
+    cache = ProgramCache()
+    assert cache.read_pulse_file(pulse_file).params["tau"] == 25
+    assert cache.disk_hits == 0
+
+
+def test_sidecar_version(pulse_file, monkeypatch):
+    ProgramCache().read_pulse_file(pulse_file)
+    monkeypatch.setattr(program_cache, "DISK_VERSION", program_cache.DISK_VERSION + 1)
+    cache = ProgramCache()
+    cache.read_pulse_file(pulse_file)
+    assert cache.disk_hits == 0
+    # Saved again with the new version
+    cache = ProgramCache()
+    cache.read_pulse_file(pulse_file)
+    assert cache.disk_hits == 1
+
+
+def test_bad_sidecar_is_ignored(pulse_file):
+    cache = ProgramCache()
+    digest = cache.digest(pulse_file)
+    os.makedirs(os.path.dirname(cache.sidecar(pulse_file)))
+    with open(cache.sidecar(pulse_file), "wb") as f:
+        pickle.dump((program_cache.DISK_VERSION, digest, b"not a pickle"), f)
+    assert cache.read_pulse_file(pulse_file).params["tau"] == 20
+    assert cache.disk_hits == 0
+
+
+def test_threads_share_the_cache(tmp_path):
+    filename = str(tmp_path / "Rabi.pls")
+    shutil.copy(os.path.join(PULSES, "Rabi.pls"), filename)
+    cache = ProgramCache(cache_dir=None)
+    prog = cache.compile_file(filename, N=2)
+    # Room for a few programs, so that threads evict each other's
+    cache.max_bytes = 4 * prog.nbytes
+    errors = []
+    def compile_some(offset):
+        try:
+            for i in range(30):
+                cache.compile_file(filename, N=2, tau=20 + (offset + i) % 10)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=compile_some, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert cache.nbytes == sum(size for _, size in cache._entries.values())
+    assert cache.nbytes <= cache.max_bytes
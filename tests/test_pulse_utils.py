@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+
+from pulse_src import pulse_utils as pu
+from pulse_src.compiler import CompiledProgram
+from pulse_src.spinapi import Inst
+
+
+class Board:
+    """ Records what is sent to the board, in place of SpinAPI. """
+    def __init__(self):
+        self.writes = []
+
+    def pb_inst_pbonly_many(self, flags, inst, inst_data, length):
+        self.writes.append(list(zip(flags, inst, inst_data, length)))
+        return list(range(len(flags)))
+
+
+@pytest.fixture
+def board(monkeypatch):
+    board = Board()
+    monkeypatch.setattr(pu, "pb_inst_pbonly_many", board.pb_inst_pbonly_many)
+    monkeypatch.setattr(pu, "pb_start_programming", lambda target: None)
+    monkeypatch.setattr(pu, "pb_stop_programming", lambda: None)
+    monkeypatch.setattr(pu.SequenceProgram, "board_initialised", True)
+    monkeypatch.setattr(pu.SequenceProgram, "uploaded", None)
+    monkeypatch.setattr(pu, "LOG_PROG", False)
+    return board
+
+
+def program(flags, length, inst_data=None):
+    n = len(flags)
+    opcode = [Inst.CONTINUE] * (n - 1) + [Inst.BRANCH]
+    if inst_data is None:
+        inst_data = [0] * n
+    return CompiledProgram(flags, opcode, inst_data, length)
+
+
+def test_diff():
+    a = program([1, 2, 3, 4], [100, 100, 100, 100])
+    b = program([1, 2, 5, 4], [100, 200, 100, 100])
+    assert a.diff(b).tolist() == [1, 2]
+    assert a.diff(a).tolist() == []
+    # The shorter program branches at address 1, and has no 2 or 3
+    assert a.diff(program([1, 2], [100, 100])).tolist() == [1, 2, 3]
+
+
+def test_same_layout():
+    a = program([1, 2, 3], [100, 100, 100])
+    assert pu.SequenceProgram._same_layout(a, program([4, 5, 6], [10, 20, 30]))
+    assert not pu.SequenceProgram._same_layout(a, None)
+    assert not pu.SequenceProgram._same_layout(a, program([1, 2], [100, 100]))
+    assert not pu.SequenceProgram._same_layout(a, program([1, 2, 3], [100, 100, 100], [0, 0, 1]))
+
+
+def test_incremental_rewrites_the_prefix(board):
+    controller = pu.SequenceProgram("test")
+    a = program([1, 2, 3, 4], [100, 100, 100, 100])
+    controller.program(a, incremental=True)
+    assert len(board.writes[-1]) == 4
+    # Only address 1 changed, addresses 0 and 1 are rewritten
+    b = program([1, 6, 3, 4], [100, 100, 100, 100])
+    controller.program(b, incremental=True)
+    assert len(board.writes) == 2
+    written = board.writes[-1]
+    assert [w[0] & 0xFF for w in written] == [1, 6]
+    assert pu.SequenceProgram.uploaded is b
+    # What the controller thinks is on the board covers every instruction
+    assert (np.frombuffer(controller.inst_flags, dtype=np.uint32) & 0xFF).tolist() == [1, 6, 3, 4]
+    assert np.frombuffer(controller.inst_lengths).tolist() == [100] * 4
+
+
+def test_incremental_unchanged_program(board):
+    controller = pu.SequenceProgram("test")
+    a = program([1, 2, 3], [100, 100, 100])
+    controller.program(a, incremental=True)
+    assert controller.program(program([1, 2, 3], [100, 100, 100]), incremental=True) == []
+    assert len(board.writes) == 1
+
+
+def test_incremental_needs_the_same_layout(board):
+    controller = pu.SequenceProgram("test")
+    controller.program(program([1, 2, 3], [100, 100, 100]), incremental=True)
+    controller.program(program([1, 2, 5], [100, 100, 100], [0, 0, 1]), incremental=True)
+    assert len(board.writes[-1]) == 3
+
+
+def test_not_incremental_rewrites_everything(board):
+    controller = pu.SequenceProgram("test")
+    controller.program(program([1, 2, 3], [100, 100, 100]), incremental=False)
+    controller.program(program([1, 2, 5], [100, 100, 100]), incremental=False)
+    assert len(board.writes[-1]) == 3
+
+
+def test_program_checks_once(board, monkeypatch):
+    controller = pu.SequenceProgram("test")
+    calls = []
+    preflight = controller.preflight
+    def counted(*args, **kwargs):
+        calls.append(args)
+        return preflight(*args, **kwargs)
+    monkeypatch.setattr(controller, "preflight", counted)
+    # An instruction too short is extended, and flagged as long, once
+    controller.program(program([1, 2, 3], [100, 5, 100]))
+    assert len(calls) == 1
+    assert np.frombuffer(controller.inst_lengths).tolist() == [100, pu.MIN_TIME, 100]
+    assert [w[3] for w in board.writes[-1]] == [100, pu.MIN_TIME, 100]
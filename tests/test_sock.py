@@ -0,0 +1,173 @@
+import asyncio
+import concurrent.futures
+import socket
+import threading
+import time
+
+import pytest
+
+import sock
+from sock import AsyncPulseClient, PulseClient, decode_telemetry, encode_telemetry
+from src.control_server import ControlServer
+
+
+class Program:
+    length_ns = 1234
+
+
+@pytest.fixture
+def server():
+    # STOP waits on the board until the test finishes it
+    def on_command(command):
+        if command == "STOP":
+            server.stops.append(concurrent.futures.Future())
+            return server.stops[-1]
+        if command == "STATUS":
+            return "stopped"
+    server = ControlServer(on_command=on_command, host="127.0.0.1", port=0)
+    server.stops = []
+    server.start()
+    server.wait_listening()
+    yield server
+    server.kill()
+    server.join(5)
+
+
+def wait_framed(server):
+    for _ in range(500):
+        if any(client.framed for client in list(server.clients)):
+            return
+        time.sleep(0.01)
+    raise AssertionError("client not seen as framed")
+
+
+def test_telemetry_right_after_connecting(server):
+    with PulseClient(port=server.port, host=server.host) as client:
+        wait_framed(server)
+        server.send_info(Program())
+        assert client.next_telemetry(5).length_ns == 1234
+
+
+def test_request_timeout_forgets_the_request(server):
+    with PulseClient(port=server.port, host=server.host) as client:
+        with pytest.raises(TimeoutError):
+            client.request("STOP", timeout=0.1)
+        assert client._pending == {}
+        # The late reply is ignored
+        server.stops[0].set_result(None)
+        assert client.status() == "stopped"
+
+
+def test_async_request_timeout_forgets_the_request(server):
+    async def run():
+        async with AsyncPulseClient(port=server.port, host=server.host) as client:
+            with pytest.raises(TimeoutError):
+                await client.request("STOP", timeout=0.1)
+            assert client._pending == {}
+            server.stops[0].set_result(None)
+            return await client.status()
+    assert asyncio.run(run()) == "stopped"
+
+
+class Swept:
+    length_ns = 2**40 + 3
+    inst_count = 12
+    step_starts = [0, 100]
+    step_lengths = [100, 150]
+    axes = {"tau": [10, 20]}
+
+
+def test_telemetry_round_trip():
+    telemetry = decode_telemetry(encode_telemetry(Swept()))
+    assert telemetry.version == sock.TELEMETRY_VERSION
+    # Exactly, as an integer
+    assert telemetry.length_ns == 2**40 + 3
+    assert isinstance(telemetry.length_ns, int)
+    assert telemetry.inst_count == 12
+    assert telemetry.step_starts.tolist() == [0, 100]
+    assert telemetry.step_lengths.tolist() == [100, 150]
+    assert telemetry.axes["tau"].tolist() == [10, 20]
+
+
+def test_telemetry_version_1():
+    fixed = sock._TELEMETRY_FIXED_V1
+    message = (sock._TELEMETRY_PREFIX.pack(sock.TELEMETRY_MAGIC, 1, fixed.size)
+        + fixed.pack(1234.0, 5, 0, 0))
+    telemetry = decode_telemetry(message)
+    assert telemetry.length_ns == 1234
+    assert telemetry.step_starts.tolist() == []
+
+
+def test_pipelined_requests(server):
+    with PulseClient(port=server.port, host=server.host) as client:
+        replies = [client.submit(command) for command in ["STATUS", "START", "STATUS"] * 50]
+        assert [reply.result(5) for reply in replies] == ["stopped", "", "stopped"] * 50
+        assert client._pending == {}
+
+
+def test_async_gathered_requests(server):
+    async def run():
+        async with AsyncPulseClient(port=server.port, host=server.host) as client:
+            return await asyncio.gather(*[client.status() for _ in range(50)])
+    assert asyncio.run(run()) == ["stopped"] * 50
+
+
+def test_command_error(server):
+    with PulseClient(port=server.port, host=server.host) as client:
+        with pytest.raises(sock.CommandError):
+            client.request("JUMP")
+        assert client.status() == "stopped"
+
+
+def test_reconnects_after_server_restart(server):
+    client = PulseClient(port=server.port, host=server.host, backoff=0.01)
+    try:
+        assert client.status() == "stopped"
+        first = client.sock
+        server.kill()
+        server.join(5)
+        # The connection is dropped once its end is read
+        for _ in range(500):
+            if client.sock is None:
+                break
+            time.sleep(0.01)
+        assert client.sock is None
+        restarted = ControlServer(on_command=lambda command: "again", host=server.host,
+            port=server.port)
+        restarted.start()
+        restarted.wait_listening()
+        try:
+            assert client.status() == "again"
+            assert client.sock is not first
+        finally:
+            restarted.kill()
+            restarted.join(5)
+    finally:
+        client.close()
+
+
+def test_connect_retries(server):
+    port = server.port
+    server.kill()
+    server.join(5)
+    late = ControlServer(on_command=lambda command: "late", host="127.0.0.1", port=port)
+    # Not listening for the first few attempts
+    starter = threading.Timer(0.2, late.start)
+    starter.start()
+    client = PulseClient(port=port, host="127.0.0.1", retries=10, backoff=0.05, max_backoff=0.1)
+    try:
+        assert client.status() == "late"
+    finally:
+        client.close()
+        starter.join()
+        late.kill()
+        late.join(5)
+
+
+def test_connect_gives_up():
+    with socket.socket() as unused:
+        unused.bind(("127.0.0.1", 0))
+        port = unused.getsockname()[1]
+    client = PulseClient(port=port, host="127.0.0.1", retries=2, backoff=0.01)
+    with pytest.raises(ConnectionError):
+        client.connect()
@@ -0,0 +1,54 @@
+import pytest
+
+from pulse_src import pulse_utils as pu, structure
+from pulse_src.structure import StructureError, Term, parse
+from pulse_src.structured_seq import StructuredSequence
+
+
+@pytest.mark.parametrize("text, terms", [
+    ("0", [Term(0)]),
+    ("2, 3, 0, 4, (1, 5)^N, 6",
+        [Term(2), Term(3), Term(0), Term(4), Term([Term(1), Term(5)], "N"), Term(6)]),
+    ("0, (1, 2^N)^M", [Term(0), Term([Term(1), Term(2, "N")], "M")]),
+    ("((0^a, 1)^b)^3  # comment", [Term([Term([Term(0, "a"), Term(1)], "b")], 3)]),
+    ("0 ,1^ 4", [Term(0), Term(1, 4)]),
+])
+def test_parse(text, terms):
+    assert parse(text) == terms
+    assert parse(structure.to_string(terms)) == terms
+
+
+@pytest.mark.parametrize("text, pos", [
+    ("", 0),
+    ("0,", 2),
+    ("0, (1, 2", 8),
+    ("0 1", 2),
+    ("0^", 2),
+    ("0^(1)", 2),
+    ("a", 0),
+    ("0, $", 3),
+    ("(0))", 3),
+])
+def test_errors(text, pos):
+    with pytest.raises(StructureError) as info:
+        parse(text)
+    assert info.value.pos == pos
+
+
+def test_names():
+    terms = parse("0, (1, 2^N)^M, (3^N)^2")
+    assert structure.indices(terms) == {0, 1, 2, 3}
+    assert structure.rep_names(terms) == {"N", "M"}
+
+
+def test_nested_repetitions():
+    children = []
+    for bit, length in enumerate([10, 100, 1000]):
+        child = pu.AbstractSequence(None)
+        child.add_seq(bit, [length])
+        children.append(child)
+    seq = StructuredSequence(*children, structure="0, (1, 2^N)^M")
+    assert set(seq.params) >= {"N", "M"}
+    assert seq.eval(N=2, M=3).length_ns == 10 + 3 * (100 + 2 * 1000)
+    assert seq.eval(N=0, M=3).length_ns == 10 + 3 * 100
+    assert seq.compile(loops=True, N=2, M=3).length_ns == 10 + 3 * (100 + 2 * 1000)
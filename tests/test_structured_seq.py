@@ -0,0 +1,49 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from pulse_src import compiler, pulse_utils as pu
+from pulse_src.structured_seq import StructuredSequence
+
+
+def frames(prog):
+    # Joining frames with the same flags, which an instruction boundary may split
+    joined = compiler.Frames(*prog.frames())
+    return joined.t_ax.astype(float).tolist(), joined.words.tolist()
+
+
+def children():
+    a = pu.AbstractSequence(None)
+    a.add_seq(0, [30, 20, "tau"])
+    b = pu.AbstractSequence(None)
+    b.add_seq(1, [100])
+    c = pu.AbstractSequence(None)
+    c.add_seq(0, ["tau", "u", 10])
+    c.add_seq(1, [10, "tau", "tau", "u", 10])
+    c.add_seq(2, [20, 0])
+    return a, b, c
+
+
+STRUCTURES = ["0^3, 1", "0, 1^N, 2", "(0, 2)^N, 1", "2^N", "1, 0^4, 2", "(0^2, 2)^N"]
+OPTIONS = [dict(loops=True), dict(subroutines=True), dict(loops=True, subroutines=True)]
+
+
+@pytest.mark.parametrize("structure, options", list(itertools.product(STRUCTURES, OPTIONS)))
+@pytest.mark.parametrize("tau, u", [(0, 0), (0, 7), (5, 0), (5, 7)])
+def test_compile_matches_eval(structure, options, tau, u):
+    # Zero durations make toggles coincide and cancel, which must happen in
+    # the same way whether the children are merged on their own or not
+    seq = StructuredSequence(*children(), structure=structure)
+    params = {k: v for k, v in dict(tau=tau, u=u, N=3).items() if k in seq.params}
+    expected = frames(seq.eval(**params).compile())
+    assert frames(seq.compile(**options, **params)) == expected
+
+
+@pytest.mark.parametrize("structure", ["0, 1^N, 2", "(0, 2)^N, 1", "(0^2, 2)^N"])
+def test_sweep_matches_eval(structure):
+    seq = StructuredSequence(*children(), structure=structure)
+    taus = np.array([0, 5, 0, 10])
+    expected = frames(seq.eval(N=len(taus), tau=taus, u=0).compile())
+    assert frames(seq.sweep({"tau": taus}, u=0)) == expected
+    assert frames(seq.sweep({"tau": taus}, u=0, subroutines=True)) == expected